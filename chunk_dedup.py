@@ -0,0 +1,150 @@
+# chunk_dedup.py
+"""
+近重复切片检测 (切片之后、向量化之前；Day 3 入库、流式流水线、命令行替换文档共用)
+
+通知类文档里联系人信息、法律声明、修订说明等样板段落反复出现，Split_X_of_Y 的重叠窗口也会切出高度相似的切片，
+每一条都要调用一次向量接口、占一行索引。这里对切片正文做 MinHash:
+- 正文去空白、转小写后取字符 shingle (默认 5 字)，crc32 后用 num_perm 个 multiply-shift 哈希取最小值作为签名
+- LSH 分桶 (bands x rows)，只与同桶的代表切片比较签名，估计 Jaccard 相似度 >= 阈值即判为近重复
+- 每个簇只有第一条 (代表切片) 向量化；重复切片照常入库 (全文 / 标识符检索、文档归属不变)，但不写向量，
+  并在 chunk_duplicates 中记下代表切片与相似度，供结果展示出处 (见 chunk_store.set_duplicate)
+
+过短的切片 (< DEDUP_MIN_CHARS) 不参与，避免 "一、总则" 这类标题把无关内容归为一簇。
+簇不跨文档 (按 doc_title 分开检测): 每份文档都保留自己的代表切片与向量，按文档 / 章节过滤的向量检索不会漏掉
+只在其他文档中有代表的内容；省下的是文档内的重复 (重叠窗口、同一文档内反复出现的样板段落)。
+签名按文档保存 (每个代表切片 num_perm x 4 字节)，只保留最近 DEDUP_MAX_DOCS 份文档 (LRU)，流式入库在文档结束时
+即释放 (forget)；内存与文档数无关，上限约为 DEDUP_MAX_DOCS x 最大文档的切片数 x num_perm x 4 字节。
+代价: 同一文档的切片被其他文档隔开超过 DEDUP_MAX_DOCS 份时，再次出现的部分不再与之前的代表切片比较 (照常向量化)
+"""
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+from day3_config import Config
+
+_MASK64 = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+def normalize_text(text):
+    return "".join((text or "").split()).lower()
+
+def record_text(record):
+    """语料记录 -> 参与比较的正文 (与 bulk_insert 取 pure_text 的优先级一致)"""
+    text = record.get('pure_text') or record.get('metadata', {}).get('pure_text')
+    if text:
+        return text
+    embedding_text = record.get('embedding_text', '')
+    return embedding_text.split("Content: ", 1)[1] if "Content: " in embedding_text else embedding_text
+
+class MinHasher:
+    """字符 shingle 的 MinHash 签名 (uint32 x num_perm)"""
+    def __init__(self, num_perm=None, shingle_size=None, seed=1):
+        self.num_perm = num_perm or Config.DEDUP_NUM_PERM
+        self.shingle_size = shingle_size or Config.DEDUP_SHINGLE_SIZE
+        rng = np.random.RandomState(seed)
+        # multiply-shift: h(x) = (a * x + b) mod 2^64 的高 32 位，a 为奇数
+        self._a = rng.randint(0, np.iinfo(np.uint64).max, size=self.num_perm, dtype=np.uint64) | np.uint64(1)
+        self._b = rng.randint(0, np.iinfo(np.uint64).max, size=self.num_perm, dtype=np.uint64)
+
+    def shingles(self, text):
+        n = self.shingle_size
+        if len(text) <= n:
+            return {text}
+        return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in self.shingles(text)), dtype=np.uint64)
+        with np.errstate(over='ignore'):
+            mixed = (hashes[:, None] * self._a[None, :] + self._b[None, :]) & _MASK64
+        return (mixed >> np.uint64(32)).astype(np.uint32).min(axis=0)
+
+class ChunkDeduplicator:
+    """
+    一次入库运行内、按文档分开的近重复聚类 (线程安全)
+    assign(chunk_uuid, text, scope) -> (同一 scope 内的代表切片 chunk_uuid, 相似度)；本身成为代表切片时返回 (None, 1.0)
+    """
+    def __init__(self, threshold=None, num_perm=None, bands=None, shingle_size=None, min_chars=None, max_docs=None):
+        self.threshold = threshold if threshold is not None else Config.DEDUP_THRESHOLD
+        self.min_chars = min_chars if min_chars is not None else Config.DEDUP_MIN_CHARS
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.bands = bands or Config.DEDUP_BANDS
+        if self.hasher.num_perm % self.bands:
+            raise ValueError(f"num_perm ({self.hasher.num_perm}) 必须是 bands ({self.bands}) 的整数倍")
+        self.rows = self.hasher.num_perm // self.bands
+        self.max_docs = max_docs or Config.DEDUP_MAX_DOCS
+        # scope -> (buckets: (band, 签名片段) -> [代表切片 chunk_uuid], signatures: 代表切片 chunk_uuid -> 签名)
+        self._scopes = OrderedDict()
+        self._lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.representatives = 0
+        self.evicted = 0
+
+    def _band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def _scope_state(self, scope):
+        state = self._scopes.get(scope)
+        if state is None:
+            state = self._scopes[scope] = ({}, {})
+            while len(self._scopes) > self.max_docs:
+                self._scopes.popitem(last=False)
+                self.evicted += 1
+        else:
+            self._scopes.move_to_end(scope)
+        return state
+
+    def forget(self, scope):
+        """文档已全部到达时释放其签名 (流式入库在文档结束时调用)"""
+        with self._lock:
+            self._scopes.pop(scope, None)
+
+    def assign(self, chunk_uuid, text, scope=None):
+        """scope: 检测范围 (文档名)，只与同一 scope 内的代表切片比较"""
+        text = normalize_text(text)
+        if len(text) < self.min_chars:
+            return None, 1.0
+        signature = self.hasher.signature(text)
+        keys = self._band_keys(signature)
+        with self._lock:
+            buckets, signatures = self._scope_state(scope)
+            self.checked += 1
+            best, best_score = None, 0.0
+            seen = set()
+            for key in keys:
+                for candidate in buckets.get(key, ()):
+                    if candidate in seen:
+                        continue
+                    seen.add(candidate)
+                    score = float(np.mean(signatures[candidate] == signature))
+                    if score > best_score:
+                        best, best_score = candidate, score
+            if best is not None and best_score >= self.threshold:
+                self.duplicates += 1
+                return best, best_score
+            signatures[chunk_uuid] = signature
+            self.representatives += 1
+            for key in keys:
+                buckets.setdefault(key, []).append(chunk_uuid)
+            return None, 1.0
+
+    def mark(self, records):
+        """
+        逐条判定语料记录 (按顺序，先到的成为代表)，重复切片写入 duplicate_of / duplicate_similarity
+        返回本批需要向量化的记录
+        """
+        targets = []
+        for record in records:
+            meta = record.get('metadata', {})
+            representative, similarity = self.assign(meta.get('section_id', ''), record_text(record),
+                                                      scope=meta.get('doc_title', ''))
+            if representative is None:
+                targets.append(record)
+            else:
+                record['duplicate_of'] = representative
+                record['duplicate_similarity'] = round(similarity, 4)
+        return targets
+
+    def summary(self):
+        rate = self.duplicates / self.checked * 100 if self.checked else 0.0
+        return (f"[Dedup] 近重复切片 {self.duplicates} 条跳过向量化 (参与比较 {self.checked} 条, {rate:.1f}%, "
+                f"代表切片 {self.representatives} 条, 按文档 LRU 释放签名 {self.evicted} 次)")
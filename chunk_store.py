@@ -0,0 +1,256 @@
+# chunk_store.py
+"""
+切片存储的规范化表结构 (Day 2 各入口与 Day 3 DBConnector 共用)
+
+原 chunks_full_index 每行都存 full_context_text: 其中 Document / Chapter / Section 表头与
+doc_title / chapter_title / sub_title 重复，正文又与 pure_text 重复；长段落切成 N 片时表头也存 N 份。
+规范化后:
+- doc_catalog (doc_id, doc_title): 每个文档一行 (documents 已是按内容哈希的版本登记表，这里只做名称目录)
+- sections (section_id, doc_id, chapter_title, sub_title): 每个 (文档, 章, 节) 一行
+- chunks: 只存本切片的正文、页码、策略、向量，section_id 引用所属章节
+- chunks_full_index 改为同名视图，full_context_text 按 SmartChunker 的格式现场拼出；
+  写入方给出的 full_context_text 与拼接结果不同时 (如旧版 Day 2 的空节名) 才存入 context_override
+- 视图上的 INSTEAD OF 触发器把 INSERT / UPDATE / DELETE 转写到基础表，原有读写 SQL 不用改
+  (INSERT OR REPLACE 的冲突策略作用于 chunks 的主键)
+- 视图的 rowid 列即 chunks.rowid；FTS 与变更日志的触发器挂在 chunks 上，rowid 仍与 FTS 对齐
+
+chunk_duplicates (chunk_uuid -> 代表切片 chunk_uuid, 相似度): 近重复切片 (chunk_dedup) 不写向量，
+只记下所属簇的代表切片，供结果展示出处；代表切片被删除时由 release_representatives 把向量转给簇内存活的切片
+
+旧库 (chunks_full_index 是普通表) 由 Day 3 DBConnector 启动时迁移: 按原 rowid 拷贝后删除旧表，
+FTS 行无需重建；Day 2 入口遇到旧表不迁移，照旧写入
+"""
+
+VIEW_NAME = "chunks_full_index"
+
+TABLE_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS doc_catalog (
+        doc_id INTEGER PRIMARY KEY,
+        doc_title TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS sections (
+        section_id INTEGER PRIMARY KEY,
+        doc_id INTEGER NOT NULL REFERENCES doc_catalog (doc_id),
+        chapter_title TEXT NOT NULL,
+        sub_title TEXT NOT NULL,
+        UNIQUE (doc_id, chapter_title, sub_title)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS chunks (
+        chunk_uuid TEXT PRIMARY KEY,
+        section_id INTEGER NOT NULL REFERENCES sections (section_id),
+        pure_text TEXT,
+        context_override TEXT,
+        page_num INTEGER,
+        char_count INTEGER,
+        strategy_tag TEXT,
+        created_at DATETIME,
+        embedding_json TEXT
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_chunks_section ON chunks (section_id)",
+    '''
+    CREATE TABLE IF NOT EXISTS chunk_duplicates (
+        chunk_uuid TEXT PRIMARY KEY,
+        representative_uuid TEXT NOT NULL,
+        similarity REAL
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_chunk_duplicates_rep ON chunk_duplicates (representative_uuid)",
+]
+
+def context_text_sql(doc_title, chapter_title, sub_title, pure_text):
+    """与 SmartChunker 相同格式的 full_context_text 拼接表达式 (参数为 SQL 列表达式)"""
+    return (f"'Document: ' || {doc_title} || char(10) || "
+            f"'Chapter: ' || COALESCE(NULLIF({chapter_title}, ''), 'General') || char(10) || "
+            f"'Section: ' || COALESCE(NULLIF({sub_title}, ''), 'Intro') || char(10) || "
+            f"'Content: ' || {pure_text}")
+
+def _override_sql(row):
+    """写入的 full_context_text 与现场拼接结果相同 (或为空) 时不存"""
+    rebuilt = context_text_sql(f"COALESCE({row}.doc_title, '')", f"{row}.chapter_title",
+                               f"{row}.sub_title", f"{row}.pure_text")
+    return (f"CASE WHEN {row}.full_context_text IS NULL OR {row}.full_context_text = {rebuilt} "
+            f"THEN NULL ELSE {row}.full_context_text END")
+
+VIEW_SQL = f'''
+    CREATE VIEW IF NOT EXISTS {VIEW_NAME} AS
+    SELECT c.rowid AS rowid,
+           c.chunk_uuid AS chunk_uuid,
+           d.doc_title AS doc_title,
+           s.chapter_title AS chapter_title,
+           s.sub_title AS sub_title,
+           COALESCE(c.context_override,
+                    {context_text_sql("d.doc_title", "s.chapter_title", "s.sub_title", "c.pure_text")}) AS full_context_text,
+           c.pure_text AS pure_text,
+           c.page_num AS page_num,
+           c.char_count AS char_count,
+           c.strategy_tag AS strategy_tag,
+           c.created_at AS created_at,
+           c.embedding_json AS embedding_json
+    FROM chunks c
+    JOIN sections s ON s.section_id = c.section_id
+    JOIN doc_catalog d ON d.doc_id = s.doc_id
+'''
+
+# 文档 / 章节行不存在时补上 (WHERE NOT EXISTS 而非 OR IGNORE: 外层 INSERT OR REPLACE 会覆盖触发器内的冲突策略)
+_ENSURE_SECTION_SQL = '''
+    INSERT INTO doc_catalog (doc_title)
+    SELECT COALESCE(NEW.doc_title, '')
+    WHERE NOT EXISTS (SELECT 1 FROM doc_catalog WHERE doc_title = COALESCE(NEW.doc_title, ''));
+    INSERT INTO sections (doc_id, chapter_title, sub_title)
+    SELECT d.doc_id, COALESCE(NEW.chapter_title, ''), COALESCE(NEW.sub_title, '')
+    FROM doc_catalog d
+    WHERE d.doc_title = COALESCE(NEW.doc_title, '')
+      AND NOT EXISTS (SELECT 1 FROM sections s WHERE s.doc_id = d.doc_id
+                      AND s.chapter_title = COALESCE(NEW.chapter_title, '')
+                      AND s.sub_title = COALESCE(NEW.sub_title, ''));
+'''
+
+_SECTION_LOOKUP_SQL = '''(
+    SELECT s.section_id FROM sections s JOIN doc_catalog d ON d.doc_id = s.doc_id
+    WHERE d.doc_title = COALESCE(NEW.doc_title, '')
+      AND s.chapter_title = COALESCE(NEW.chapter_title, '')
+      AND s.sub_title = COALESCE(NEW.sub_title, ''))'''
+
+TRIGGER_SQL = [
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {VIEW_NAME}_ii INSTEAD OF INSERT ON {VIEW_NAME} BEGIN
+        {_ENSURE_SECTION_SQL}
+        INSERT INTO chunks (chunk_uuid, section_id, pure_text, context_override, page_num,
+                            char_count, strategy_tag, created_at, embedding_json)
+        VALUES (NEW.chunk_uuid, {_SECTION_LOOKUP_SQL}, NEW.pure_text, {_override_sql("NEW")}, NEW.page_num,
+                NEW.char_count, NEW.strategy_tag, NEW.created_at, NEW.embedding_json);
+    END
+    ''',
+    # 未改动 full_context_text 的 UPDATE (如只回填 embedding_json) 保留原 context_override
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {VIEW_NAME}_iu INSTEAD OF UPDATE ON {VIEW_NAME} BEGIN
+        {_ENSURE_SECTION_SQL}
+        UPDATE chunks SET
+            chunk_uuid = NEW.chunk_uuid,
+            section_id = {_SECTION_LOOKUP_SQL},
+            pure_text = NEW.pure_text,
+            context_override = CASE WHEN NEW.full_context_text IS OLD.full_context_text
+                                    THEN context_override ELSE {_override_sql("NEW")} END,
+            page_num = NEW.page_num,
+            char_count = NEW.char_count,
+            strategy_tag = NEW.strategy_tag,
+            created_at = NEW.created_at,
+            embedding_json = NEW.embedding_json
+        WHERE chunk_uuid = OLD.chunk_uuid;
+    END
+    ''',
+    f'''
+    CREATE TRIGGER IF NOT EXISTS {VIEW_NAME}_id INSTEAD OF DELETE ON {VIEW_NAME} BEGIN
+        DELETE FROM chunks WHERE chunk_uuid = OLD.chunk_uuid;
+    END
+    ''',
+]
+
+def _object_type(cursor, name):
+    row = cursor.execute("SELECT type FROM sqlite_master WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+def _migrate_legacy_table(cursor):
+    """旧版普通表 -> 规范化基础表 (保留 rowid，FTS 行仍对齐)，删除旧表及其触发器；返回迁移的行数"""
+    columns = {row[1] for row in cursor.execute(f"PRAGMA table_info({VIEW_NAME})")}
+    embedding = "t.embedding_json" if 'embedding_json' in columns else "NULL"
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO doc_catalog (doc_title)
+        SELECT DISTINCT COALESCE(doc_title, '') FROM {VIEW_NAME}
+    ''')
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO sections (doc_id, chapter_title, sub_title)
+        SELECT DISTINCT d.doc_id, COALESCE(t.chapter_title, ''), COALESCE(t.sub_title, '')
+        FROM {VIEW_NAME} t JOIN doc_catalog d ON d.doc_title = COALESCE(t.doc_title, '')
+    ''')
+    cursor.execute(f'''
+        INSERT INTO chunks (rowid, chunk_uuid, section_id, pure_text, context_override, page_num,
+                            char_count, strategy_tag, created_at, embedding_json)
+        SELECT t.rowid, t.chunk_uuid, s.section_id, t.pure_text, {_override_sql("t")}, t.page_num,
+               t.char_count, t.strategy_tag, t.created_at, {embedding}
+        FROM {VIEW_NAME} t
+        JOIN doc_catalog d ON d.doc_title = COALESCE(t.doc_title, '')
+        JOIN sections s ON s.doc_id = d.doc_id
+                       AND s.chapter_title = COALESCE(t.chapter_title, '')
+                       AND s.sub_title = COALESCE(t.sub_title, '')
+    ''')
+    migrated = cursor.rowcount
+    # 旧表上的 FTS / 变更日志触发器与索引随表一起删除，由调用方在 chunks 上重建
+    cursor.execute(f"DROP TABLE {VIEW_NAME}")
+    return migrated
+
+def init_chunk_tables(cursor, migrate=False):
+    """
+    建基础表、兼容视图与 INSTEAD OF 触发器 (不提交)
+    chunks_full_index 仍是旧版普通表时: migrate=True 迁移并返回迁移行数；否则保持旧表，返回 None
+    其余情况返回 0
+    """
+    for sql in TABLE_SQL:
+        cursor.execute(sql)
+    migrated = 0
+    if _object_type(cursor, VIEW_NAME) == 'table':
+        if not migrate:
+            return None
+        migrated = _migrate_legacy_table(cursor)
+    cursor.execute(VIEW_SQL)
+    for sql in TRIGGER_SQL:
+        cursor.execute(sql)
+    return migrated
+
+def prune_sections(cursor):
+    """删除已没有切片的章节与文档目录行 (按文档删除 / 替换切片后调用，不提交)"""
+    cursor.execute('''
+        DELETE FROM sections
+        WHERE NOT EXISTS (SELECT 1 FROM chunks c WHERE c.section_id = sections.section_id)
+    ''')
+    cursor.execute('''
+        DELETE FROM doc_catalog
+        WHERE NOT EXISTS (SELECT 1 FROM sections s WHERE s.doc_id = doc_catalog.doc_id)
+    ''')
+
+def set_duplicate(cursor, chunk_uuid, representative_uuid=None, similarity=None):
+    """
+    写入切片时登记 / 清除其近重复归属 (不提交)
+    切片改判为重复时，原先挂在它名下的重复切片一并改挂到新的代表切片
+    """
+    if representative_uuid is None:
+        cursor.execute("DELETE FROM chunk_duplicates WHERE chunk_uuid = ?", (chunk_uuid,))
+        return
+    cursor.execute("INSERT OR REPLACE INTO chunk_duplicates (chunk_uuid, representative_uuid, similarity) VALUES (?, ?, ?)",
+                   (chunk_uuid, representative_uuid, similarity))
+    cursor.execute("UPDATE chunk_duplicates SET representative_uuid = ? WHERE representative_uuid = ?",
+                   (representative_uuid, chunk_uuid))
+
+def release_representatives(cursor, chunk_uuids):
+    """
+    删除切片之前调用 (不提交): 被删除的代表切片若还有存活的重复切片，把向量转给相似度最高的一条，
+    簇内其余切片改挂到它名下；该切片的向量更新经变更日志回放到索引
+    返回被提升为代表的 chunk_uuid 列表
+    """
+    deleted = set(chunk_uuids)
+    promoted = []
+    for chunk_uuid in chunk_uuids:
+        survivors = [row[0] for row in cursor.execute(
+            "SELECT chunk_uuid FROM chunk_duplicates WHERE representative_uuid = ? ORDER BY similarity DESC",
+            (chunk_uuid,)).fetchall() if row[0] not in deleted]
+        if not survivors:
+            continue
+        heir = survivors[0]
+        cursor.execute(f"""
+            UPDATE {VIEW_NAME} SET embedding_json = (SELECT embedding_json FROM {VIEW_NAME} WHERE chunk_uuid = ?)
+            WHERE chunk_uuid = ?
+        """, (chunk_uuid, heir))
+        cursor.execute("DELETE FROM chunk_duplicates WHERE chunk_uuid = ?", (heir,))
+        cursor.execute("UPDATE chunk_duplicates SET representative_uuid = ? WHERE representative_uuid = ?",
+                       (heir, chunk_uuid))
+        promoted.append(heir)
+    rows = [(chunk_uuid,) for chunk_uuid in chunk_uuids]
+    cursor.executemany("DELETE FROM chunk_duplicates WHERE chunk_uuid = ?", rows)
+    cursor.executemany("DELETE FROM chunk_duplicates WHERE representative_uuid = ?", rows)
+    return promoted
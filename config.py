@@ -28,4 +28,10 @@ class RAGConfig:
     # 默认 OCR 开关
     DEFAULT_ENABLE_OCR = True 
     # 扫描分辨率
-    OCR_DPI = 300
\ No newline at end of file
+    OCR_DPI = 300
+    # 流式解析 (iter_lines) 时用前几页统计正文字号
+    STREAM_FONT_SAMPLE_PAGES = 3
+    # OCR 调度 (ocr_scheduler.py): 同时进行的 OCR 页数 (槽位) 与每个槽位的 Tesseract 线程数
+    # Tesseract 多线程加速有限，默认每核一个槽位、每槽单线程
+    OCR_SLOTS = os.cpu_count() or 1
+    OCR_THREADS_PER_SLOT = 1
\ No newline at end of file
@@ -0,0 +1,248 @@
+# corpus_io.py
+"""
+切片语料读写 (Day 2 产出 / Day 3 入库共用)
+
+格式: JSONL，每行一个切片记录 (与原 JSON 数组中的元素完全相同)，UTF-8
+- 按扩展名选择压缩: .jsonl (不压缩) / .jsonl.gz (gzip) / .jsonl.zst (zstd，需安装 zstandard)
+- 边切片边写入 (CorpusWriter)，不再在内存里攒整个列表后 json.dump(indent=2)
+- 读取按行惰性解析 (iter_corpus / iter_batches)，内存占用只与批大小有关
+- 不压缩的 JSONL 同时写出偏移索引 <语料>.idx (每条记录的起始字节偏移，uint64 小端)，
+  CorpusReader 据此 O(1) 随机读取第 i 条 (预览、抽样、断点续跑)
+- 读取端自动识别格式: 按文件头魔数识别压缩，按首个非空字符识别 JSONL ('{') 与旧版 JSON 数组 ('[')；
+  旧版数组只能整体 json.load，仍可读取但没有流式的内存优势
+"""
+import gzip
+import io
+import json
+import os
+import sys
+from array import array
+
+try:
+    import zstandard
+except ImportError:  # zstd 为可选依赖，只在读写 .zst 语料时需要
+    zstandard = None
+
+INDEX_SUFFIX = ".idx"
+
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def _compression_by_suffix(path):
+    lower = path.lower()
+    if lower.endswith(".gz"):
+        return "gzip"
+    if lower.endswith(".zst") or lower.endswith(".zstd"):
+        return "zstd"
+    return None
+
+def _compression_by_magic(path):
+    with open(path, "rb") as f:
+        head = f.read(4)
+    if head.startswith(_GZIP_MAGIC):
+        return "gzip"
+    if head == _ZSTD_MAGIC:
+        return "zstd"
+    return None
+
+def _require_zstd():
+    if zstandard is None:
+        raise RuntimeError("读写 .zst 语料需要安装 zstandard (pip install zstandard)")
+
+def _open_binary(path, mode, compression):
+    """mode: 'rb' / 'wb'，返回 (二进制) 文件对象"""
+    if compression == "gzip":
+        return gzip.open(path, mode)
+    if compression == "zstd":
+        _require_zstd()
+        raw = open(path, mode)
+        if mode == "rb":
+            # stream_reader 不支持按行迭代，套一层 BufferedReader
+            return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, closefd=True))
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+    return open(path, mode)
+
+def index_path_for(corpus_path):
+    return corpus_path + INDEX_SUFFIX
+
+def detect_format(path):
+    """
+    返回 (compression, layout)
+    compression: None / 'gzip' / 'zstd'；layout: 'jsonl' / 'array' (旧版 JSON 数组) / 'empty'
+    """
+    compression = _compression_by_magic(path)
+    with _open_binary(path, "rb", compression) as f:
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                return compression, "empty"
+            stripped = chunk.lstrip(b" \t\r\n\xef\xbb\xbf")
+            if stripped:
+                return compression, "array" if stripped[:1] == b"[" else "jsonl"
+
+class CorpusWriter:
+    """
+    增量写出 JSONL 语料 (with 语句使用；异常退出时也会关闭文件)
+    不压缩时同步写出偏移索引；写入先落到临时文件，close() 时原子替换，避免读到写了一半的语料
+    """
+    def __init__(self, path, write_index=True):
+        self.path = path
+        self.compression = _compression_by_suffix(path)
+        self.count = 0
+        self._tmp_path = path + ".tmp"
+        self._file = _open_binary(self._tmp_path, "wb", self.compression)
+        self._offsets = array("Q") if (write_index and self.compression is None) else None
+        self._pos = 0
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+        if self._offsets is not None:
+            self._offsets.append(self._pos)
+        self._file.write(line)
+        self._pos += len(line)
+        self.count += 1
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.replace(self._tmp_path, self.path)
+        idx_path = index_path_for(self.path)
+        if self._offsets is not None:
+            _write_index(idx_path, self._offsets)
+        elif os.path.exists(idx_path):
+            # 同名旧索引已与新语料不符
+            os.remove(idx_path)
+
+    def abort(self):
+        """丢弃未完成的语料 (保留原有文件不变)"""
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+def _write_index(idx_path, offsets):
+    tmp_path = idx_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        if sys.byteorder != "little":
+            offsets = array("Q", offsets)
+            offsets.byteswap()
+        f.write(offsets.tobytes())
+    os.replace(tmp_path, idx_path)
+
+def _read_index(idx_path):
+    offsets = array("Q")
+    with open(idx_path, "rb") as f:
+        offsets.frombytes(f.read())
+    if sys.byteorder != "little":
+        offsets.byteswap()
+    return offsets
+
+def iter_corpus(path):
+    """逐条产出语料记录 (自动识别 JSONL / 压缩 / 旧版 JSON 数组)"""
+    compression, layout = detect_format(path)
+    if layout == "empty":
+        return
+    if layout == "array":
+        with _open_binary(path, "rb", compression) as f:
+            data = json.load(io.TextIOWrapper(f, encoding="utf-8-sig"))
+        yield from data
+        return
+    with _open_binary(path, "rb", compression) as f:
+        for line_no, line in enumerate(io.TextIOWrapper(f, encoding="utf-8-sig"), 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"语料第 {line_no} 行不是合法 JSON: {e}")
+
+def iter_batches(path, batch_size):
+    """按批产出语料记录列表，最后一批可能不足 batch_size"""
+    batch = []
+    for record in iter_corpus(path):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def count_records(path):
+    """语料条数: 有偏移索引时直接取索引长度，否则流式数一遍 (不保留记录)"""
+    idx_path = index_path_for(path)
+    if os.path.exists(idx_path) and os.path.getmtime(idx_path) >= os.path.getmtime(path):
+        return os.path.getsize(idx_path) // 8
+    compression, layout = detect_format(path)
+    if layout == "jsonl":
+        count = 0
+        with _open_binary(path, "rb", compression) as f:
+            for line in f:
+                if line.strip():
+                    count += 1
+        return count
+    return sum(1 for _ in iter_corpus(path))
+
+def build_index(path):
+    """为已有的不压缩 JSONL 语料 (重新) 生成偏移索引，返回记录数"""
+    compression, layout = detect_format(path)
+    if compression is not None or layout == "array":
+        raise ValueError("只有不压缩的 JSONL 语料支持偏移索引")
+    offsets = array("Q")
+    pos = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                offsets.append(pos)
+            pos += len(line)
+    _write_index(index_path_for(path), offsets)
+    return len(offsets)
+
+class CorpusReader:
+    """
+    按序号随机读取不压缩的 JSONL 语料
+    索引缺失或比语料旧时自动重建 (顺序扫描一遍)
+    """
+    def __init__(self, path):
+        self.path = path
+        idx_path = index_path_for(path)
+        if not os.path.exists(idx_path) or os.path.getmtime(idx_path) < os.path.getmtime(path):
+            build_index(path)
+        self._offsets = _read_index(idx_path)
+        self._file = open(path, "rb")
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self._offsets)
+        self._file.seek(self._offsets[i])
+        return json.loads(self._file.readline().decode("utf-8-sig"))
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
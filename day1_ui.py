@@ -10,6 +10,7 @@ from PyQt5.QtCore import QThread, pyqtSignal, Qt
 
 # 导入逻辑模块
 from pdf_structure_parser import PDFStructureParser
+from ocr_scheduler import PRIORITY_INTERACTIVE
 from config import RAGConfig
 
 class ParserWorker(QThread):
@@ -27,7 +28,7 @@ class ParserWorker(QThread):
     def run(self):
         try:
             self.log_signal.emit("初始化解析器...")
-            parser = PDFStructureParser(self.filepath, self.use_ocr)
+            parser = PDFStructureParser(self.filepath, self.use_ocr, ocr_priority=PRIORITY_INTERACTIVE)
             
             self.log_signal.emit(f"开始解析 (模式: {'OCR' if self.use_ocr else 'PDF元数据'})...")
             # 传递 progress_signal 给 parser 用于回调
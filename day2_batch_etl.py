@@ -0,0 +1,238 @@
+# day2_batch_etl.py
+"""
+Day 2 批量 ETL (无界面): 目录 / 通配符下的全部 PDF -> 切片 -> 同一个 DB + 同一份 JSONL 语料
+
+- 解析与切片在进程池中按文档并行 (pdfplumber / OCR 都是 CPU 密集，线程受 GIL 限制)
+- OCR 的 CPU 总预算: 主进程启动共享的 OCR 调度器 (ocr_scheduler)，全部工作进程共用
+  OCR 预算 / 每槽线程数 个槽位，避免 N 个进程各自按核数开 OpenMP 线程导致机器过载；
+  调度器只覆盖本次批量任务的进程树，其他进程 (Day 1 界面等) 各用自己的本地调度器，彼此之间没有优先级
+- 只有主进程写 DB 与语料 (SQLite 单写者)，每个文档一个事务
+- 按文档登记表 (document_registry) 去重: 内容与解析参数都未变的文件 (即使改了文件名) 直接跳过，
+  不再重复 OCR / 切片；同名文档内容变化时旧版本切片与新版本在同一事务中替换
+- 文档以文件名标识: 本批次内出现同名的不同文件 (--recursive 下的 dir1/通知.pdf 与 dir2/通知.pdf) 时只处理第一个，
+  其余报错并计入失败
+- 每个文档输出吞吐 (页/秒、切片/秒)，结束时输出汇总
+
+本次语料只包含新入库的文档，交给 Day 3 向量化即可
+
+用法示例:
+    python day2_batch_etl.py ./notices --db rag_production.db
+    python day2_batch_etl.py "scans/*.pdf" --ocr --workers 4 --ocr-cpus 8
+"""
+import argparse
+import concurrent.futures
+import glob
+import os
+import time
+from day2_etl_gui_v3 import Day2Config, DBManager, SmartChunker, document_settings
+from pdf_structure_parser import PDFStructureParser
+from corpus_io import CorpusWriter
+from config import RAGConfig
+from ocr_scheduler import PRIORITY_BATCH, install_scheduler, start_shared_scheduler
+from document_registry import (file_sha256, find_ingested, next_version, document_chunk_ids,
+                               delete_chunks, register_document, mark_failed)
+
+def collect_pdfs(inputs, recursive=False):
+    """目录 / 通配符 / 文件 -> 去重后的 PDF 路径列表 (保持输入顺序)"""
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            if recursive:
+                for root, _, files in os.walk(item):
+                    paths.extend(os.path.join(root, f) for f in sorted(files))
+            else:
+                paths.extend(os.path.join(item, f) for f in sorted(os.listdir(item)))
+        elif glob.has_magic(item):
+            paths.extend(sorted(glob.glob(item, recursive=recursive)))
+        else:
+            paths.append(item)
+    seen = set()
+    result = []
+    for path in paths:
+        key = os.path.abspath(path)
+        if path.lower().endswith('.pdf') and os.path.isfile(path) and key not in seen:
+            seen.add(key)
+            result.append(path)
+    return result
+
+def _init_worker(scheduler, threads_per_slot):
+    # 工作进程挂上主进程共享调度器的代理 (同时设置 Tesseract 线程数)
+    if scheduler is not None:
+        install_scheduler(scheduler, threads_per_slot)
+
+def parse_document(path, use_ocr):
+    """
+    工作进程: 解析 + 切片一个 PDF (与 ETLWorker 相同的 H1/H2 状态机)
+    返回可 pickle 的结果字典，由主进程统一写库
+    """
+    start = time.perf_counter()
+    doc_title = os.path.basename(path)
+    parser = PDFStructureParser(path, use_ocr=use_ocr, ocr_priority=PRIORITY_BATCH)
+    lines = parser.parse()
+    parse_seconds = time.perf_counter() - start
+
+    packets = []
+    current_h1, current_h2 = None, None
+    for line in lines:
+        if line.role == 'H1':
+            current_h1, current_h2 = line.text, None
+        elif line.role == 'H2':
+            current_h2 = line.text
+        elif line.role == 'BODY':
+            packets.extend(SmartChunker.process_paragraph(doc_title, current_h1, current_h2,
+                                                          line.text, line.page_num))
+    return {
+        'path': path,
+        'doc_title': doc_title,
+        'page_count': parser.page_count,
+        'packets': packets,
+        'parse_seconds': parse_seconds,
+        'total_seconds': time.perf_counter() - start,
+    }
+
+class BatchETL:
+    """主进程: 分发文档、单写者入库、登记表去重与吞吐统计"""
+    def __init__(self, db_path, corpus_path, use_ocr=False, workers=None, ocr_cpus=None,
+                 threads_per_slot=None, logger=print):
+        self.db_path = db_path
+        self.corpus_path = corpus_path
+        self.use_ocr = use_ocr
+        self.workers = workers or os.cpu_count() or 1
+        self.ocr_cpus = ocr_cpus or os.cpu_count() or 1
+        self.threads_per_slot = threads_per_slot or RAGConfig.OCR_THREADS_PER_SLOT
+        self.logger = logger
+        self.settings = document_settings(use_ocr)
+
+    def _write_document(self, db, corpus, result, content_hash):
+        """删除同名旧版本切片 + 写入全部新切片 + 登记记录，在同一个事务中提交"""
+        doc_title = result['doc_title']
+        try:
+            version = next_version(db.cursor, doc_title)
+            replaced = delete_chunks(db.cursor, document_chunk_ids(db.cursor, doc_title))
+            for packet in result['packets']:
+                db.insert_chunk(packet['db'])
+            register_document(db.cursor, content_hash, doc_title, version, os.path.abspath(result['path']),
+                              result['page_count'], len(result['packets']), self.settings)
+            db.commit()
+        except Exception:
+            db.conn.rollback()
+            raise
+        if replaced:
+            self.logger(f"[Registry] 《{doc_title}》内容已变化，替换旧版本的 {replaced} 个切片 (新版本 v{version})")
+        corpus.write_many(packet['json'] for packet in result['packets'])
+
+    def _mark_failed(self, db, path, content_hash, error):
+        mark_failed(db.cursor, content_hash, os.path.basename(path), os.path.abspath(path), self.settings, error)
+        db.commit()
+
+    def run(self, pdf_paths):
+        start = time.perf_counter()
+        db = DBManager(self.db_path)
+
+        pending = []
+        skipped = 0
+        seen = set()
+        for path in pdf_paths:
+            content_hash = file_sha256(path)
+            existing = find_ingested(db.cursor, content_hash, self.settings)
+            if existing or content_hash in seen:  # 本批次内的重复文件也只处理一次
+                self.logger(f"[Skip] 内容未变化，已入库: {os.path.basename(path)}"
+                            + (f" (《{existing[0]}》v{existing[1]})" if existing else ""))
+                skipped += 1
+                continue
+            seen.add(content_hash)
+            pending.append((path, content_hash))
+
+        # 文档以文件名 (doc_title) 标识: 本批次内不同目录下的同名文件不能都入库，否则后写入的会把前一个当作旧版本替换掉
+        conflicts = []
+        by_title = {}
+        for path, content_hash in pending:
+            first = by_title.setdefault(os.path.basename(path), path)
+            if first is not path:
+                self.logger(f"[Error] 文件名与 {first} 相同，未处理 (文档按文件名标识，请改名后单独入库): {path}")
+                conflicts.append((path, content_hash))
+        pending = [item for item in pending if item not in conflicts]
+
+        ocr_slots = max(1, self.ocr_cpus // self.threads_per_slot)
+        self.logger(f"[Batch] 待处理 {len(pending)} 个文档 (跳过 {skipped}, 同名冲突 {len(conflicts)}) | 进程数: {self.workers}"
+                    + (f" | OCR 槽位: {ocr_slots} x {self.threads_per_slot} 线程" if self.use_ocr else ""))
+
+        stats = {'docs': 0, 'failed': len(conflicts), 'skipped': skipped, 'pages': 0, 'chunks': 0}
+        manager, scheduler = None, None
+        if pending and self.use_ocr:
+            manager, scheduler = start_shared_scheduler(ocr_slots, self.threads_per_slot)
+        if pending:
+            with CorpusWriter(self.corpus_path) as corpus, \
+                    concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                                           initargs=(scheduler, self.threads_per_slot)) as executor:
+                # 有界提交: 每个进程最多 2 个待写文档，已解析的结果不会在主进程堆积
+                todo = list(reversed(pending))
+                inflight = {}
+                while todo or inflight:
+                    while todo and len(inflight) < self.workers * 2:
+                        path, content_hash = todo.pop()
+                        inflight[executor.submit(parse_document, path, self.use_ocr)] = (path, content_hash)
+                    done, _ = concurrent.futures.wait(inflight, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        path, content_hash = inflight.pop(future)
+                        try:
+                            result = future.result()
+                            self._write_document(db, corpus, result, content_hash)
+                        except Exception as e:
+                            stats['failed'] += 1
+                            self.logger(f"[Error] {os.path.basename(path)}: {e}")
+                            self._mark_failed(db, path, content_hash, e)
+                            continue
+                        stats['docs'] += 1
+                        stats['pages'] += result['page_count']
+                        stats['chunks'] += len(result['packets'])
+                        seconds = max(result['total_seconds'], 1e-6)
+                        self.logger(f"[Doc] 《{result['doc_title']}》{result['page_count']} 页 / "
+                                    f"{len(result['packets'])} 切片 | 解析 {result['parse_seconds']:.2f}s | "
+                                    f"{result['page_count'] / seconds:.1f} 页/s, {len(result['packets']) / seconds:.1f} 切片/s")
+                if not stats['docs']:
+                    corpus.abort()  # 没有新文档入库时保留上一次的语料
+        if manager is not None:
+            stats['ocr'] = scheduler.stats()
+            manager.shutdown()
+        db.close()
+
+        elapsed = time.perf_counter() - start
+        stats['seconds'] = elapsed
+        self.logger("=" * 50)
+        self.logger(f"[SUCCESS] 批量 ETL 完成: 成功 {stats['docs']} | 失败 {stats['failed']} | 跳过 {stats['skipped']}")
+        self.logger(f"总页数: {stats['pages']} | 总切片: {stats['chunks']} | 耗时 {elapsed:.2f}s | "
+                    f"{stats['pages'] / max(elapsed, 1e-6) * 60:.1f} 页/分钟")
+        if stats['docs']:
+            self.logger(f"数据库: {self.db_path} | 语料JSONL: {self.corpus_path}")
+        if 'ocr' in stats:
+            ocr = stats['ocr']
+            self.logger(f"OCR 调度: 槽位利用率 {ocr['utilization'] * 100:.1f}% | 页数 {ocr['granted']} | "
+                        f"平均排队 {ocr['avg_wait_ms']:.0f}ms (最长 {ocr['max_wait_ms']:.0f}ms)")
+        self.logger("=" * 50)
+        return stats
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Day 2 批量 ETL: 多进程解析切片，单写者入库")
+    parser.add_argument("inputs", nargs="+", help="PDF 文件、目录或通配符 (如 \"scans/*.pdf\")")
+    parser.add_argument("--recursive", action="store_true", help="递归子目录 (通配符支持 **)")
+    parser.add_argument("--db", default=Day2Config.DB_PATH, help="目标数据库路径")
+    parser.add_argument("--corpus", default=Day2Config.JSON_OUTPUT_PATH, help="输出语料路径 (.jsonl / .jsonl.gz / .jsonl.zst)")
+    parser.add_argument("--ocr", action="store_true", help="使用 OCR 解析 (扫描件)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="解析进程数 (默认 CPU 核数)")
+    parser.add_argument("--ocr-cpus", type=int, default=os.cpu_count(), help="OCR 可用的 CPU 线程总数")
+    parser.add_argument("--ocr-threads", type=int, default=RAGConfig.OCR_THREADS_PER_SLOT, help="每个 OCR 槽位的 Tesseract 线程数")
+    return parser
+
+def main():
+    args = build_arg_parser().parse_args()
+    pdf_paths = collect_pdfs(args.inputs, recursive=args.recursive)
+    if not pdf_paths:
+        print("错误: 没有找到 PDF 文件")
+        return 1
+    BatchETL(args.db, args.corpus, use_ocr=args.ocr, workers=args.workers, ocr_cpus=args.ocr_cpus,
+             threads_per_slot=args.ocr_threads).run(pdf_paths)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
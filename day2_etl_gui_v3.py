@@ -2,7 +2,6 @@ import tkinter as tk
 from tkinter import filedialog, scrolledtext, messagebox, ttk
 import threading
 import sqlite3
-import json
 import uuid
 import os
 import queue
@@ -11,13 +10,23 @@ from datetime import datetime
 # 复用 Day 1 ��解析器 (确保 pdf_structure_parser.py 在同级目录)
 from pdf_structure_parser import PDFStructureParser
 from config import RAGConfig as Day1Config
+# 规范化切片存储 (文档目录 / 章节表 / 切片表，与 Day 3 共用)
+from chunk_store import init_chunk_tables
+# 文号 / 编号抽取 (与 Day 3 查询侧共用同一套规则)
+from identifier_extractor import extract_identifiers, init_identifier_table, insert_identifiers
+# 切片语料读写 (JSONL，边切片边写出)
+from corpus_io import CorpusWriter
+# 文档登记表 (按内容哈希跳过未变化的文档、原子替换旧版本)
+from document_registry import (init_document_table, file_sha256, find_ingested, next_version,
+                               document_chunk_ids, delete_chunks, register_document, mark_failed)
 
 # ==========================================
 # 1. 核心配置 (Configuration & Schema)
 # ==========================================
 class Day2Config:
     DB_PATH = "rag_production.db"
-    JSON_OUTPUT_PATH = "rag_corpus_for_embedding.json"
+    # JSONL 语料 (每行一个切片)；扩展名 .jsonl.gz / .jsonl.zst 时压缩写出
+    JSON_OUTPUT_PATH = "rag_corpus_for_embedding.jsonl"
     
     # 策略阈值
     MAX_CHUNK_CHARS = 800       
@@ -35,21 +44,13 @@ class DBManager:
         self._init_tables()
         
     def _init_tables(self):
-        # 扁平化存储结构，对应 Gemini 方案 V2 的表设计
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chunks_full_index (
-                chunk_uuid TEXT PRIMARY KEY,
-                doc_title TEXT,
-                chapter_title TEXT,
-                sub_title TEXT,
-                full_context_text TEXT,
-                pure_text TEXT,
-                page_num INTEGER,
-                char_count INTEGER,
-                strategy_tag TEXT,
-                created_at DATETIME
-            )
-        ''')
+        # 规范化切片存储: 文档目录 / 章节表 / 切片表 + 兼容视图 chunks_full_index (见 chunk_store)
+        # 旧库仍是扁平表时不在这里迁移 (由 Day 3 启动时迁移)，写入 SQL 两种结构通用
+        init_chunk_tables(self.cursor)
+        # 标识符索引表: (identifier, chunk_uuid)，供 Day 3 精确编号查询走 B-tree
+        init_identifier_table(self.cursor)
+        # 文档登记表: 内容哈希 -> 版本 / 页数 / 解析参数 / 入库状态
+        init_document_table(self.cursor)
         self.conn.commit()
         # 注意：这里不再执行 DELETE，以免误删 Day 3 已生成的向量数据
         # 如果需要重置，请手动删除 .db 文件或取消下面注释
@@ -77,6 +78,7 @@ class DBManager:
             data['strategy_tag'], 
             datetime.now()
         ))
+        insert_identifiers(self.cursor, data['chunk_uuid'], data.get('identifiers', []))
         
     def commit(self):
         self.conn.commit()
@@ -167,6 +169,9 @@ class SmartChunker:
             
             chunk_uuid = str(uuid.uuid4())
             
+            # 抽取文号 / 标准号 / 工作号 / 条款号等标识符 (只看正文，标题路径不参与)
+            identifiers = extract_identifiers(pure_text)
+            
             # 1. DB 记录格式 (扁平)
             db_record = {
                 "chunk_uuid": chunk_uuid,
@@ -177,7 +182,8 @@ class SmartChunker:
                 "pure_text": pure_text,  # ✨ 保证完整
                 "page_num": page_num,
                 "char_count": len(pure_text),
-                "strategy_tag": item['strategy']
+                "strategy_tag": item['strategy'],
+                "identifiers": identifiers  # [(kind, identifier)]，由 DBManager 写入 chunk_identifiers 表
             }
             
             # 2. JSON 记录格式 (嵌套，适配 BGE + Day 3)
@@ -194,6 +200,7 @@ class SmartChunker:
                     "char_count": len(pure_text),
                     "strategy": item['strategy'],
                     "split_id": item['split_id'],
+                    "identifiers": [identifier for _, identifier in identifiers],
                     "pure_text": pure_text  # ✨ 也在 metadata 中备份
                 },
                 "original_snippet": section_path_str  # ✨ 简化为路径字符串
@@ -203,6 +210,15 @@ class SmartChunker:
             
         return results
 
+def document_settings(use_ocr):
+    """影响切片结果的解析 / 切片参数 (登记到 documents 表，参数变化时同一文件会被重新处理)"""
+    return {
+        "use_ocr": bool(use_ocr),
+        "max_chunk_chars": Day2Config.MAX_CHUNK_CHARS,
+        "split_window_size": Day2Config.SPLIT_WINDOW_SIZE,
+        "split_overlap": Day2Config.SPLIT_OVERLAP,
+    }
+
 # ==========================================
 # 4. ETL 核心流水线 (Worker)
 # ==========================================
@@ -223,10 +239,25 @@ class ETLWorker(threading.Thread):
             self.q.put(("LOG", f"[Day1 Parser] {msg}"))
 
     def run(self):
+        corpus_writer = None
+        db_manager = None
+        content_hash = None
+        settings = document_settings(self.use_ocr)
         try:
-            self.msg_q.put(("LOG", "=== 阶段 1: 启动文档结构解析 (Day 1 Core) ==="))
             doc_title = os.path.basename(self.filepath)
             
+            # 0. 查询文档登记表: 内容与参数均未变化则无需重新解析
+            content_hash = file_sha256(self.filepath)
+            db_manager = DBManager(Day2Config.DB_PATH)
+            existing = find_ingested(db_manager.cursor, content_hash, settings)
+            if existing:
+                db_manager.close()
+                db_manager = None
+                self.msg_q.put(("LOG", f"[Registry] 文件内容未变化，已作为《{existing[0]}》v{existing[1]} 入库，跳过 ETL"))
+                self.callback(True)
+                return
+            
+            self.msg_q.put(("LOG", "=== 阶段 1: 启动文档结构解析 (Day 1 Core) ==="))
             # 1. 调用 Day 1 解析器提取结构化 Lines
             parser = PDFStructureParser(self.filepath, use_ocr=self.use_ocr)
             # 使用适配器将 parser 的 PyQt 信号转为 Queue 消息
@@ -241,8 +272,13 @@ class ETLWorker(threading.Thread):
             # 2. 状态机与组装 (Day 2 Core)
             self.msg_q.put(("LOG", "=== 阶段 2: 上下文锚点融合与切片 ==="))
             
-            db_manager = DBManager(Day2Config.DB_PATH)
-            json_output = []
+            corpus_writer = CorpusWriter(Day2Config.JSON_OUTPUT_PATH)
+            
+            # 同名旧版本的切片在同一事务中删除，提交前旧版本仍完整可查，提交后只剩新版本
+            version = next_version(db_manager.cursor, doc_title)
+            replaced = delete_chunks(db_manager.cursor, document_chunk_ids(db_manager.cursor, doc_title))
+            if replaced:
+                self.msg_q.put(("LOG", f"[Registry] 《{doc_title}》内容已变化，替换旧版本的 {replaced} 个切片 (新版本 v{version})"))
             
             current_h1 = None
             current_h2 = None
@@ -280,7 +316,7 @@ class ETLWorker(threading.Thread):
                     
                     for p in packets:
                         db_manager.insert_chunk(p['db'])
-                        json_output.append(p['json'])
+                        corpus_writer.write(p['json'])
                         total_chunks += 1
                         total_output_chars += len(p['db']['pure_text'])
                         
@@ -288,13 +324,13 @@ class ETLWorker(threading.Thread):
                         if total_chunks <= 5 or total_chunks % 10 == 0:
                             self.msg_q.put(("PREVIEW", p['json']))
 
-            # 3. 收尾
+            # 3. 收尾 (语料在切片过程中已逐条写出，这里只需落盘)
+            register_document(db_manager.cursor, content_hash, doc_title, version, os.path.abspath(self.filepath),
+                              parser.page_count, total_chunks, settings)
             db_manager.commit()
             db_manager.close()
-            
-            # 导出 JSON
-            with open(Day2Config.JSON_OUTPUT_PATH, 'w', encoding='utf-8') as f:
-                json.dump(json_output, f, ensure_ascii=False, indent=2)
+            db_manager = None
+            corpus_writer.close()
                 
             self.msg_q.put(("LOG", "="*50))
             self.msg_q.put(("LOG", f"[SUCCESS] ETL 完成!"))
@@ -304,7 +340,7 @@ class ETLWorker(threading.Thread):
             self.msg_q.put(("LOG", f"输出总字数: {total_output_chars}"))
             self.msg_q.put(("LOG", f"数据完整率: {total_output_chars/max(total_input_chars, 1)*100:.1f}%"))
             self.msg_q.put(("LOG", f"数据库: {Day2Config.DB_PATH}"))
-            self.msg_q.put(("LOG", f"语料JSON: {Day2Config.JSON_OUTPUT_PATH}"))
+            self.msg_q.put(("LOG", f"语料JSONL: {Day2Config.JSON_OUTPUT_PATH} (共 {corpus_writer.count} 条)"))
             self.msg_q.put(("LOG", "="*50))
             
             self.callback(True)
@@ -314,6 +350,16 @@ class ETLWorker(threading.Thread):
             err_msg = traceback.format_exc()
             self.msg_q.put(("LOG", f"[ERROR] {str(e)}"))
             self.msg_q.put(("LOG", err_msg))
+            if corpus_writer is not None:
+                corpus_writer.abort()  # 丢弃写了一半的语料，保留上一次的完整语料
+            if db_manager is not None:
+                # 回滚未提交的切片 (旧版本保持不变)，登记失败原因
+                db_manager.conn.rollback()
+                if content_hash:
+                    mark_failed(db_manager.cursor, content_hash, os.path.basename(self.filepath),
+                                os.path.abspath(self.filepath), settings, e)
+                    db_manager.commit()
+                db_manager.close()
             self.callback(False)
 
 # ==========================================
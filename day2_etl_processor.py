@@ -1,11 +1,15 @@
 import pdfplumber
 import sqlite3
-import json
 import uuid
 import os
 import re
 from datetime import datetime
 from typing import List, Dict, Tuple, Optional
+from corpus_io import CorpusWriter
+from chunk_store import init_chunk_tables
+from identifier_extractor import extract_identifiers, init_identifier_table, insert_identifiers
+from document_registry import (init_document_table, file_sha256, find_ingested, next_version,
+                               document_chunk_ids, delete_chunks, register_document, mark_failed)
 
 # ==========================================
 # 1. 配置区域 (Configuration)
@@ -14,7 +18,7 @@ class RAGConfig:
     # 文件路径配置
     PDF_PATH = "关于修订《中国国际航空股份有限公司ICS订座系统工作号管理与使用规定》的通知.pdf" # 替换为你图中的PDF文件名
     DB_PATH = "rag_production.db"
-    JSON_OUTPUT_PATH = "rag_corpus_for_embedding.json"
+    JSON_OUTPUT_PATH = "rag_corpus_for_embedding.jsonl"
     
     # 解析阈值 (参考 Day 1 UI 调试出的最佳参数)
     # 如果 Day 1 UI 显示正文大概是 10-12px，标题是 14px+，这里设为 2.0 比较安全
@@ -35,30 +39,21 @@ class DBManager:
         self._init_tables()
         
     def _init_tables(self):
-        # 根据你的文档[Source: 3]定义的表结构
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chunks_full_index (
-                chunk_uuid TEXT PRIMARY KEY,
-                doc_title TEXT,
-                chapter_title TEXT,
-                sub_title TEXT,
-                full_context_text TEXT,
-                pure_text TEXT,
-                page_num INTEGER,
-                char_count INTEGER,
-                strategy_tag TEXT,
-                created_at DATETIME
-            )
-        ''')
-        self.conn.commit()
-        # 清空旧数据（开发阶段方便调试，生产环境可去掉）
-        self.cursor.execute('DELETE FROM chunks_full_index')
+        # 规范化切片存储: 文档目录 / 章节表 / 切片表 + 兼容视图 chunks_full_index (见 chunk_store)
+        # 旧库仍是扁平表时不在这里迁移 (由 Day 3 启动时迁移)，写入 SQL 两种结构通用
+        init_chunk_tables(self.cursor)
+        init_identifier_table(self.cursor)
+        init_document_table(self.cursor)
         self.conn.commit()
+        # 不再清空整表：同一文档的旧版本由文档登记表按文档替换，其他文档不受影响
         
     def insert_chunk(self, data: Dict):
+        # 显式指定列名：表可能已被 Day 3 增加 embedding_json 列
         self.cursor.execute('''
-            INSERT INTO chunks_full_index VALUES 
-            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO chunks_full_index 
+            (chunk_uuid, doc_title, chapter_title, sub_title, full_context_text,
+             pure_text, page_num, char_count, strategy_tag, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         ''', (
             data['chunk_uuid'],
             data['doc_title'],
@@ -71,6 +66,7 @@ class DBManager:
             data['strategy_tag'],
             datetime.now()
         ))
+        insert_identifiers(self.cursor, data['chunk_uuid'], data.get('identifiers', []))
         
     def close(self):
         self.conn.commit()
@@ -152,6 +148,9 @@ class SmartChunker:
         # 生成唯一ID
         c_uuid = str(uuid.uuid4())
         
+        # 抽取文号 / 标准号 / 工作号 / 条款号等标识符 (只看正文，标题路径不参与)
+        identifiers = extract_identifiers(chunk_text)
+        
         # 1. 面向 SQLite 的扁平结构
         db_record = {
             "chunk_uuid": c_uuid,
@@ -162,7 +161,8 @@ class SmartChunker:
             "pure_text": chunk_text,
             "page_num": page,
             "char_count": len(chunk_text),
-            "strategy_tag": strategy
+            "strategy_tag": strategy,
+            "identifiers": identifiers  # [(kind, identifier)]，由 DBManager 写入 chunk_identifiers 表
         }
         
         # 2. 面向 BGE 模型的 JSON 结构
@@ -176,7 +176,8 @@ class SmartChunker:
                 "page_num": page,
                 "char_count": len(chunk_text),
                 "strategy": strategy,
-                "split_id": split_id
+                "split_id": split_id,
+                "identifiers": [identifier for _, identifier in identifiers]
             },
             "original_snippet": embedding_text # 用于召回显示
         }
@@ -189,7 +190,8 @@ class SmartChunker:
 class PDFProcessor:
     def __init__(self):
         self.db = DBManager(RAGConfig.DB_PATH)
-        self.json_results = []
+        # JSONL 语料边切片边写出，不在内存中累积
+        self.corpus = CorpusWriter(RAGConfig.JSON_OUTPUT_PATH)
         
         # 状态机变量 (Context State Machine)
         self.current_h1 = None
@@ -202,9 +204,30 @@ class PDFProcessor:
         print(f"[*] 模式: 全量上下文 (Full Context Embedding)")
         
         doc_title = os.path.basename(RAGConfig.PDF_PATH)
+        settings = {
+            "processor": "day2_etl_processor",
+            "font_size_diff_threshold": RAGConfig.FONT_SIZE_DIFF_THRESHOLD,
+            "max_chunk_chars": RAGConfig.MAX_CHUNK_CHARS,
+            "split_window_size": RAGConfig.SPLIT_WINDOW_SIZE,
+            "split_overlap": RAGConfig.SPLIT_OVERLAP,
+        }
+        content_hash = file_sha256(RAGConfig.PDF_PATH)
+        existing = find_ingested(self.db.cursor, content_hash, settings)
+        if existing:
+            print(f"[*] 文件内容未变化，已作为《{existing[0]}》v{existing[1]} 入库，跳过处理")
+            self.corpus.abort()
+            self.db.close()
+            return
         
         try:
+            # 同名旧版本的切片与新切片在同一事务中替换
+            version = next_version(self.db.cursor, doc_title)
+            replaced = delete_chunks(self.db.cursor, document_chunk_ids(self.db.cursor, doc_title))
+            if replaced:
+                print(f"[*] 替换旧版本: 删除 {replaced} 个切片 (新版本 v{version})")
+            
             with pdfplumber.open(RAGConfig.PDF_PATH) as pdf:
+                page_count = len(pdf.pages)
                 # 1. 预扫描计算字体基准 (自动适应不同文档)
                 body_font_size = self._analyze_font_stats(pdf.pages[0])
                 header_threshold = body_font_size + RAGConfig.FONT_SIZE_DIFF_THRESHOLD
@@ -218,13 +241,19 @@ class PDFProcessor:
                 # 3. 处理文档末尾残留的 buffer
                 self._flush_buffer(doc_title, self.last_page_num)
                 
-            # 4. 导出结果
-            self._export_json()
+            # 4. 登记并导出结果
+            register_document(self.db.cursor, content_hash, doc_title, version, os.path.abspath(RAGConfig.PDF_PATH),
+                              page_count, self.corpus.count, settings)
+            self.corpus.close()
             print(f"\n[Success] 处理完成!")
             print(f"   - SQLite: {RAGConfig.DB_PATH} (已写入)")
-            print(f"   - JSON:   {RAGConfig.JSON_OUTPUT_PATH} (共 {len(self.json_results)} 个切片)")
+            print(f"   - JSONL:  {RAGConfig.JSON_OUTPUT_PATH} (共 {self.corpus.count} 个切片)")
             
         except Exception as e:
+            self.corpus.abort()
+            # 回滚本次写入 (旧版本保持不变)，登记失败原因
+            self.db.conn.rollback()
+            mark_failed(self.db.cursor, content_hash, doc_title, os.path.abspath(RAGConfig.PDF_PATH), settings, e)
             print(f"\n[Error] 处理失败: {e}")
         finally:
             self.db.close()
@@ -305,16 +334,12 @@ class PDFProcessor:
         for p in packets:
             # 写入 DB
             self.db.insert_chunk(p['db'])
-            # 存入 JSON List
-            self.json_results.append(p['json'])
+            # 写入 JSONL 语料
+            self.corpus.write(p['json'])
             
         # 清空 Buffer
         self.buffer_text = []
 
-    def _export_json(self):
-        with open(RAGConfig.JSON_OUTPUT_PATH, 'w', encoding='utf-8') as f:
-            json.dump(self.json_results, f, ensure_ascii=False, indent=2)
-
 # ==========================================
 # Main Execution
 # ==========================================
@@ -0,0 +1,974 @@
+# day3_ann_index.py
+"""
+Day 3 近似最近邻 (ANN) 索引
+
+IVF (Inverted File) 索引：
+1. 训练: 对归一化向量做球面 k-means，得到 nlist 个质心
+2. 入库: 每条向量归入最近的质心 (倒排列表)，向量按列表重排后连续存储
+3. 检索: 先找与查询最相近的 nprobe 个质心，只在这些列表内精确打分
+nprobe 越大召回越高、延迟越大；nprobe = nlist 时等价于精确检索
+
+标量量化 (Scalar Quantization) 索引：
+- float16: 每维 2 字节 (相对 float32 压缩 2x，相对仿真器原 float64 压缩 4x)
+- int8 (SQ8): 每维 1 字节，按维度记录 min (offset) 与步长 (scale)，压缩 4x / 8x
+直接在压缩码上打分，可选用 float32 原始向量对 Top 候选做精确重排
+
+乘积量化 (Product Quantization) 索引：
+- 向量切成 m 段子向量，每段用 k-means 训练 256 个码字，每条向量只存 m 个字节
+- 检索用非对称距离 (ADC): 查询保持 float32，先算 (m x 256) 查表，打分 = m 次查表求和
+- IVF-PQ: 倒排列表下存放残差 (x - 质心) 的 PQ 码；内积可分解为 q·c + q·r，
+  查表与列表无关，每条查询只需算一次
+
+二值 (1-bit 符号哈希) 预筛索引：
+- 每维只保留符号位，打包成 uint8 (1024 维 = 128 字节，float32 的 1/32)
+- 第一阶段: XOR + popcount 向量化计算 Hamming 距离，取前几百个候选
+- 第二阶段: 用 float32 原始向量对候选精确重排
+
+检索接口与 VectorSearchEngine 一致: search(q, k) / search_batch(Q, k)，返回 [(row, score), ...]，
+row 为 VectorIndexStore 导出矩阵的行号，仿真器可直接替换使用。
+"""
+import os
+import json
+import time
+import numpy as np
+from datetime import datetime
+from day3_config import Config
+from day3_backend import VectorSearchEngine
+
+# --- 持久化辅助: 先写临时文件再 os.replace，读者不会看到写了一半的文件 ---
+def _save_npy(dir_path, name, arr):
+    tmp_path = os.path.join(dir_path, name + ".tmp")
+    with open(tmp_path, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp_path, os.path.join(dir_path, name))
+
+def _save_json(dir_path, name, obj):
+    tmp_path = os.path.join(dir_path, name + ".tmp")
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(dir_path, name))
+
+def _read_json(dir_path, name):
+    path = os.path.join(dir_path, name)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+def _cluster_sums(data, assign, k):
+    """按簇求和: 先按簇号排序再 np.add.reduceat (比 np.add.at 的逐元素散射快一个数量级)"""
+    counts = np.bincount(assign, minlength=k)
+    sums = np.zeros((k, data.shape[1]), dtype=np.float32)
+    nonempty = counts > 0
+    if nonempty.any():
+        order = np.argsort(assign, kind='stable')
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+        sums[nonempty] = np.add.reduceat(data[order], starts, axis=0)
+    return sums, counts
+
+class IVFIndex:
+    """
+    IVF-Flat 倒排索引 (纯 NumPy 实现)
+    持久化目录 (默认 DB 同级 .index/ivf/):
+    - centroids.npy    : (nlist x dim) float32 质心
+    - list_offsets.npy : (nlist + 1) 每个倒排列表在重排矩阵中的起止位置
+    - row_ids.npy      : 重排后每行对应的原始行号
+    - vectors.f32      : 按倒排列表重排的归一化向量 (内存映射加载)
+    - ivf_manifest.json
+    """
+    CENTROIDS_FILE = "centroids.npy"
+    OFFSETS_FILE = "list_offsets.npy"
+    ROW_IDS_FILE = "row_ids.npy"
+    VECTORS_FILE = "vectors.f32"
+    MANIFEST_FILE = "ivf_manifest.json"
+
+    def __init__(self, centroids, list_offsets, row_ids, vectors, nprobe=None, manifest=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.row_ids = row_ids
+        self.vectors = vectors
+        self.nprobe = nprobe or Config.IVF_DEFAULT_NPROBE
+        self.manifest = manifest or {}
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def default_dir(index_dir):
+        return os.path.join(index_dir, Config.IVF_SUBDIR)
+
+    @staticmethod
+    def suggest_nlist(count):
+        """经验值: nlist ≈ 4 * sqrt(N)，且每个列表平均至少约 39 条训练样本"""
+        if count <= 0:
+            return 1
+        return int(max(1, min(4 * np.sqrt(count), count // 39 or 1)))
+
+    # --- 训练与构建 ---
+    @staticmethod
+    def _assign(matrix, centroids, chunk_size=65536):
+        """分块计算每条向量最近的质心 (内积最大)，避免 N x nlist 打分矩阵撑爆内存"""
+        assign = np.empty(matrix.shape[0], dtype=np.int64)
+        for start in range(0, matrix.shape[0], chunk_size):
+            block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+            assign[start:start + chunk_size] = np.argmax(block @ centroids.T, axis=1)
+        return assign
+
+    @classmethod
+    def train_centroids(cls, matrix, nlist, n_iter=20, max_train_points=None, seed=42, logger=None):
+        """
+        球面 k-means (Lloyd 迭代，质心每轮重新归一化)
+        训练样本最多 max_train_points 条 (默认 nlist * 256)，大库只用抽样训练
+        """
+        rng = np.random.default_rng(seed)
+        count = matrix.shape[0]
+        nlist = max(1, min(nlist, count))
+        max_train_points = max_train_points or nlist * 256
+
+        if count > max_train_points:
+            sample_rows = np.sort(rng.choice(count, max_train_points, replace=False))
+            train = np.asarray(matrix[sample_rows], dtype=np.float32)
+        else:
+            train = np.asarray(matrix, dtype=np.float32)
+
+        centroids = train[rng.choice(train.shape[0], nlist, replace=False)].copy()
+        for it in range(n_iter):
+            assign = cls._assign(train, centroids)
+            sums, counts = _cluster_sums(train, assign, nlist)
+
+            # 空簇: 用随机样本重新初始化
+            empty = np.where(counts == 0)[0]
+            if len(empty) > 0:
+                sums[empty] = train[rng.choice(train.shape[0], len(empty), replace=False)]
+            centroids = VectorSearchEngine.normalize_rows(sums)
+
+            if logger and (it + 1) % 5 == 0:
+                logger(f"[IVF] k-means 迭代 {it + 1}/{n_iter} | 空簇: {len(empty)}")
+        return centroids
+
+    @classmethod
+    def build(cls, matrix, nlist=None, n_iter=20, nprobe=None, seed=42, logger=None):
+        """
+        从归一化矩阵 (VectorIndexStore 导出的 memmap) 训练并构建 IVF 索引
+        """
+        start_time = time.time()
+        count = matrix.shape[0]
+        nlist = nlist or cls.suggest_nlist(count)
+        if logger: logger(f"[IVF] 开始训练: {count} 条向量, nlist={nlist}")
+
+        centroids = cls.train_centroids(matrix, nlist, n_iter=n_iter, seed=seed, logger=logger)
+        assign = cls._assign(matrix, centroids)
+
+        # 按倒排列表重排 (稳定排序，列表内保持原始行序)
+        row_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        counts = np.bincount(assign, minlength=centroids.shape[0])
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        vectors = np.asarray(matrix[row_ids], dtype=np.float32)
+
+        manifest = {
+            "nlist": int(centroids.shape[0]),
+            "count": int(count),
+            "dim": int(matrix.shape[1]) if count else 0,
+            "n_iter": n_iter,
+            "max_list_size": int(counts.max()) if count else 0,
+            "created_at": datetime.now().isoformat()
+        }
+        if logger: logger(f"[IVF] 构建完成 ({time.time() - start_time:.2f}s) | 最大列表: {manifest['max_list_size']} 条")
+        return cls(centroids, list_offsets, row_ids, vectors, nprobe=nprobe, manifest=manifest)
+
+    # --- 持久化 ---
+    def save(self, ivf_dir, source_version=None):
+        """写入临时文件后 os.replace，manifest 最后替换"""
+        os.makedirs(ivf_dir, exist_ok=True)
+        self.manifest["source_version"] = source_version
+
+        _save_npy(ivf_dir, self.CENTROIDS_FILE, self.centroids)
+        _save_npy(ivf_dir, self.OFFSETS_FILE, self.list_offsets)
+        _save_npy(ivf_dir, self.ROW_IDS_FILE, self.row_ids)
+
+        tmp_path = os.path.join(ivf_dir, self.VECTORS_FILE + ".tmp")
+        self.vectors.astype(np.float32).tofile(tmp_path)
+        os.replace(tmp_path, os.path.join(ivf_dir, self.VECTORS_FILE))
+
+        _save_json(ivf_dir, self.MANIFEST_FILE, self.manifest)
+
+    @classmethod
+    def read_manifest(cls, ivf_dir):
+        return _read_json(ivf_dir, cls.MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, ivf_dir, nprobe=None):
+        manifest = cls.read_manifest(ivf_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"IVF manifest 不存在: {ivf_dir}")
+        centroids = np.load(os.path.join(ivf_dir, cls.CENTROIDS_FILE))
+        list_offsets = np.load(os.path.join(ivf_dir, cls.OFFSETS_FILE))
+        row_ids = np.load(os.path.join(ivf_dir, cls.ROW_IDS_FILE), mmap_mode='r')
+        if manifest["count"] == 0:
+            vectors = np.zeros((0, manifest["dim"]), dtype=np.float32)
+        else:
+            vectors = np.memmap(os.path.join(ivf_dir, cls.VECTORS_FILE), dtype=np.float32, mode='r',
+                                shape=(manifest["count"], manifest["dim"]))
+        return cls(centroids, list_offsets, row_ids, vectors, nprobe=nprobe, manifest=manifest)
+
+    # --- 检索 ---
+    def _probe_lists(self, q, nprobe):
+        """返回与查询最相近的 nprobe 个倒排列表编号"""
+        nprobe = max(1, min(nprobe, self.nlist))
+        centroid_scores = self.centroids @ q
+        if nprobe < self.nlist:
+            return np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        return np.arange(self.nlist)
+
+    def search(self, query_vector, k=3, nprobe=None):
+        """
+        单条查询: 只扫描 nprobe 个倒排列表 (列表内向量连续存储，切片即视图)
+        返回: [(row, score), ...]，row 为原始矩阵行号
+        """
+        if len(self) == 0:
+            return []
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+        lists = self._probe_lists(q, nprobe or self.nprobe)
+
+        cand_scores = []
+        cand_rows = []
+        for lst in lists:
+            lo, hi = self.list_offsets[lst], self.list_offsets[lst + 1]
+            if hi > lo:
+                cand_scores.append(self.vectors[lo:hi] @ q)
+                cand_rows.append(self.row_ids[lo:hi])
+        if not cand_scores:
+            return []
+
+        scores = np.concatenate(cand_scores)
+        rows = np.concatenate(cand_rows)
+        top = VectorSearchEngine._top_k_desc(scores, k)
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def search_batch(self, query_vectors, k=3, nprobe=None):
+        queries = VectorSearchEngine.normalize_rows(query_vectors)
+        return [self.search(q, k=k, nprobe=nprobe) for q in queries]
+
+    @property
+    def nbytes(self):
+        return int(self.centroids.nbytes + self.list_offsets.nbytes + self.row_ids.nbytes + self.vectors.nbytes)
+
+class ScalarQuantizedIndex:
+    """
+    标量量化索引 (float16 / int8)
+    
+    int8 编码 (按维度): code = round((x - offset) / scale)，取值 0..255 (uint8 存储)
+    打分直接在码上完成: q · x ≈ q · offset + (q * scale) · code
+    
+    rerank_matrix: 可选的 float32 原始矩阵 (通常是 VectorIndexStore 的 memmap)，
+    开启重排时先在码上取 k * rerank 条候选，再用原始向量精确打分，只会访问候选行对应的页
+    持久化目录: .index/sq8/ 或 .index/fp16/
+    """
+    MODES = ("int8", "float16")
+    CODES_FILE = "codes.npy"
+    SCALE_FILE = "scale.npy"
+    OFFSET_FILE = "offset.npy"
+    MANIFEST_FILE = "sq_manifest.json"
+
+    def __init__(self, codes, mode, scale=None, offset=None, rerank_matrix=None, rerank=0, manifest=None):
+        if mode not in self.MODES:
+            raise ValueError(f"不支持的量化模式: {mode}")
+        self.codes = codes
+        self.mode = mode
+        self.scale = scale
+        self.offset = offset
+        self.rerank_matrix = rerank_matrix
+        self.rerank = rerank
+        self.manifest = manifest or {}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        """量化码 + 码本参数占用的字节数 (不含可选的重排矩阵)"""
+        total = self.codes.nbytes
+        if self.scale is not None:
+            total += self.scale.nbytes + self.offset.nbytes
+        return int(total)
+
+    @classmethod
+    def build(cls, matrix, mode="int8", chunk_size=65536, logger=None):
+        """分块编码，避免一次性生成 N x dim 的中间矩阵"""
+        start_time = time.time()
+        count, dim = matrix.shape
+        scale = offset = None
+
+        if mode == "float16":
+            codes = np.empty((count, dim), dtype=np.float16)
+            for start in range(0, count, chunk_size):
+                codes[start:start + chunk_size] = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+        elif mode == "int8":
+            # 第一遍: 按维度统计 min / max
+            lo = np.full(dim, np.inf, dtype=np.float32)
+            hi = np.full(dim, -np.inf, dtype=np.float32)
+            for start in range(0, count, chunk_size):
+                block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+                lo = np.minimum(lo, block.min(axis=0))
+                hi = np.maximum(hi, block.max(axis=0))
+            offset = lo if count else np.zeros(dim, dtype=np.float32)
+            scale = ((hi - lo) / 255.0) if count else np.ones(dim, dtype=np.float32)
+            scale[scale == 0] = 1.0
+            scale = scale.astype(np.float32)
+
+            # 第二遍: 编码
+            codes = np.empty((count, dim), dtype=np.uint8)
+            for start in range(0, count, chunk_size):
+                block = np.asarray(matrix[start:start + chunk_size], dtype=np.float32)
+                codes[start:start + chunk_size] = np.clip(np.rint((block - offset) / scale), 0, 255)
+        else:
+            raise ValueError(f"不支持的量化模式: {mode}")
+
+        manifest = {
+            "mode": mode,
+            "count": int(count),
+            "dim": int(dim),
+            "code_bytes": int(codes.nbytes),
+            "float32_bytes": int(count * dim * 4),
+            "created_at": datetime.now().isoformat()
+        }
+        if logger:
+            logger(f"[SQ] {mode} 编码完成 ({time.time() - start_time:.2f}s) | "
+                   f"{manifest['code_bytes'] / 1024 / 1024:.1f} MB (float32: {manifest['float32_bytes'] / 1024 / 1024:.1f} MB)")
+        return cls(codes, mode, scale=scale, offset=offset, manifest=manifest)
+
+    def _score_codes(self, q, chunk_size=4096):
+        """在压缩码上为所有行打分 (小块解码为 float32，临时块常驻 CPU 缓存)"""
+        count = len(self)
+        scores = np.empty(count, dtype=np.float32)
+        if self.mode == "int8":
+            q_scaled = q * self.scale
+            base = float(q @ self.offset)
+            for start in range(0, count, chunk_size):
+                scores[start:start + chunk_size] = self.codes[start:start + chunk_size].astype(np.float32) @ q_scaled + base
+        else:
+            for start in range(0, count, chunk_size):
+                scores[start:start + chunk_size] = self.codes[start:start + chunk_size].astype(np.float32) @ q
+        return scores
+
+    def search(self, query_vector, k=3, rerank=None):
+        """
+        rerank: 重排候选倍数 (0 表示不重排，直接返回量化分数)；需要设置 rerank_matrix
+        返回: [(row, score), ...]
+        """
+        if len(self) == 0:
+            return []
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+        scores = self._score_codes(q)
+        rerank = self.rerank if rerank is None else rerank
+
+        if rerank and self.rerank_matrix is not None:
+            candidates = VectorSearchEngine._top_k_desc(scores, k * rerank)
+            # 只读取候选行 (按行号排序，顺序访问 memmap)
+            rows = np.sort(candidates)
+            exact = np.asarray(self.rerank_matrix[rows], dtype=np.float32) @ q
+            top = VectorSearchEngine._top_k_desc(exact, k)
+            return [(int(rows[i]), float(exact[i])) for i in top]
+
+        top = VectorSearchEngine._top_k_desc(scores, k)
+        return [(int(row), float(scores[row])) for row in top]
+
+    def search_batch(self, query_vectors, k=3, rerank=None):
+        queries = VectorSearchEngine.normalize_rows(query_vectors)
+        return [self.search(q, k=k, rerank=rerank) for q in queries]
+
+    # --- 持久化 ---
+    def save(self, sq_dir, source_version=None):
+        os.makedirs(sq_dir, exist_ok=True)
+        self.manifest["source_version"] = source_version
+
+        _save_npy(sq_dir, self.CODES_FILE, self.codes)
+        if self.mode == "int8":
+            _save_npy(sq_dir, self.SCALE_FILE, self.scale)
+            _save_npy(sq_dir, self.OFFSET_FILE, self.offset)
+        _save_json(sq_dir, self.MANIFEST_FILE, self.manifest)
+
+    @classmethod
+    def read_manifest(cls, sq_dir):
+        return _read_json(sq_dir, cls.MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, sq_dir, rerank_matrix=None, rerank=0):
+        manifest = cls.read_manifest(sq_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"SQ manifest 不存在: {sq_dir}")
+        codes = np.load(os.path.join(sq_dir, cls.CODES_FILE), mmap_mode='r')
+        scale = offset = None
+        if manifest["mode"] == "int8":
+            scale = np.load(os.path.join(sq_dir, cls.SCALE_FILE))
+            offset = np.load(os.path.join(sq_dir, cls.OFFSET_FILE))
+        return cls(codes, manifest["mode"], scale=scale, offset=offset,
+                   rerank_matrix=rerank_matrix, rerank=rerank, manifest=manifest)
+
+def _kmeans(data, k, n_iter=15, rng=None):
+    """欧氏 k-means (Lloyd)，PQ 子空间码本训练用；||x - c||^2 = ||x||^2 - 2x·c + ||c||^2"""
+    rng = rng or np.random.default_rng(42)
+    data = np.ascontiguousarray(data, dtype=np.float32)
+    k = min(k, data.shape[0])
+    centroids = data[rng.choice(data.shape[0], k, replace=False)].copy()
+    for _ in range(n_iter):
+        dists = (centroids * centroids).sum(axis=1) - 2 * (data @ centroids.T)
+        assign = np.argmin(dists, axis=1)
+        sums, counts = _cluster_sums(data, assign, k)
+        empty = counts == 0
+        centroids = (sums / np.maximum(counts, 1)[:, None]).astype(np.float32)
+        if empty.any():
+            centroids[empty] = data[rng.choice(data.shape[0], int(empty.sum()), replace=False)]
+    return centroids
+
+class ProductQuantizer:
+    """
+    乘积量化器: m 段子空间，每段 ksub (<= 256) 个码字，码以 uint8 存储
+    codebooks: (m x ksub x dsub) float32
+    """
+    def __init__(self, codebooks):
+        self.codebooks = codebooks
+
+    @property
+    def m(self):
+        return self.codebooks.shape[0]
+
+    @property
+    def ksub(self):
+        return self.codebooks.shape[1]
+
+    @property
+    def dsub(self):
+        return self.codebooks.shape[2]
+
+    @classmethod
+    def train(cls, train, m, ksub=256, n_iter=15, seed=42, logger=None):
+        """train: (n x dim) float32 训练样本；dim 必须能被 m 整除"""
+        dim = train.shape[1]
+        if dim % m != 0:
+            raise ValueError(f"向量维度 {dim} 不能被子空间数 m={m} 整除")
+        if ksub > 256:
+            raise ValueError("ksub 不能超过 256 (码以 uint8 存储)")
+        rng = np.random.default_rng(seed)
+        dsub = dim // m
+        ksub = min(ksub, train.shape[0])
+
+        codebooks = np.empty((m, ksub, dsub), dtype=np.float32)
+        for j in range(m):
+            codebooks[j] = _kmeans(train[:, j * dsub:(j + 1) * dsub], ksub, n_iter=n_iter, rng=rng)
+            if logger and (j + 1) % 16 == 0:
+                logger(f"[PQ] 子空间码本训练 {j + 1}/{m}")
+        return cls(codebooks)
+
+    def encode(self, vectors, chunk_size=16384):
+        """分块编码: 每段子向量取最近码字编号 -> (n x m) uint8"""
+        n = vectors.shape[0]
+        codes = np.empty((n, self.m), dtype=np.uint8)
+        cb_norms = (self.codebooks * self.codebooks).sum(axis=2)  # (m x ksub)
+        for start in range(0, n, chunk_size):
+            block = np.asarray(vectors[start:start + chunk_size], dtype=np.float32)
+            for j in range(self.m):
+                sub = block[:, j * self.dsub:(j + 1) * self.dsub]
+                dists = cb_norms[j] - 2 * (sub @ self.codebooks[j].T)
+                codes[start:start + chunk_size, j] = np.argmin(dists, axis=1)
+        return codes
+
+    def decode(self, codes):
+        """码 -> 近似向量 (n x dim)"""
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.m)], axis=1)
+
+    def lookup_table(self, q):
+        """ADC 查表: table[j, c] = q 第 j 段 · 第 j 段第 c 个码字 -> (m x ksub)"""
+        q_sub = q.reshape(self.m, self.dsub)
+        return np.einsum('jkd,jd->jk', self.codebooks, q_sub)
+
+    def adc_scores(self, codes, table, chunk_size=16384):
+        """非对称内积打分: 每行 m 次查表求和 (逐子空间 gather 累加，不生成 n x m 临时矩阵)"""
+        n = codes.shape[0]
+        scores = np.zeros(n, dtype=np.float32)
+        table = table.astype(np.float32)
+        for start in range(0, n, chunk_size):
+            block = np.asarray(codes[start:start + chunk_size])
+            acc = scores[start:start + chunk_size]
+            for j in range(self.m):
+                acc += table[j][block[:, j]]
+        return scores
+
+    @property
+    def nbytes(self):
+        return int(self.codebooks.nbytes)
+
+    @staticmethod
+    def fit_m(dim, m):
+        """取不超过 m 且能整除 dim 的最大子空间数"""
+        m = max(1, min(m, dim))
+        while dim % m != 0:
+            m -= 1
+        return m
+
+    @staticmethod
+    def sample_train(matrix, max_train_points, rng):
+        count = matrix.shape[0]
+        if count > max_train_points:
+            rows = np.sort(rng.choice(count, max_train_points, replace=False))
+            return np.asarray(matrix[rows], dtype=np.float32)
+        return np.asarray(matrix, dtype=np.float32)
+
+def _rerank_exact(rerank_matrix, candidates, q, k):
+    """用 float32 原始向量对候选行精确重排 (按行号排序后读取，顺序访问 memmap)"""
+    rows = np.sort(np.asarray(candidates, dtype=np.int64))
+    exact = np.asarray(rerank_matrix[rows], dtype=np.float32) @ q
+    top = VectorSearchEngine._top_k_desc(exact, k)
+    return [(int(rows[i]), float(exact[i])) for i in top]
+
+class PQIndex:
+    """
+    Flat PQ 索引: 全量 ADC 扫描 (每条向量 m 字节)
+    持久化目录: .index/pq/ (codebooks.npy + codes.npy + pq_manifest.json)
+    """
+    CODEBOOKS_FILE = "codebooks.npy"
+    CODES_FILE = "codes.npy"
+    MANIFEST_FILE = "pq_manifest.json"
+
+    def __init__(self, pq, codes, rerank_matrix=None, rerank=0, manifest=None):
+        self.pq = pq
+        self.codes = codes
+        self.rerank_matrix = rerank_matrix
+        self.rerank = rerank
+        self.manifest = manifest or {}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        return int(self.codes.nbytes + self.pq.nbytes)
+
+    @classmethod
+    def build(cls, matrix, m=None, n_iter=15, max_train_points=None, seed=42, logger=None, pq=None):
+        """训练码本 (或复用传入的 pq) 并编码全量向量"""
+        start_time = time.time()
+        if pq is None:
+            m = ProductQuantizer.fit_m(matrix.shape[1], m or Config.PQ_DEFAULT_M)
+            max_train_points = max_train_points or Config.PQ_TRAIN_POINTS
+            train = ProductQuantizer.sample_train(matrix, max_train_points, np.random.default_rng(seed))
+            if logger: logger(f"[PQ] 训练码本: m={m}, 样本 {train.shape[0]} 条")
+            pq = ProductQuantizer.train(train, m, n_iter=n_iter, seed=seed, logger=logger)
+        codes = pq.encode(matrix)
+        manifest = {
+            "m": pq.m, "ksub": pq.ksub, "dim": int(matrix.shape[1]), "count": int(matrix.shape[0]),
+            "code_bytes": int(codes.nbytes), "float32_bytes": int(matrix.shape[0] * matrix.shape[1] * 4),
+            "created_at": datetime.now().isoformat()
+        }
+        if logger:
+            logger(f"[PQ] 编码完成 ({time.time() - start_time:.2f}s) | 码 {codes.nbytes / 1024 / 1024:.1f} MB "
+                   f"(float32: {manifest['float32_bytes'] / 1024 / 1024:.1f} MB)")
+        return cls(pq, codes, manifest=manifest)
+
+    def search(self, query_vector, k=3, rerank=None):
+        if len(self) == 0:
+            return []
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+        scores = self.pq.adc_scores(self.codes, self.pq.lookup_table(q))
+        rerank = self.rerank if rerank is None else rerank
+        if rerank and self.rerank_matrix is not None:
+            return _rerank_exact(self.rerank_matrix, VectorSearchEngine._top_k_desc(scores, k * rerank), q, k)
+        top = VectorSearchEngine._top_k_desc(scores, k)
+        return [(int(row), float(scores[row])) for row in top]
+
+    def search_batch(self, query_vectors, k=3, rerank=None):
+        queries = VectorSearchEngine.normalize_rows(query_vectors)
+        return [self.search(q, k=k, rerank=rerank) for q in queries]
+
+    def save(self, pq_dir, source_version=None):
+        os.makedirs(pq_dir, exist_ok=True)
+        self.manifest["source_version"] = source_version
+        _save_npy(pq_dir, self.CODEBOOKS_FILE, self.pq.codebooks)
+        _save_npy(pq_dir, self.CODES_FILE, self.codes)
+        _save_json(pq_dir, self.MANIFEST_FILE, self.manifest)
+
+    @classmethod
+    def read_manifest(cls, pq_dir):
+        return _read_json(pq_dir, cls.MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, pq_dir, rerank_matrix=None, rerank=0):
+        manifest = cls.read_manifest(pq_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"PQ manifest 不存在: {pq_dir}")
+        pq = ProductQuantizer(np.load(os.path.join(pq_dir, cls.CODEBOOKS_FILE)))
+        codes = np.load(os.path.join(pq_dir, cls.CODES_FILE), mmap_mode='r')
+        return cls(pq, codes, rerank_matrix=rerank_matrix, rerank=rerank, manifest=manifest)
+
+class IVFPQIndex:
+    """
+    IVF-PQ 索引: IVF 粗筛 + 残差 PQ 码 (千万级语料常驻内存的主力方案)
+    打分: q·x ≈ q·c_list + ADC(q, code(x - c_list))
+    持久化目录: .index/ivfpq/
+    """
+    CENTROIDS_FILE = "centroids.npy"
+    OFFSETS_FILE = "list_offsets.npy"
+    ROW_IDS_FILE = "row_ids.npy"
+    CODEBOOKS_FILE = "codebooks.npy"
+    CODES_FILE = "codes.npy"
+    MANIFEST_FILE = "ivfpq_manifest.json"
+
+    def __init__(self, centroids, list_offsets, row_ids, pq, codes, nprobe=None,
+                 rerank_matrix=None, rerank=0, manifest=None):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.row_ids = row_ids
+        self.pq = pq
+        self.codes = codes
+        self.nprobe = nprobe or Config.IVF_DEFAULT_NPROBE
+        self.rerank_matrix = rerank_matrix
+        self.rerank = rerank
+        self.manifest = manifest or {}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    @property
+    def nbytes(self):
+        return int(self.centroids.nbytes + self.list_offsets.nbytes + self.row_ids.nbytes
+                   + self.codes.nbytes + self.pq.nbytes)
+
+    @classmethod
+    def build(cls, matrix, nlist=None, m=None, n_iter=15, max_train_points=None, seed=42, logger=None,
+              centroids=None, pq=None):
+        """
+        训练 IVF 质心与残差码本 (也可传入已训练好的 centroids / pq，只做编码)
+        """
+        start_time = time.time()
+        count = matrix.shape[0]
+        rng = np.random.default_rng(seed)
+        max_train_points = max_train_points or Config.PQ_TRAIN_POINTS
+
+        if centroids is None:
+            nlist = nlist or IVFIndex.suggest_nlist(count)
+            if logger: logger(f"[IVF-PQ] 训练粗量化质心: nlist={nlist}")
+            centroids = IVFIndex.train_centroids(matrix, nlist, n_iter=n_iter, seed=seed, logger=logger)
+        if pq is None:
+            m = ProductQuantizer.fit_m(matrix.shape[1], m or Config.PQ_DEFAULT_M)
+            train = ProductQuantizer.sample_train(matrix, max_train_points, rng)
+            residuals = train - centroids[IVFIndex._assign(train, centroids)]
+            if logger: logger(f"[IVF-PQ] 训练残差码本: m={m}, 样本 {train.shape[0]} 条")
+            pq = ProductQuantizer.train(residuals, m, n_iter=n_iter, seed=seed, logger=logger)
+
+        assign = IVFIndex._assign(matrix, centroids)
+        row_ids = np.argsort(assign, kind='stable').astype(np.int64)
+        counts = np.bincount(assign, minlength=centroids.shape[0])
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        # 按列表重排后分块编码残差
+        codes = np.empty((count, pq.m), dtype=np.uint8)
+        chunk_size = 16384
+        for start in range(0, count, chunk_size):
+            rows = row_ids[start:start + chunk_size]
+            # 按行号升序读取 memmap (顺序 IO)，再还原成列表顺序
+            order = np.argsort(rows)
+            block = np.empty((len(rows), matrix.shape[1]), dtype=np.float32)
+            block[order] = matrix[rows[order]]
+            codes[start:start + chunk_size] = pq.encode(block - centroids[assign[rows]])
+
+        manifest = {
+            "nlist": int(centroids.shape[0]), "m": pq.m, "ksub": pq.ksub,
+            "dim": int(matrix.shape[1]), "count": int(count),
+            "code_bytes": int(codes.nbytes), "float32_bytes": int(count * matrix.shape[1] * 4),
+            "created_at": datetime.now().isoformat()
+        }
+        if logger:
+            logger(f"[IVF-PQ] 构建完成 ({time.time() - start_time:.2f}s) | 码 {codes.nbytes / 1024 / 1024:.1f} MB "
+                   f"(float32: {manifest['float32_bytes'] / 1024 / 1024:.1f} MB)")
+        return cls(centroids, list_offsets, row_ids, pq, codes, manifest=manifest)
+
+    def search(self, query_vector, k=3, nprobe=None, rerank=None):
+        if len(self) == 0:
+            return []
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+        nprobe = max(1, min(nprobe or self.nprobe, self.nlist))
+        centroid_scores = self.centroids @ q
+        if nprobe < self.nlist:
+            lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        else:
+            lists = np.arange(self.nlist)
+
+        # 先拼接所有候选列表的码，再做一次 ADC (查表与列表无关，只算一次)
+        cand_codes, cand_rows, cand_bias = [], [], []
+        for lst in lists:
+            lo, hi = self.list_offsets[lst], self.list_offsets[lst + 1]
+            if hi > lo:
+                cand_codes.append(self.codes[lo:hi])
+                cand_rows.append(self.row_ids[lo:hi])
+                cand_bias.append(np.full(hi - lo, centroid_scores[lst], dtype=np.float32))
+        if not cand_codes:
+            return []
+        rows = np.concatenate(cand_rows)
+        scores = self.pq.adc_scores(np.concatenate(cand_codes), self.pq.lookup_table(q)) + np.concatenate(cand_bias)
+
+        rerank = self.rerank if rerank is None else rerank
+        if rerank and self.rerank_matrix is not None:
+            return _rerank_exact(self.rerank_matrix, rows[VectorSearchEngine._top_k_desc(scores, k * rerank)], q, k)
+        top = VectorSearchEngine._top_k_desc(scores, k)
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def search_batch(self, query_vectors, k=3, nprobe=None, rerank=None):
+        queries = VectorSearchEngine.normalize_rows(query_vectors)
+        return [self.search(q, k=k, nprobe=nprobe, rerank=rerank) for q in queries]
+
+    def save(self, ivfpq_dir, source_version=None):
+        os.makedirs(ivfpq_dir, exist_ok=True)
+        self.manifest["source_version"] = source_version
+        _save_npy(ivfpq_dir, self.CENTROIDS_FILE, self.centroids)
+        _save_npy(ivfpq_dir, self.OFFSETS_FILE, self.list_offsets)
+        _save_npy(ivfpq_dir, self.ROW_IDS_FILE, self.row_ids)
+        _save_npy(ivfpq_dir, self.CODEBOOKS_FILE, self.pq.codebooks)
+        _save_npy(ivfpq_dir, self.CODES_FILE, self.codes)
+        _save_json(ivfpq_dir, self.MANIFEST_FILE, self.manifest)
+
+    @classmethod
+    def read_manifest(cls, ivfpq_dir):
+        return _read_json(ivfpq_dir, cls.MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, ivfpq_dir, nprobe=None, rerank_matrix=None, rerank=0):
+        manifest = cls.read_manifest(ivfpq_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"IVF-PQ manifest 不存在: {ivfpq_dir}")
+        return cls(
+            np.load(os.path.join(ivfpq_dir, cls.CENTROIDS_FILE)),
+            np.load(os.path.join(ivfpq_dir, cls.OFFSETS_FILE)),
+            np.load(os.path.join(ivfpq_dir, cls.ROW_IDS_FILE), mmap_mode='r'),
+            ProductQuantizer(np.load(os.path.join(ivfpq_dir, cls.CODEBOOKS_FILE))),
+            np.load(os.path.join(ivfpq_dir, cls.CODES_FILE), mmap_mode='r'),
+            nprobe=nprobe, rerank_matrix=rerank_matrix, rerank=rerank, manifest=manifest
+        )
+
+# popcount: NumPy >= 2.0 提供 np.bitwise_count，旧版本用 256 项查表
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(arr):
+        return _POPCOUNT_TABLE[arr.view(np.uint8)]
+
+class BinaryIndex:
+    """
+    1-bit 符号哈希索引 + 精确重排
+    codes: (count x ceil(dim/8)) uint8，np.packbits(x > 0)
+    码长是 8 字节的倍数时以 uint64 视图做 XOR / popcount，每条向量只需 dim/64 次运算
+    持久化目录: .index/binary/
+    """
+    CODES_FILE = "codes.npy"
+    MANIFEST_FILE = "binary_manifest.json"
+
+    def __init__(self, codes, dim, rerank_matrix=None, candidates=None, manifest=None):
+        self.codes = codes
+        self.dim = dim
+        self.rerank_matrix = rerank_matrix
+        self.candidates = candidates or Config.BINARY_CANDIDATES
+        self.manifest = manifest or {}
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    @property
+    def nbytes(self):
+        return int(self.codes.nbytes)
+
+    @classmethod
+    def build(cls, matrix, chunk_size=65536, logger=None):
+        start_time = time.time()
+        count, dim = matrix.shape
+        codes = np.empty((count, (dim + 7) // 8), dtype=np.uint8)
+        for start in range(0, count, chunk_size):
+            codes[start:start + chunk_size] = np.packbits(np.asarray(matrix[start:start + chunk_size]) > 0, axis=1)
+        manifest = {
+            "dim": int(dim), "count": int(count), "code_bytes": int(codes.nbytes),
+            "float32_bytes": int(count * dim * 4), "created_at": datetime.now().isoformat()
+        }
+        if logger:
+            logger(f"[Binary] 编码完成 ({time.time() - start_time:.2f}s) | {codes.nbytes / 1024 / 1024:.2f} MB "
+                   f"(float32: {manifest['float32_bytes'] / 1024 / 1024:.1f} MB)")
+        return cls(codes, dim, manifest=manifest)
+
+    @staticmethod
+    def _words(codes):
+        """码长是 8 字节的倍数时转 uint64 视图，减少 XOR / popcount 次数"""
+        codes = np.ascontiguousarray(codes)
+        if codes.shape[-1] % 8 == 0:
+            return codes.view(np.uint64)
+        return codes
+
+    def hamming(self, query_vector, chunk_size=65536):
+        """查询与全部向量的 Hamming 距离 -> (count,) int32"""
+        q_code = self._words(np.packbits(np.asarray(query_vector).reshape(1, -1) > 0, axis=1))[0]
+        count = len(self)
+        dists = np.empty(count, dtype=np.int32)
+        for start in range(0, count, chunk_size):
+            block = self._words(self.codes[start:start + chunk_size])
+            dists[start:start + chunk_size] = _popcount(block ^ q_code).sum(axis=1, dtype=np.int32)
+        return dists
+
+    def search(self, query_vector, k=3, candidates=None):
+        """
+        candidates: Hamming 预筛候选数 (至少 k)，候选用 float32 原始向量精确重排；
+        未设置 rerank_matrix 时按 1 - 2 * hamming / dim 近似打分
+        """
+        if len(self) == 0:
+            return []
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+        dists = self.hamming(q)
+        n_cand = min(max(candidates or self.candidates, k), len(self))
+        if n_cand < len(self):
+            cand = np.argpartition(dists, n_cand - 1)[:n_cand]
+        else:
+            cand = np.arange(len(self))
+
+        if self.rerank_matrix is not None:
+            return _rerank_exact(self.rerank_matrix, cand, q, k)
+        approx = 1.0 - 2.0 * dists[cand].astype(np.float32) / self.dim
+        top = VectorSearchEngine._top_k_desc(approx, k)
+        return [(int(cand[i]), float(approx[i])) for i in top]
+
+    def search_batch(self, query_vectors, k=3, candidates=None):
+        queries = VectorSearchEngine.normalize_rows(query_vectors)
+        return [self.search(q, k=k, candidates=candidates) for q in queries]
+
+    def save(self, binary_dir, source_version=None):
+        os.makedirs(binary_dir, exist_ok=True)
+        self.manifest["source_version"] = source_version
+        _save_npy(binary_dir, self.CODES_FILE, self.codes)
+        _save_json(binary_dir, self.MANIFEST_FILE, self.manifest)
+
+    @classmethod
+    def read_manifest(cls, binary_dir):
+        return _read_json(binary_dir, cls.MANIFEST_FILE)
+
+    @classmethod
+    def load(cls, binary_dir, rerank_matrix=None, candidates=None):
+        manifest = cls.read_manifest(binary_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"Binary manifest 不存在: {binary_dir}")
+        codes = np.load(os.path.join(binary_dir, cls.CODES_FILE), mmap_mode='r')
+        return cls(codes, manifest["dim"], rerank_matrix=rerank_matrix, candidates=candidates, manifest=manifest)
+
+# --- 索引类型注册表 (仿真器 / CLI 统一按名字加载) ---
+# name -> (子目录, 读 manifest, 加载, 构建)
+ANN_INDEX_TYPES = {
+    "ivf": (
+        Config.IVF_SUBDIR,
+        IVFIndex.read_manifest,
+        lambda d, matrix: IVFIndex.load(d),
+        lambda matrix, logger: IVFIndex.build(matrix, logger=logger),
+    ),
+    "sq8": (
+        "sq8",
+        ScalarQuantizedIndex.read_manifest,
+        lambda d, matrix: ScalarQuantizedIndex.load(d, rerank_matrix=matrix, rerank=Config.SQ_DEFAULT_RERANK),
+        lambda matrix, logger: ScalarQuantizedIndex.build(matrix, mode="int8", logger=logger),
+    ),
+    "fp16": (
+        "fp16",
+        ScalarQuantizedIndex.read_manifest,
+        lambda d, matrix: ScalarQuantizedIndex.load(d, rerank_matrix=matrix, rerank=Config.SQ_DEFAULT_RERANK),
+        lambda matrix, logger: ScalarQuantizedIndex.build(matrix, mode="float16", logger=logger),
+    ),
+    "pq": (
+        "pq",
+        PQIndex.read_manifest,
+        lambda d, matrix: PQIndex.load(d, rerank_matrix=matrix, rerank=Config.SQ_DEFAULT_RERANK),
+        lambda matrix, logger: PQIndex.build(matrix, logger=logger),
+    ),
+    "ivfpq": (
+        "ivfpq",
+        IVFPQIndex.read_manifest,
+        lambda d, matrix: IVFPQIndex.load(d, rerank_matrix=matrix, rerank=Config.SQ_DEFAULT_RERANK),
+        lambda matrix, logger: IVFPQIndex.build(matrix, logger=logger),
+    ),
+    "binary": (
+        "binary",
+        BinaryIndex.read_manifest,
+        lambda d, matrix: BinaryIndex.load(d, rerank_matrix=matrix),
+        lambda matrix, logger: BinaryIndex.build(matrix, logger=logger),
+    ),
+}
+
+def load_or_build_ann(kind, index_dir, matrix, manifest, logger=None, rebuild=False):
+    """
+    按类型加载 ANN / 量化索引；子目录不存在或与当前向量索引版本不一致时重新构建并保存
+    index_dir: 向量索引快照目录 (manifest['snapshot_dir'])，ANN 索引随快照一起发布与清理
+    matrix / manifest: VectorIndexStore.load 的返回值 (构建的数据源 & 重排矩阵)
+    """
+    if kind not in ANN_INDEX_TYPES:
+        raise ValueError(f"未知的索引类型: {kind}")
+    subdir, read_manifest, load, build = ANN_INDEX_TYPES[kind]
+    ann_dir = os.path.join(index_dir, subdir)
+
+    ann_manifest = read_manifest(ann_dir)
+    if not rebuild and ann_manifest and ann_manifest.get('source_version') == manifest['version']:
+        index = load(ann_dir, matrix)
+        if logger: logger(f"[ANN] 已加载 {kind} 索引 -> {ann_dir}")
+        return index
+
+    if logger: logger(f"[ANN] {kind} 索引不存在或已过期，正在构建...")
+    build(matrix, logger).save(ann_dir, source_version=manifest['version'])
+    return load(ann_dir, matrix)
+
+def benchmark_recall(exact_engine, ann_index, queries, k=10, search_kwargs=None, logger=None):
+    """
+    以精确检索为基准，测量 ANN 索引的 recall@k 与延迟
+    queries: (nq x dim) 查询向量
+    返回: {'recall', 'exact_ms', 'ann_ms', 'ann_p95_ms', 'qps', 'index_mb'}
+    """
+    search_kwargs = search_kwargs or {}
+    queries = VectorSearchEngine.normalize_rows(queries)
+
+    exact_times, ann_times, recalls = [], [], []
+    for q in queries:
+        t0 = time.perf_counter()
+        truth = {row for row, _ in exact_engine.search(q, k=k)}
+        t1 = time.perf_counter()
+        approx = {row for row, _ in ann_index.search(q, k=k, **search_kwargs)}
+        t2 = time.perf_counter()
+
+        exact_times.append(t1 - t0)
+        ann_times.append(t2 - t1)
+        if truth:
+            recalls.append(len(truth & approx) / len(truth))
+
+    ann_ms = np.array(ann_times) * 1000
+    report = {
+        "recall": float(np.mean(recalls)) if recalls else 0.0,
+        "exact_ms": float(np.mean(exact_times) * 1000),
+        "ann_ms": float(ann_ms.mean()),
+        "ann_p95_ms": float(np.percentile(ann_ms, 95)),
+        "qps": float(len(queries) / max(sum(ann_times), 1e-9)),
+        "index_mb": getattr(ann_index, "nbytes", 0) / 1024 / 1024
+    }
+    if logger:
+        logger(f"[Bench] {search_kwargs} | recall@{k}: {report['recall']:.4f} | 索引 {report['index_mb']:.1f} MB | "
+               f"ANN {report['ann_ms']:.2f}ms (p95 {report['ann_p95_ms']:.2f}ms, {report['qps']:.0f} QPS) | "
+               f"Exact {report['exact_ms']:.2f}ms")
+    return report
+
+def sample_benchmark_queries(matrix, n_queries=200, noise=0.3, seed=7):
+    """
+    没有标注查询集时，从库内抽样向量并加高斯扰动作为查询 (模拟"相近但不相同"的问题)
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(matrix.shape[0], min(n_queries, matrix.shape[0]), replace=False)
+    base = np.asarray(matrix[np.sort(rows)], dtype=np.float32)
+    return base + rng.standard_normal(base.shape).astype(np.float32) * noise / np.sqrt(base.shape[1])
@@ -1,23 +1,303 @@
 # day3_backend.py
 import sqlite3
 import json
+import os
+import shutil
 import requests
 import urllib3
 import time
+import threading
+import concurrent.futures
+from collections import deque, OrderedDict
 import numpy as np
 from datetime import datetime
 from day3_config import Config
+from identifier_extractor import (extract_identifiers, query_identifier_variants, init_identifier_table, insert_identifiers,
+                                  UNIQUE_IDENTIFIER_KINDS)
+from chunk_store import init_chunk_tables, set_duplicate
+from document_registry import (init_document_table, document_chunk_ids, delete_chunks, next_version,
+                               register_document, mark_deleted)
 
 # 禁用 HTTPS 警告
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+class QueryEmbeddingCache:
+    """
+    查询向量缓存 (LRU + TTL + single-flight)
+
+    - 键: (接口地址, 模型名, 归一化后的问题)，不同模型 / 接口的向量互不混用
+    - LRU 容量 Config.QUERY_CACHE_SIZE，条目超过 Config.QUERY_CACHE_TTL_SECONDS 视为过期
+    - single-flight: 同一个键已有请求在途时，后来的线程等待它的结果，不再重复调用 API；
+      在途请求失败时等待者收到同一个异常，失败结果不缓存
+    缓存的向量是只读 float32 数组，调用方不能原地修改
+    """
+    def __init__(self, max_size=None, ttl=None):
+        self.max_size = Config.QUERY_CACHE_SIZE if max_size is None else max_size
+        self.ttl = Config.QUERY_CACHE_TTL_SECONDS if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (过期时间, 向量)
+        self._inflight = {}             # key -> concurrent.futures.Future
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def normalize(text):
+        """去首尾空白、连续空白合并为一个空格 (只影响缓存命中，不改变语义)"""
+        return " ".join(text.split())
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, vector, now):
+        self._entries[key] = (now + self.ttl, vector)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys, compute):
+        """
+        keys: 缓存键列表；compute(missing_keys) -> 与 missing_keys 对齐的向量列表 (一次 API 调用)
+        返回: 与 keys 对齐的向量列表
+        """
+        now = time.monotonic()
+        results = [None] * len(keys)
+        waiting = {}   # 下标 -> 其他线程的在途 Future
+        owned = {}     # key -> 本线程负责的 Future
+        with self._lock:
+            for i, key in enumerate(keys):
+                vector = self._get(key, now)
+                if vector is not None:
+                    self.hits += 1
+                    results[i] = vector
+                elif key in owned:
+                    waiting[i] = owned[key]
+                elif key in self._inflight:
+                    self.coalesced += 1
+                    waiting[i] = self._inflight[key]
+                else:
+                    self.misses += 1
+                    owned[key] = self._inflight[key] = concurrent.futures.Future()
+                    waiting[i] = owned[key]
+
+        if owned:
+            missing = list(owned)
+            try:
+                vectors = compute(missing)
+                if len(vectors) != len(missing):
+                    raise ValueError(f"向量数 {len(vectors)} 与请求数 {len(missing)} 不一致")
+                vectors = [np.asarray(v, dtype=np.float32) for v in vectors]
+                for v in vectors:
+                    v.setflags(write=False)
+            except BaseException as e:
+                with self._lock:
+                    for key in missing:
+                        self._inflight.pop(key, None)
+                for future in owned.values():
+                    future.set_exception(e)
+                raise
+            with self._lock:
+                now = time.monotonic()
+                for key, vector in zip(missing, vectors):
+                    self._put(key, vector, now)
+                    self._inflight.pop(key, None)
+            for key, vector in zip(missing, vectors):
+                owned[key].set_result(vector)
+
+        for i, future in waiting.items():
+            results[i] = future.result()
+        return results
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+class EmbeddingMicroBatcher:
+    """
+    查询向量化微批: 把几毫秒内先后到达的问题合并成一次 API 请求，充分利用 BGE-M3 的批处理能力
+
+    - 调用线程 submit(texts) 后阻塞等待；收集线程在某个队列凑满 max_batch 条，
+      或该队列最早的请求已等待 max_wait_ms 时发出一批
+    - 只有同一接口 / 模型 (url, model) 的请求才会合批；一个请求的多条问题不会被拆到两批
+    - 发送在线程池 (Config.MICROBATCH_CONCURRENCY) 中进行，API 往返期间继续收集下一批
+    - 一批的结果按顺序拆回各调用方；请求失败时这一批的所有调用方收到同一个异常
+    - stats(): 批次数、条目数、平均批大小、填充率 (每批按 min(条数, max_batch) 计，不超过 1)、
+      满批数与超大批数 (单个请求超过 max_batch 条时不拆分，单独成批)、平均 / 最大排队等待
+    """
+    def __init__(self, embed_fn, max_batch=None, max_wait_ms=None, concurrency=None):
+        """embed_fn(texts, provider_config) -> 向量列表 (通常是 EmbeddingAdapter.get_embeddings)"""
+        self.embed_fn = embed_fn
+        self.max_batch = max_batch or Config.MICROBATCH_MAX_SIZE
+        self.max_wait = (Config.MICROBATCH_MAX_WAIT_MS if max_wait_ms is None else max_wait_ms) / 1000.0
+        self._cond = threading.Condition()
+        self._pending = []   # [(scope, texts, provider_config, future, 入队时间)]
+        self._closed = False
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency or Config.MICROBATCH_CONCURRENCY)
+        self._stats_lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.requests = 0
+        self.full_batches = 0
+        self.oversize_batches = 0
+        self.filled_items = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._collector = threading.Thread(target=self._collect, daemon=True)
+        self._collector.start()
+
+    def submit(self, texts, provider_config=None):
+        """提交一组问题并等待其向量 (与 texts 对齐)"""
+        texts = list(texts)
+        if not texts:
+            return []
+        config = provider_config or {}
+        future = concurrent.futures.Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("微批已关闭")
+            self._pending.append(((config.get("url"), config.get("model")), texts, provider_config,
+                                  future, time.perf_counter()))
+            self._cond.notify()
+        return future.result()
+
+    def _collect(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # 以最早到达的请求所在队列为准，等到凑满或超时
+                scope, deadline = self._pending[0][0], self._pending[0][4] + self.max_wait
+                while not self._closed:
+                    size = sum(len(r[1]) for r in self._pending if r[0] == scope)
+                    remaining = deadline - time.perf_counter()
+                    if size >= self.max_batch or remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, rest, size = [], [], 0
+                for r in self._pending:
+                    if r[0] == scope and (not batch or size + len(r[1]) <= self.max_batch):
+                        batch.append(r)
+                        size += len(r[1])
+                    else:
+                        rest.append(r)
+                self._pending = rest
+            self._executor.submit(self._send, batch, size)
+
+    def _send(self, batch, size):
+        start_time = time.perf_counter()
+        waits = [start_time - r[4] for r in batch]
+        with self._stats_lock:
+            self.batches += 1
+            self.items += size
+            self.requests += len(batch)
+            self.full_batches += size >= self.max_batch
+            self.oversize_batches += size > self.max_batch
+            self.filled_items += min(size, self.max_batch)
+            self.wait_total += sum(waits)
+            self.wait_max = max(self.wait_max, max(waits))
+        try:
+            vectors = self.embed_fn([t for r in batch for t in r[1]], batch[0][2])
+            if len(vectors) != size:
+                raise ValueError(f"向量数 {len(vectors)} 与请求数 {size} 不一致")
+        except BaseException as e:
+            for r in batch:
+                r[3].set_exception(e)
+            return
+        offset = 0
+        for r in batch:
+            r[3].set_result(vectors[offset:offset + len(r[1])])
+            offset += len(r[1])
+
+    def stats(self):
+        with self._stats_lock:
+            batches = self.batches or 1
+            return {
+                'batches': self.batches, 'items': self.items, 'requests': self.requests,
+                'avg_batch_size': self.items / batches,
+                'fill_rate': self.filled_items / (batches * self.max_batch),
+                'full_batches': self.full_batches, 'oversize_batches': self.oversize_batches,
+                'avg_wait_ms': self.wait_total / max(self.requests, 1) * 1000,
+                'max_wait_ms': self.wait_max * 1000,
+                'max_batch': self.max_batch, 'max_wait_ms_cap': self.max_wait * 1000,
+            }
+
+    def close(self):
+        """停止收集；已排队的请求仍会发出 (等收集线程交出最后几批后再关闭发送线程池，不等待 API 往返)"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._collector.join()
+        self._executor.shutdown(wait=False)
+
 class EmbeddingAdapter:
     """
     向量化适配器
     支持多后端切换: Intranet BGE-M3 / SiliconFlow BGE-M3 / Mock
+    查询侧 (embed_query / embed_queries) 经过 QueryEmbeddingCache；入库的批量向量化 (get_embeddings) 不缓存
+    enable_micro_batching() 后，缓存未命中的问题经 EmbeddingMicroBatcher 与其他线程的问题合批发送
     """
-    def __init__(self, use_mock=False):
+    def __init__(self, use_mock=False, query_cache=None):
         self.use_mock = use_mock
+        if query_cache is None and Config.QUERY_CACHE_SIZE > 0:
+            query_cache = QueryEmbeddingCache()
+        self.query_cache = query_cache
+        self.micro_batcher = None
+
+    def enable_micro_batching(self, max_batch=None, max_wait_ms=None, concurrency=None):
+        """多线程服务使用；单用户的仿真器不开启 (没有可合并的并发问题，只会多等 max_wait_ms)"""
+        if self.micro_batcher is None:
+            self.micro_batcher = EmbeddingMicroBatcher(
+                lambda texts, provider_config: self.get_embeddings(texts, provider_config=provider_config),
+                max_batch=max_batch, max_wait_ms=max_wait_ms, concurrency=concurrency)
+        return self.micro_batcher
+
+    def _embed_uncached(self, texts, provider_config=None, logger=None):
+        if self.micro_batcher is not None:
+            return self.micro_batcher.submit(texts, provider_config)
+        return self.get_embeddings(texts, provider_config, logger)
+
+    def embed_queries(self, queries: list, provider_config=None, logger=None):
+        """
+        查询向量化 (带缓存)：命中缓存的问题不发请求，其余合并为一次 API 调用
+        相同问题在途时等待那一次调用的结果 (single-flight)
+        返回: 与 queries 对齐的 float32 向量列表 (只读)
+        """
+        queries = [QueryEmbeddingCache.normalize(q) for q in queries]
+        if self.query_cache is None:
+            return [np.asarray(v, dtype=np.float32) for v in self._embed_uncached(queries, provider_config, logger)]
+        if self.use_mock:
+            scope = ("mock", Config.EMBEDDING_DIM)
+        else:
+            config = provider_config or {"url": Config.INTRANET_API_URL, "model": Config.INTRANET_MODEL_NAME}
+            scope = (config["url"], config["model"])
+
+        def compute(missing_keys):
+            return self._embed_uncached([key[2] for key in missing_keys], provider_config, logger)
+
+        start_time = time.perf_counter()
+        vectors = self.query_cache.get_many([scope + (q,) for q in queries], compute)
+        if logger:
+            logger(f"[Cache] 查询向量化 {len(queries)} 条 ({(time.perf_counter() - start_time) * 1000:.2f}ms) | "
+                   f"缓存 {self.query_cache.stats()}")
+        return vectors
+
+    def embed_query(self, query, provider_config=None, logger=None):
+        """单条查询向量化 (带缓存)"""
+        return self.embed_queries([query], provider_config, logger)[0]
 
     def get_embeddings(self, texts: list, provider_config=None, logger=None):
         """
@@ -103,12 +383,16 @@ class DBConnector:
     - 不再依赖字符串分割
     - 增强的数据验证
     """
-    def __init__(self):
-        self.db_path = Config.DB_PATH
+    def __init__(self, db_path=None):
+        self.db_path = db_path or Config.DB_PATH
+        self.fts_available = False
         self._init_tables()
 
     def get_connection(self):
-        return sqlite3.connect(self.db_path, check_same_thread=False)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        # INSERT OR REPLACE 删除旧行时也触发 DELETE 触发器，保持全文索引同步
+        conn.execute("PRAGMA recursive_triggers = ON")
+        return conn
 
     def _init_tables(self):
         """
@@ -118,41 +402,392 @@ class DBConnector:
         c = conn.cursor()
         
         try:
-            # 1. 确保基础表存在
-            c.execute('''
-                CREATE TABLE IF NOT EXISTS chunks_full_index (
-                    chunk_uuid TEXT PRIMARY KEY,
-                    doc_title TEXT,
-                    chapter_title TEXT,
-                    sub_title TEXT,
-                    full_context_text TEXT,
-                    pure_text TEXT,
-                    page_num INTEGER,
-                    char_count INTEGER,
-                    strategy_tag TEXT,
-                    created_at DATETIME
-                )
-            ''')
-            
-            # 2. [关键修复] 强制检查并添加 embedding_json 列
-            c.execute("PRAGMA table_info(chunks_full_index)")
-            existing_columns = [info[1] for info in c.fetchall()]
-            
-            if 'embedding_json' not in existing_columns:
-                print(f"[DB Init] 检测到旧表结构，正在添加 'embedding_json' 列...")
-                try:
-                    c.execute("ALTER TABLE chunks_full_index ADD COLUMN embedding_json TEXT")
-                    print("[DB Init] 列添加成功。")
-                except Exception as e:
-                    print(f"[DB Error] 添加列失败: {e}")
-            
+            # 1. 规范化切片存储 (doc_catalog / sections / chunks + 兼容视图 chunks_full_index)
+            #    旧版普通表 (含缺 embedding_json 列的更早版本) 在此迁移
+            migrated = init_chunk_tables(c, migrate=True)
+            if migrated:
+                print(f"[DB Init] 已将 {migrated} 条切片迁移到规范化存储 (章节表头不再逐行重复)")
+
+            # 2. 全文索引 (FTS5) 及同步触发器
+            self._init_fts(c)
+
+            # 3. 标识符索引表 (文号 / 标准号 / 工作号 → chunk_uuid)
+            init_identifier_table(c)
+
+            # 4. 变更日志: 索引挂载时只回放导出之后的变更，而不是重新导出全库
+            self._init_change_log(c)
+
+            # 5. 文档登记表 (内容哈希 -> 版本 / 入库状态)，流式流水线据此跳过未变化的文档
+            init_document_table(c)
+
             conn.commit()
+            if migrated:
+                # 旧表删除后空出的页回收，数据库文件随之缩小
+                conn.execute("VACUUM")
             
         except Exception as e:
             print(f"[DB Critical Error] 初始化失败: {e}")
         finally:
             conn.close()
 
+    def _init_fts(self, c):
+        """
+        创建 FTS5 全文索引虚表 chunks_fts 与三个同步触发器
+        - 分词器: trigram (按 3 字符滑窗切分，中文 / 文号 / 编号无需分词词典)
+        - rowid 与 chunks.rowid (即视图 chunks_full_index 的 rowid 列) 对齐；Day 2 / Day 3 任何写入都会经触发器同步
+        - SQLite 未编译 FTS5 或版本过旧 (< 3.34 无 trigram) 时降级为 LIKE 扫描
+        """
+        table = Config.FTS_TABLE
+        try:
+            c.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,))
+            is_new = c.fetchone() is None
+            c.execute(f'''
+                CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5(
+                    chunk_uuid UNINDEXED,
+                    doc_title,
+                    chapter_title,
+                    sub_title,
+                    pure_text,
+                    tokenize = '{Config.FTS_TOKENIZER}'
+                )
+            ''')
+        except sqlite3.OperationalError as e:
+            print(f"[DB Warning] FTS5 不可用，精确查询将退化为 LIKE 全表扫描: {e}")
+            return
+
+        # INSERT 用 OR REPLACE: 未开启 recursive_triggers 的连接 (如 Day 2 ETL) 执行 REPLACE 时
+        # 旧行不会触发 DELETE，新行若复用同一 rowid 则直接覆盖
+        # 触发器挂在基础表 chunks 上 (chunks_full_index 是视图)，标题经 sections / doc_catalog 取得
+        columns = "chunk_uuid, doc_title, chapter_title, sub_title, pure_text"
+        new_values = ("SELECT new.rowid, new.chunk_uuid, d.doc_title, s.chapter_title, s.sub_title, new.pure_text "
+                      "FROM sections s JOIN doc_catalog d ON d.doc_id = s.doc_id WHERE s.section_id = new.section_id")
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_ai AFTER INSERT ON chunks BEGIN
+                INSERT OR REPLACE INTO {table} (rowid, {columns}) {new_values};
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_ad AFTER DELETE ON chunks BEGIN
+                DELETE FROM {table} WHERE rowid = old.rowid;
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS {table}_au AFTER UPDATE ON chunks BEGIN
+                DELETE FROM {table} WHERE rowid = old.rowid;
+                INSERT OR REPLACE INTO {table} (rowid, {columns}) {new_values};
+            END
+        ''')
+        self.fts_available = True
+
+        if is_new:
+            c.execute("SELECT COUNT(*) FROM chunks_full_index")
+            existing = c.fetchone()[0]
+            if existing:
+                print(f"[DB Init] 已创建全文索引 {table}，现有 {existing} 条数据尚未建索引，"
+                      f"请运行: python day3_index_cli.py backfill-fts --db {self.db_path}")
+
+    def _init_change_log(self, c):
+        """
+        chunk_changes 变更日志表与 chunks 上的触发器 (Day 2 / Day 3 任何连接的写入都会记录)
+        seq 单调递增；索引导出时记下当时的 seq，之后的变更由 fetch_changes_since 回放为增量段
+        """
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS chunk_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                chunk_uuid TEXT NOT NULL,
+                op TEXT NOT NULL
+            )
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS chunk_changes_ai AFTER INSERT ON chunks BEGIN
+                INSERT INTO chunk_changes (chunk_uuid, op) VALUES (new.chunk_uuid, 'U');
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS chunk_changes_au AFTER UPDATE ON chunks BEGIN
+                INSERT INTO chunk_changes (chunk_uuid, op) VALUES (new.chunk_uuid, 'U');
+            END
+        ''')
+        c.execute('''
+            CREATE TRIGGER IF NOT EXISTS chunk_changes_ad AFTER DELETE ON chunks BEGIN
+                INSERT INTO chunk_changes (chunk_uuid, op) VALUES (old.chunk_uuid, 'D');
+            END
+        ''')
+
+    def current_change_seq(self):
+        """当前最大变更序号 (无变更记录时为 0)"""
+        conn = self.get_connection()
+        try:
+            return conn.execute("SELECT COALESCE(MAX(seq), 0) FROM chunk_changes").fetchone()[0]
+        finally:
+            conn.close()
+
+    def change_log_covers(self, seq):
+        """
+        seq 之后的变更是否仍完整保留在日志中 (没有被 prune_changes 删掉)
+        AUTOINCREMENT 的 sqlite_sequence 在行被删除后仍保留最大序号，可据此判断
+        """
+        conn = self.get_connection()
+        try:
+            min_seq = conn.execute("SELECT MIN(seq) FROM chunk_changes").fetchone()[0]
+            if min_seq is not None:
+                return min_seq - 1 <= seq
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'chunk_changes'").fetchone()
+            return (row[0] if row else 0) <= seq
+        finally:
+            conn.close()
+
+    def count_changes_since(self, seq):
+        """seq 之后变更过的切片数 (同一切片多次变更只算一次)"""
+        conn = self.get_connection()
+        try:
+            return conn.execute("SELECT COUNT(DISTINCT chunk_uuid) FROM chunk_changes WHERE seq > ?", (seq,)).fetchone()[0]
+        finally:
+            conn.close()
+
+    def fetch_changes_since(self, seq, batch_size=500):
+        """
+        回放 seq 之后的变更
+        返回: (upserts, deletes, last_seq)
+            upserts: [(chunk_uuid, 向量, doc_title, chapter_title)]，只含当前仍存在且有向量的切片
+            deletes: [chunk_uuid]，已被删除 (或向量被清空) 的切片
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            c.execute("SELECT COALESCE(MAX(seq), ?) FROM chunk_changes WHERE seq > ?", (seq, seq))
+            last_seq = c.fetchone()[0]
+            c.execute("SELECT DISTINCT chunk_uuid FROM chunk_changes WHERE seq > ? AND seq <= ?", (seq, last_seq))
+            changed = [r[0] for r in c.fetchall()]
+
+            upserts = []
+            alive = set()
+            for start in range(0, len(changed), batch_size):
+                batch = changed[start:start + batch_size]
+                c.execute(f"""
+                    SELECT chunk_uuid, embedding_json, doc_title, chapter_title
+                    FROM chunks_full_index
+                    WHERE chunk_uuid IN ({",".join("?" * len(batch))})
+                      AND embedding_json IS NOT NULL AND embedding_json != ''
+                """, batch)
+                for chunk_uuid, embedding_json, doc_title, chapter_title in c.fetchall():
+                    try:
+                        vec_data = json.loads(embedding_json)
+                    except json.JSONDecodeError:
+                        continue
+                    if vec_data:
+                        upserts.append((chunk_uuid, vec_data, doc_title or "", chapter_title or ""))
+                        alive.add(chunk_uuid)
+            deletes = [chunk_uuid for chunk_uuid in changed if chunk_uuid not in alive]
+            return upserts, deletes, last_seq
+        finally:
+            conn.close()
+
+    def prune_changes(self, seq):
+        """删除 seq 及之前的变更记录 (新的基础索引已经包含这些变更)"""
+        conn = self.get_connection()
+        try:
+            conn.execute("DELETE FROM chunk_changes WHERE seq <= ?", (seq,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def backfill_fts(self, logger=None):
+        """
+        用 chunks_full_index 全量重建全文索引 (旧库首次升级 / 清理孤儿行)
+        返回: 写入的条数
+        """
+        if not self.fts_available:
+            if logger: logger("[FTS] 当前 SQLite 不支持 FTS5，跳过回填")
+            return 0
+        table = Config.FTS_TABLE
+        start_time = time.time()
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            c.execute(f"DELETE FROM {table}")
+            c.execute(f'''
+                INSERT INTO {table} (rowid, chunk_uuid, doc_title, chapter_title, sub_title, pure_text)
+                SELECT rowid, chunk_uuid, doc_title, chapter_title, sub_title, pure_text FROM chunks_full_index
+            ''')
+            count = c.rowcount
+            # 合并 b-tree 段，提升查询速度
+            c.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+            conn.commit()
+        finally:
+            conn.close()
+        if logger:
+            logger(f"[FTS] 回填完成: {count} 条 ({time.time() - start_time:.2f}s)")
+        return count
+
+    @staticmethod
+    def _fts_phrase(term):
+        """转为 FTS5 短语 (双引号包裹)，避免 - * : 等字符被当作查询语法"""
+        return '"' + term.replace('"', '""') + '"'
+
+    @staticmethod
+    def _like_pattern(term):
+        """转为 LIKE 子串模式 (配合 ESCAPE '\\')，用户输入中的 % _ \\ 按字面匹配"""
+        return "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+    @staticmethod
+    def _scope_clause(column, values):
+        """文档 / 章节范围 -> (SQL 条件, 参数)；values 为 None / 空时不限定"""
+        if isinstance(values, str):
+            values = [values]
+        if not values:
+            return "", []
+        return f" AND {column} IN ({','.join('?' * len(values))})", list(values)
+
+    def search_fts(self, query, limit=10, docs=None, chapters=None):
+        """
+        精确短语 / 编号查询
+        - 空格分隔的每个词都必须出现 (AND)
+        - 长度 >= 3 的词走 FTS5 trigram 索引，按 bm25 排序
+        - 长度 < 3 的词 trigram 无法索引，作为 LIKE 条件在候选内过滤；
+          全部是短词 (或 FTS5 不可用) 时退化为 chunks_full_index 上的 LIKE 扫描
+        - docs / chapters: 文档名 / 章节名 (字符串或列表)，在 SQL 中限定范围后再取前 limit 条，
+          范围外的命中不会挤掉范围内的命中
+        返回: [{'id', 'doc', 'chapter', 'sub', 'pure_text', 'score'}]，score 越大越相关
+        """
+        terms = [t for t in (query or "").split() if t]
+        if not terms:
+            return []
+        long_terms = [t for t in terms if len(t) >= 3]
+        short_terms = [t for t in terms if len(t) < 3]
+
+        def scope(alias=""):
+            doc_sql, doc_params = self._scope_clause(alias + "doc_title", docs)
+            chapter_sql, chapter_params = self._scope_clause(alias + "chapter_title", chapters)
+            return doc_sql + chapter_sql, doc_params + chapter_params
+
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            if self.fts_available and long_terms:
+                table = Config.FTS_TABLE
+                # 回表按 rowid + chunk_uuid 校验，过滤未开启 recursive_triggers 的 REPLACE 残留的孤儿行
+                sql = f'''
+                    SELECT b.chunk_uuid, b.doc_title, b.chapter_title, b.sub_title, b.pure_text, bm25({table}) AS rank
+                    FROM {table} f
+                    JOIN chunks_full_index b ON b.rowid = f.rowid AND b.chunk_uuid = f.chunk_uuid
+                    WHERE {table} MATCH ?
+                '''
+                params = [" AND ".join(self._fts_phrase(t) for t in long_terms)]
+                for t in short_terms:
+                    sql += " AND b.pure_text LIKE ? ESCAPE '\\'"
+                    params.append(self._like_pattern(t))
+                scope_sql, scope_params = scope("b.")
+                sql += scope_sql
+                params += scope_params
+                sql += " ORDER BY rank LIMIT ?"
+                params.append(limit)
+                c.execute(sql, params)
+                # bm25() 越小越相关，取负号统一为 "越大越好"
+                return [{'id': r[0], 'doc': r[1], 'chapter': r[2], 'sub': r[3], 'pure_text': r[4],
+                         'score': -float(r[5])} for r in c.fetchall()]
+
+            sql = "SELECT chunk_uuid, doc_title, chapter_title, sub_title, pure_text FROM chunks_full_index WHERE "
+            scope_sql, scope_params = scope()
+            sql += " AND ".join("pure_text LIKE ? ESCAPE '\\'" for _ in terms) + scope_sql + " LIMIT ?"
+            c.execute(sql, [self._like_pattern(t) for t in terms] + scope_params + [limit])
+            return [{'id': r[0], 'doc': r[1], 'chapter': r[2], 'sub': r[3], 'pure_text': r[4], 'score': 0.0}
+                    for r in c.fetchall()]
+        except sqlite3.OperationalError as e:
+            print(f"[DB FTS Error] {e}")
+            return []
+        finally:
+            conn.close()
+
+    def backfill_identifiers(self, logger=None, fetch_size=1000):
+        """
+        用 chunks_full_index 的 pure_text 全量重建 chunk_identifiers (旧库升级 / 抽取规则变更后)
+        返回: (切片数, 标识符条数)
+        """
+        start_time = time.time()
+        conn = self.get_connection()
+        read_cur = conn.cursor()
+        write_cur = conn.cursor()
+        chunk_count = 0
+        try:
+            write_cur.execute("DELETE FROM chunk_identifiers")
+            read_cur.execute("SELECT chunk_uuid, pure_text FROM chunks_full_index")
+            while True:
+                rows = read_cur.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for chunk_uuid, pure_text in rows:
+                    insert_identifiers(write_cur, chunk_uuid, extract_identifiers(pure_text))
+                    chunk_count += 1
+            conn.commit()
+            write_cur.execute("SELECT COUNT(*) FROM chunk_identifiers")
+            id_count = write_cur.fetchone()[0]
+        finally:
+            conn.close()
+        if logger:
+            logger(f"[Identifier] 回填完成: {chunk_count} 个切片, {id_count} 条标识符 ({time.time() - start_time:.2f}s)")
+        return chunk_count, id_count
+
+    def lookup_identifiers(self, query, limit=50, docs=None):
+        """
+        问题中含文号 / 编号时的精确查询 (chunk_identifiers 主键 B-tree 等值查找)
+        每个标识符取能命中的最长写法；文号只剥掉引导词，不截短机关代字 (见 query_identifier_variants)
+        文号 / 标准号 / ICS / 工作号全库唯一，直接全库命中；条款号 / 章节号只在文档范围确定时参与:
+        docs (调用方的文档范围) 非空时限定在这些文档内，否则限定在问题中唯一标识符命中的文档内，两者都没有时忽略
+        返回: [{'id', 'doc', 'chapter', 'sub', 'pure_text', 'identifier', 'kind'}] (唯一类型在前)；无命中时返回 []
+        """
+        identifiers = extract_identifiers(query)
+        if not identifiers:
+            return []
+        variants = {}
+        for kind, identifier in identifiers:
+            variants[(kind, identifier)] = query_identifier_variants(kind, identifier)
+        all_variants = sorted({v for vs in variants.values() for v in vs})
+
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            # 回表 chunks_full_index: 过滤已删除切片残留的标识符
+            c.execute(f'''
+                SELECT i.identifier, i.kind, b.chunk_uuid, b.doc_title, b.chapter_title, b.sub_title, b.pure_text
+                FROM chunk_identifiers i
+                JOIN chunks_full_index b ON b.chunk_uuid = i.chunk_uuid
+                WHERE i.identifier IN ({",".join("?" * len(all_variants))})
+            ''', all_variants)
+            by_identifier = {}
+            for row in c.fetchall():
+                by_identifier.setdefault(row[0], []).append(row)
+        except sqlite3.OperationalError as e:
+            print(f"[DB Identifier Error] {e}")
+            return []
+        finally:
+            conn.close()
+
+        results = []
+        seen = set()
+
+        def collect(unique, scope=None):
+            for (kind, identifier), vs in variants.items():
+                if (kind in UNIQUE_IDENTIFIER_KINDS) != unique:
+                    continue
+                hit_variant = next((v for v in vs if v in by_identifier), None)
+                if hit_variant is None:
+                    continue
+                for row in by_identifier[hit_variant]:
+                    if row[2] in seen or (scope is not None and row[3] not in scope):
+                        continue
+                    seen.add(row[2])
+                    results.append({'id': row[2], 'doc': row[3], 'chapter': row[4], 'sub': row[5],
+                                    'pure_text': row[6], 'identifier': hit_variant, 'kind': kind})
+
+        collect(unique=True)
+        if isinstance(docs, str):
+            docs = [docs]
+        scope = set(docs) if docs else {hit['doc'] for hit in results}
+        if scope:
+            collect(unique=False, scope=scope)
+        return results[:limit]
+
     def bulk_insert(self, records):
         """
         ✨ Method 2 Enhanced 版本：批量插入数据
@@ -165,57 +800,7 @@ class DBConnector:
         c = conn.cursor()
         
         try:
-            for r in records:
-                meta = r.get('metadata', {})
-                embedding_json = json.dumps(r.get('embedding', []))
-                
-                # ✨ 核心修复：优先级列表获取 pure_text
-                # 由于 Day 2 已经在 JSON 中保存了 pure_text，这里应该直接读取
-                pure_text = ""
-                
-                # 第 1 优先级：JSON 顶层的 pure_text（Day 2 新增）
-                if 'pure_text' in r and r['pure_text']:
-                    pure_text = r['pure_text'].strip()
-                
-                # 第 2 优先级：metadata 中的 pure_text（Day 2 备份）
-                elif 'pure_text' in meta and meta['pure_text']:
-                    pure_text = meta['pure_text'].strip()
-                
-                # 第 3 优先级：从 embedding_text 分割（兼容旧版 Day 2）
-                else:
-                    embedding_text = r.get('embedding_text', '')
-                    if "Content: " in embedding_text:
-                        pure_text = embedding_text.split("Content: ", 1)[1].strip()
-                    else:
-                        pure_text = embedding_text.strip()
-                
-                # 最后保底：确保不为空
-                if not pure_text:
-                    pure_text = r.get('embedding_text', '').strip()
-                
-                # 数据质量检查：如果 pure_text 太短，可能是损坏
-                if len(pure_text) < 10:
-                    print(f"[Warning] 记录的 pure_text 过短（{len(pure_text)} 字符），可能数据损坏")
-                
-                # 确保字段顺序与表结构一致
-                c.execute('''
-                    INSERT OR REPLACE INTO chunks_full_index 
-                    (chunk_uuid, doc_title, chapter_title, sub_title, full_context_text, 
-                     pure_text, page_num, char_count, strategy_tag, created_at, embedding_json)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    meta.get('section_id', ''),         
-                    meta.get('doc_title', ''),          
-                    r.get('chapter_title_temp', ''),    
-                    r.get('sub_title_temp', ''),        
-                    r.get('embedding_text', ''),        
-                    pure_text,                          # ✨ 使用从 JSON 读取的 pure_text
-                    meta.get('page_num', 0),
-                    meta.get('char_count', 0),
-                    meta.get('strategy', 'Unknown'),
-                    datetime.now(),
-                    embedding_json
-                ))
+            self._insert_records(c, records)
             conn.commit()
         except Exception as e:
             print(f"[DB Insert Error] {e}")
@@ -223,6 +808,142 @@ class DBConnector:
         finally:
             conn.close()
 
+    def _insert_records(self, c, records):
+        """写入一批切片记录 (不提交，由调用方控制事务)"""
+        for r in records:
+            meta = r.get('metadata', {})
+            # 近重复切片 (chunk_dedup) 没有向量，embedding_json 留空，不进入向量索引
+            embedding_json = json.dumps(r['embedding']) if r.get('embedding') is not None else None
+            
+            # ✨ 核心修复：优先级列表获取 pure_text
+            # 由于 Day 2 已经在 JSON 中保存了 pure_text，这里应该直接读取
+            pure_text = ""
+            
+            # 第 1 优先级：JSON 顶层的 pure_text（Day 2 新增）
+            if 'pure_text' in r and r['pure_text']:
+                pure_text = r['pure_text'].strip()
+            
+            # 第 2 优先级：metadata 中的 pure_text（Day 2 备份）
+            elif 'pure_text' in meta and meta['pure_text']:
+                pure_text = meta['pure_text'].strip()
+            
+            # 第 3 优先级：从 embedding_text 分割（兼容旧版 Day 2）
+            else:
+                embedding_text = r.get('embedding_text', '')
+                if "Content: " in embedding_text:
+                    pure_text = embedding_text.split("Content: ", 1)[1].strip()
+                else:
+                    pure_text = embedding_text.strip()
+            
+            # 最后保底：确保不为空
+            if not pure_text:
+                pure_text = r.get('embedding_text', '').strip()
+            
+            # 数据质量检查：如果 pure_text 太短，可能是损坏
+            if len(pure_text) < 10:
+                print(f"[Warning] 记录的 pure_text 过短（{len(pure_text)} 字符），可能数据损坏")
+            
+            # 确保字段顺序与表结构一致
+            c.execute('''
+                INSERT OR REPLACE INTO chunks_full_index 
+                (chunk_uuid, doc_title, chapter_title, sub_title, full_context_text, 
+                 pure_text, page_num, char_count, strategy_tag, created_at, embedding_json)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                meta.get('section_id', ''),         
+                meta.get('doc_title', ''),          
+                r.get('chapter_title_temp', ''),    
+                r.get('sub_title_temp', ''),        
+                r.get('embedding_text', ''),        
+                pure_text,                          # ✨ 使用从 JSON 读取的 pure_text
+                meta.get('page_num', 0),
+                meta.get('char_count', 0),
+                meta.get('strategy', 'Unknown'),
+                datetime.now(),
+                embedding_json
+            ))
+            # 标识符索引 (Day 2 入库时已写入的不会重复)
+            insert_identifiers(c, meta.get('section_id', ''), extract_identifiers(pure_text))
+            # 近重复归属 (出处映射)；重新入库时不再是重复切片的清除旧映射
+            set_duplicate(c, meta.get('section_id', ''), r.get('duplicate_of'), r.get('duplicate_similarity'))
+
+    # --- 文档级维护: 按文档替换 / 删除，耗时与文档大小成正比，而不是整库重建 ---
+    def replace_document(self, doc_title, records, registration=None):
+        """
+        用 records (bulk_insert 的记录格式，含 embedding) 整体替换某文档的切片
+        旧切片 (含标识符、FTS 行) 的删除与新切片写入在同一个事务中提交；
+        registration: 可选的登记信息 {content_hash, version, source_path, page_count, settings}，
+                      同一事务内写入文档登记表 (version 缺省时自动递增)
+        返回 (删除的 chunk_uuid 列表, 写入的 chunk_uuid 列表)，供调用方把变更发布到内存索引
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            old_ids = document_chunk_ids(c, doc_title)
+            delete_chunks(c, old_ids)
+            self._insert_records(c, records)
+            if registration is not None:
+                version = registration.get('version') or next_version(c, doc_title)
+                register_document(c, registration['content_hash'], doc_title, version,
+                                  registration.get('source_path'), registration.get('page_count'),
+                                  len(records), registration.get('settings'))
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[DB Replace Error] {doc_title}: {e}")
+            raise
+        finally:
+            conn.close()
+        new_ids = [r.get('metadata', {}).get('section_id', '') for r in records]
+        kept = set(new_ids)
+        return [chunk_uuid for chunk_uuid in old_ids if chunk_uuid not in kept], new_ids
+
+    def delete_document(self, doc_title):
+        """删除某文档的全部切片 (含标识符、FTS 行) 并在登记表中标记为已删除，单个事务；返回删除的 chunk_uuid 列表"""
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            old_ids = document_chunk_ids(c, doc_title)
+            delete_chunks(c, old_ids)
+            mark_deleted(c, doc_title)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            print(f"[DB Delete Error] {doc_title}: {e}")
+            raise
+        finally:
+            conn.close()
+        return old_ids
+
+    def list_documents(self):
+        """[(doc_title, 切片数, 已向量化切片数)]，按文档名排序"""
+        conn = self.get_connection()
+        try:
+            return conn.execute(
+                "SELECT doc_title, COUNT(*), COUNT(embedding_json) FROM chunks_full_index "
+                "GROUP BY doc_title ORDER BY doc_title"
+            ).fetchall()
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _repair_pure_text(row):
+        """
+        校验并修复单条记录的 pure_text
+        返回: (pure_text, repaired)；无法修复时 pure_text 为 None
+        """
+        pure_text = row['pure_text']
+        if pure_text and len(pure_text.strip()) >= 5:
+            return pure_text, False
+
+        # 如果 pure_text 为空或过短，尝试从 full_context_text 修复
+        full_text = row['full_context_text'] or ""
+        if "Content: " in full_text:
+            pure_text = full_text.split("Content: ", 1)[1].strip()
+            if len(pure_text) > 5:
+                return pure_text, True
+        return None, False
+
     def fetch_all_vectors(self):
         """
         ✨ Method 2 Enhanced 版本：拉取所有向量用于仿真器内存计算
@@ -257,24 +978,14 @@ class DBConnector:
                     vec_data = json.loads(row['embedding_json'])
                     if vec_data:  # 确保向量非空
                         # ✨ Method 2 Enhanced：在加载时验证 pure_text 数据完整性
-                        pure_text = row['pure_text']
-                        
-                        # 如果 pure_text 为空或过短，尝试从 full_context_text 修复
-                        if not pure_text or len(pure_text.strip()) < 5:
-                            full_text = row['full_context_text'] or ""
-                            if "Content: " in full_text:
-                                pure_text = full_text.split("Content: ", 1)[1].strip()
-                                if len(pure_text) > 5:
-                                    repair_count += 1
-                                else:
-                                    skip_count += 1
-                                    print(f"[DB Warning] 记录 {row['chunk_uuid'][:8]}... 的 pure_text 无法修复，已跳过")
-                                    continue
-                            else:
-                                # 无法修复，跳过此记录
-                                skip_count += 1
-                                print(f"[DB Warning] 记录 {row['chunk_uuid'][:8]}... 的 pure_text 损坏且无法修复，已跳过")
-                                continue
+                        pure_text, repaired = self._repair_pure_text(row)
+                        if pure_text is None:
+                            # 无法修复，跳过此记录
+                            skip_count += 1
+                            print(f"[DB Warning] 记录 {row['chunk_uuid'][:8]}... 的 pure_text 损坏且无法修复，已跳过")
+                            continue
+                        if repaired:
+                            repair_count += 1
                         
                         results.append({
                             'id': row['chunk_uuid'],
@@ -299,4 +1010,981 @@ class DBConnector:
             print(f"[DB Fetch Error] {e}")
             return []
         finally:
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+    def iter_embeddings(self, fetch_size=1000, with_meta=False):
+        """
+        流式拉取 (chunk_uuid, 向量) 用于索引导出
+        只查询 ID、向量与文档 / 章节列，按 fetch_size 分批读取，不会把整库文本读进内存
+        按 (doc_title, chapter_title) 排序，同一文档 / 章节的行在矩阵中连续
+        with_meta=True 时返回 (chunk_uuid, 向量, doc_title, chapter_title)
+        """
+        conn = self.get_connection()
+        c = conn.cursor()
+        try:
+            c.execute("PRAGMA table_info(chunks_full_index)")
+            cols = [r[1] for r in c.fetchall()]
+            if 'embedding_json' not in cols:
+                print("[DB Warning] 表中缺少 embedding_json 列，无法导出向量。")
+                return
+
+            # 直接连接基础表并固定连接顺序: 沿文档名 / 章节唯一索引有序扫描，排序不会把全部向量 JSON 放进临时表
+            c.execute("""
+                SELECT c.chunk_uuid, c.embedding_json, d.doc_title, s.chapter_title
+                FROM doc_catalog d
+                CROSS JOIN sections s
+                CROSS JOIN chunks c INDEXED BY idx_chunks_section
+                WHERE s.doc_id = d.doc_id AND c.section_id = s.section_id
+                  AND c.embedding_json IS NOT NULL AND c.embedding_json != ''
+                ORDER BY d.doc_title, s.chapter_title
+            """)
+            while True:
+                rows = c.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for chunk_uuid, embedding_json, doc_title, chapter_title in rows:
+                    try:
+                        vec_data = json.loads(embedding_json)
+                    except json.JSONDecodeError:
+                        continue  # 跳过损坏的 JSON 数据
+                    if not vec_data:
+                        continue
+                    if with_meta:
+                        yield chunk_uuid, vec_data, doc_title or "", chapter_title or ""
+                    else:
+                        yield chunk_uuid, vec_data
+        finally:
+            conn.close()
+
+    def fetch_chunk_metadata(self):
+        """
+        拉取所有切片的文本与元数据 (不含向量)，供内存映射索引模式使用
+        返回: {chunk_uuid: {'id', 'text', 'pure_text', 'doc', 'chapter', 'sub'}}
+        pure_text 无法修复的记录不会出现在结果中
+        """
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        
+        try:
+            c.execute("""
+                SELECT chunk_uuid, full_context_text, pure_text, doc_title, chapter_title, sub_title 
+                FROM chunks_full_index
+            """)
+            results = {}
+            repair_count = 0
+            skip_count = 0
+            
+            for row in c.fetchall():
+                pure_text, repaired = self._repair_pure_text(row)
+                if pure_text is None:
+                    skip_count += 1
+                    continue
+                if repaired:
+                    repair_count += 1
+                results[row['chunk_uuid']] = {
+                    'id': row['chunk_uuid'],
+                    'text': row['full_context_text'],
+                    'pure_text': pure_text,
+                    'doc': row['doc_title'],
+                    'chapter': row['chapter_title'],
+                    'sub': row['sub_title']
+                }
+            
+            if repair_count > 0:
+                print(f"[DB Info] 已自动修复 {repair_count} 条损坏的 pure_text 记录")
+            if skip_count > 0:
+                print(f"[DB Info] 已跳过 {skip_count} 条无法修复的记录")
+            
+            return results
+            
+        except sqlite3.OperationalError as e:
+            print(f"[DB Fetch Error] {e}")
+            return {}
+        finally:
+            conn.close()
+
+    def fetch_duplicates(self, chunk_uuids):
+        """
+        代表切片 -> 被折叠进同一近重复簇的切片 (结果展示出处)
+        返回: {代表 chunk_uuid: [{'id', 'doc', 'page', 'similarity'}]}，按相似度降序
+        """
+        chunk_uuids = list(dict.fromkeys(chunk_uuids))
+        if not chunk_uuids:
+            return {}
+        conn = self.get_connection()
+        results = {}
+        try:
+            c = conn.cursor()
+            for chunk_uuid in chunk_uuids:
+                c.execute("""
+                    SELECT d.chunk_uuid, b.doc_title, b.page_num, d.similarity
+                    FROM chunk_duplicates d JOIN chunks_full_index b ON b.chunk_uuid = d.chunk_uuid
+                    WHERE d.representative_uuid = ?
+                    ORDER BY d.similarity DESC
+                """, (chunk_uuid,))
+                rows = c.fetchall()
+                if rows:
+                    results[chunk_uuid] = [{'id': dup_uuid, 'doc': doc_title, 'page': page_num, 'similarity': similarity}
+                                           for dup_uuid, doc_title, page_num, similarity in rows]
+            return results
+        except sqlite3.OperationalError as e:
+            print(f"[DB Fetch Error] {e}")
+            return results
+        finally:
+            conn.close()
+
+    def fetch_texts(self, chunk_uuids, batch_size=500):
+        """
+        按主键拉取少量切片的文本与元数据 (懒加载模式下只为最终 Top-K 回表)
+        每批一次 WHERE chunk_uuid IN (...) 查询 (batch_size 控制在 SQLite 参数上限以内)
+        返回: {chunk_uuid: {'id', 'text', 'pure_text', 'doc', 'chapter', 'sub'}}
+        pure_text 无法修复的记录不会出现在结果中
+        """
+        chunk_uuids = list(dict.fromkeys(chunk_uuids))
+        if not chunk_uuids:
+            return {}
+        conn = self.get_connection()
+        conn.row_factory = sqlite3.Row
+        c = conn.cursor()
+        results = {}
+        try:
+            for start in range(0, len(chunk_uuids), batch_size):
+                batch = chunk_uuids[start:start + batch_size]
+                c.execute(f"""
+                    SELECT chunk_uuid, full_context_text, pure_text, doc_title, chapter_title, sub_title
+                    FROM chunks_full_index
+                    WHERE chunk_uuid IN ({",".join("?" * len(batch))})
+                """, batch)
+                for row in c.fetchall():
+                    pure_text, _ = self._repair_pure_text(row)
+                    if pure_text is None:
+                        continue
+                    results[row['chunk_uuid']] = {
+                        'id': row['chunk_uuid'],
+                        'text': row['full_context_text'],
+                        'pure_text': pure_text,
+                        'doc': row['doc_title'],
+                        'chapter': row['chapter_title'],
+                        'sub': row['sub_title']
+                    }
+            return results
+        except sqlite3.OperationalError as e:
+            print(f"[DB Fetch Error] {e}")
+            return results
+        finally:
+            conn.close()
+
+class VectorIndexStore:
+    """
+    磁盘向量索引 (内存映射)
+    
+    目录结构 (index_dir = rag_production.index/):
+    - CURRENT                 : 当前快照名 (单行文本)，发布新快照时 os.replace 原子替换
+    - snapshots/v<版本>/      : 一次导出的不可变快照
+        - vectors.f32   : 连续的、预先 L2 归一化的 float32 矩阵 (行优先, count x dim)
+        - ids.json      : 行号 -> chunk_uuid 映射
+        - filters.json  : 过滤字段 -> 取值 -> 行区间列表 [[start, end), ...]
+                          (行按 doc_title, chapter_title 排序导出，每个文档只占一段连续区间)
+        - manifest.json : 格式版本 / 构建版本 / 模型 / 维度 / 行数 / 源 DB 信息
+        - ivf/ sq8/ ... : 由该快照构建的 ANN / 量化索引
+    
+    加载时使用 np.memmap 只读映射，首个查询无需再解析 SQLite 中的 embedding_json，
+    多个进程 (仿真器 / 检索服务) 通过 OS 页缓存共享同一份物理内存。
+    快照写完后不再修改：重建索引时读者继续使用已映射的旧快照，切换 CURRENT 后新挂载才读到新快照，
+    旧快照由 gc_snapshots 清理 (Windows 下仍被映射的快照删除失败时跳过，下次再清理)。
+    """
+    MATRIX_FILE = "vectors.f32"
+    IDS_FILE = "ids.json"
+    FILTERS_FILE = "filters.json"
+    MANIFEST_FILE = "manifest.json"
+    CURRENT_FILE = "CURRENT"
+    SNAPSHOT_DIR = "snapshots"
+    BUILDING_SUFFIX = ".building"
+
+    @staticmethod
+    def default_dir(db_path):
+        """默认索引目录: 与 DB 同级，rag_production.db -> rag_production.index/"""
+        return os.path.splitext(db_path)[0] + Config.INDEX_DIR_SUFFIX
+
+    @classmethod
+    def export(cls, db_connector, index_dir, model_name="", logger=None):
+        """
+        从 DB 流式导出一个新快照，并发布为当前快照
+        先写入 snapshots/<名>.building/，写完后整目录改名，最后原子替换 CURRENT，
+        读者不会映射到写了一半的矩阵；导出失败时删除未完成的目录，CURRENT 保持不变
+        返回: manifest 字典
+        """
+        version = datetime.now().strftime("%Y%m%d%H%M%S")
+        snapshots_root = os.path.join(index_dir, cls.SNAPSHOT_DIR)
+        os.makedirs(snapshots_root, exist_ok=True)
+        name = f"v{version}"
+        suffix = 1
+        while os.path.exists(os.path.join(snapshots_root, name)) or \
+                os.path.exists(os.path.join(snapshots_root, name + cls.BUILDING_SUFFIX)):
+            name = f"v{version}_{suffix}"
+            suffix += 1
+        building_dir = os.path.join(snapshots_root, name + cls.BUILDING_SUFFIX)
+        os.makedirs(building_dir)
+        try:
+            manifest = cls._write_snapshot(db_connector, building_dir, version, model_name, logger)
+            os.replace(building_dir, os.path.join(snapshots_root, name))
+        except BaseException:
+            shutil.rmtree(building_dir, ignore_errors=True)
+            raise
+        cls._publish(index_dir, name)
+        
+        # 新快照已包含 change_seq 之前的全部变更；CURRENT 替换成功后才清理 (发布前失败时旧快照仍需回放这些变更)，
+        # 清理会改动 DB 文件，之后重新记录 DB mtime，清理本身不使快照过期
+        db_connector.prune_changes(manifest['change_seq'])
+        if os.path.exists(db_connector.db_path):
+            manifest['source_db_mtime'] = os.path.getmtime(db_connector.db_path)
+            manifest_path = os.path.join(snapshots_root, name, cls.MANIFEST_FILE)
+            with open(manifest_path + ".tmp", 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            os.replace(manifest_path + ".tmp", manifest_path)
+        
+        if logger:
+            logger(f"[Index] 快照 {name} 已发布: {manifest['count']} 条 x {manifest['dim']} 维 -> {index_dir}")
+        return manifest
+
+    @classmethod
+    def _write_snapshot(cls, db_connector, snapshot_dir, version, model_name, logger):
+        """把 DB 中的向量写入 snapshot_dir (尚未发布的快照目录)"""
+        ids = []
+        dim = None
+        skip_count = 0
+        start_time = time.time()
+        # 扫描开始前的变更序号: 导出期间发生的变更会在挂载时再回放一次 (upsert 幂等)
+        change_seq = db_connector.current_change_seq()
+        # 过滤区间: 行按 (doc, chapter) 有序写入，值变化时开启新区间
+        filters = {"doc": {}, "chapter": {}}
+        
+        with open(os.path.join(snapshot_dir, cls.MATRIX_FILE), 'wb') as f:
+            for chunk_uuid, vec_data, doc_title, chapter_title in db_connector.iter_embeddings(with_meta=True):
+                vec = np.asarray(vec_data, dtype=np.float32)
+                if dim is None:
+                    dim = vec.shape[0]
+                if vec.shape[0] != dim:
+                    # 维度不一致 (混入了其他模型的向量)，跳过
+                    skip_count += 1
+                    continue
+                
+                norm = np.linalg.norm(vec)
+                if norm > 0:
+                    vec = vec / norm
+                f.write(vec.tobytes())
+                row = len(ids)
+                ids.append(chunk_uuid)
+                for field, value in (("doc", doc_title), ("chapter", chapter_title)):
+                    ranges = filters[field].setdefault(value, [])
+                    if ranges and ranges[-1][1] == row:
+                        ranges[-1][1] = row + 1
+                    else:
+                        ranges.append([row, row + 1])
+        
+        manifest = {
+            "format_version": Config.INDEX_FORMAT_VERSION,
+            "version": version,
+            "model": model_name,
+            "dim": dim or Config.EMBEDDING_DIM,
+            "count": len(ids),
+            "dtype": "float32",
+            "normalized": True,
+            "sorted_by": ["doc_title", "chapter_title"],
+            "source_db": os.path.abspath(db_connector.db_path),
+            "source_db_mtime": os.path.getmtime(db_connector.db_path) if os.path.exists(db_connector.db_path) else 0,
+            "change_seq": change_seq,
+            "created_at": datetime.now().isoformat()
+        }
+        
+        with open(os.path.join(snapshot_dir, cls.IDS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        with open(os.path.join(snapshot_dir, cls.FILTERS_FILE), 'w', encoding='utf-8') as f:
+            json.dump(filters, f, ensure_ascii=False)
+        with open(os.path.join(snapshot_dir, cls.MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        
+        if skip_count > 0 and logger:
+            logger(f"[Index Warning] 已跳过 {skip_count} 条维度不一致的向量")
+        if logger:
+            logger(f"[Index] 导出完成: {len(ids)} 条 x {manifest['dim']} 维 ({time.time() - start_time:.2f}s)")
+        return manifest
+
+    @classmethod
+    def _publish(cls, index_dir, name):
+        """原子替换 CURRENT 指针"""
+        current_path = os.path.join(index_dir, cls.CURRENT_FILE)
+        with open(current_path + ".tmp", 'w', encoding='utf-8') as f:
+            f.write(name)
+        os.replace(current_path + ".tmp", current_path)
+
+    @classmethod
+    def current_snapshot(cls, index_dir):
+        """当前快照目录 (CURRENT 缺失或指向不存在的快照时返回 None)"""
+        try:
+            with open(os.path.join(index_dir, cls.CURRENT_FILE), 'r', encoding='utf-8') as f:
+                name = f.read().strip()
+        except OSError:
+            return None
+        snapshot_dir = os.path.join(index_dir, cls.SNAPSHOT_DIR, name)
+        return snapshot_dir if name and os.path.isdir(snapshot_dir) else None
+
+    @classmethod
+    def gc_snapshots(cls, index_dir, keep=None, protect=(), logger=None):
+        """
+        清理旧快照: 保留最新的 keep 个 (含当前快照) 以及 protect 中的快照 (仍在使用的快照目录)
+        删除失败 (Windows 下仍被其他进程 memmap) 的快照跳过，下次再清理
+        返回: 删除的快照数
+        """
+        keep = Config.INDEX_KEEP_SNAPSHOTS if keep is None else keep
+        snapshots_root = os.path.join(index_dir, cls.SNAPSHOT_DIR)
+        if not os.path.isdir(snapshots_root):
+            return 0
+        current = cls.current_snapshot(index_dir)
+        protected = {os.path.abspath(p) for p in protect if p}
+        if current:
+            protected.add(os.path.abspath(current))
+        # 快照名以导出时间开头，按名称排序即按时间排序；未完成的 .building 目录属于正在进行的导出，不动
+        names = sorted((n for n in os.listdir(snapshots_root)
+                        if not n.endswith(cls.BUILDING_SUFFIX) and os.path.isdir(os.path.join(snapshots_root, n))),
+                       reverse=True)
+        removed = 0
+        for name in names[keep:]:
+            path = os.path.abspath(os.path.join(snapshots_root, name))
+            if path in protected:
+                continue
+            try:
+                shutil.rmtree(path)
+                removed += 1
+            except OSError as e:
+                if logger:
+                    logger(f"[Index] 快照 {name} 仍在使用，暂不清理: {e}")
+        if removed and logger:
+            logger(f"[Index] 已清理 {removed} 个旧快照")
+        return removed
+
+    @classmethod
+    def read_manifest(cls, index_dir):
+        """读取当前快照的 manifest (没有已发布的快照时返回 None)"""
+        snapshot_dir = cls.current_snapshot(index_dir)
+        if snapshot_dir is None:
+            return None
+        try:
+            with open(os.path.join(snapshot_dir, cls.MANIFEST_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    @classmethod
+    def can_replay(cls, index_dir, db_connector):
+        """
+        索引格式兼容，且导出之后的变更仍完整保留在 chunk_changes 中 (可以只回放增量，无需重新导出)
+        返回: 待回放的切片数；不能回放时返回 None
+        """
+        manifest = cls.read_manifest(index_dir)
+        if not manifest or manifest.get("format_version") != Config.INDEX_FORMAT_VERSION:
+            return None
+        seq = manifest.get("change_seq")
+        if seq is None or not db_connector.change_log_covers(seq):
+            return None
+        return db_connector.count_changes_since(seq)
+
+    @classmethod
+    def is_fresh(cls, index_dir, db_path):
+        """索引存在、格式兼容，且 DB 在导出后没有被修改过"""
+        manifest = cls.read_manifest(index_dir)
+        if not manifest or manifest.get("format_version") != Config.INDEX_FORMAT_VERSION:
+            return False
+        if not os.path.exists(db_path):
+            return False
+        return os.path.getmtime(db_path) <= manifest.get("source_db_mtime", 0)
+
+    @classmethod
+    def load(cls, index_dir):
+        """
+        以只读内存映射方式加载当前快照
+        CURRENT 只读取一次，之后的文件都来自同一个快照目录，加载过程中发布的新快照不影响本次加载
+        返回: (matrix, ids, manifest)，matrix 为 np.memmap (count x dim, float32)
+             manifest['snapshot_dir'] 为快照目录 (ANN 索引与过滤区间也从这里加载)
+        """
+        snapshot_dir = cls.current_snapshot(index_dir)
+        if snapshot_dir is None:
+            raise FileNotFoundError(f"索引快照不存在: {index_dir}")
+        with open(os.path.join(snapshot_dir, cls.MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get("format_version") != Config.INDEX_FORMAT_VERSION:
+            raise ValueError(f"索引格式版本不兼容: {manifest.get('format_version')}")
+        
+        with open(os.path.join(snapshot_dir, cls.IDS_FILE), 'r', encoding='utf-8') as f:
+            ids = json.load(f)
+        
+        count, dim = manifest["count"], manifest["dim"]
+        if count == 0:
+            matrix = np.zeros((0, dim), dtype=np.float32)
+        else:
+            matrix = np.memmap(os.path.join(snapshot_dir, cls.MATRIX_FILE), dtype=np.float32, mode='r', shape=(count, dim))
+        manifest["snapshot_dir"] = snapshot_dir
+        return matrix, ids, manifest
+
+    @classmethod
+    def load_filters(cls, snapshot_dir):
+        """
+        加载快照的过滤区间 {field: {value: [[start, end), ...]}}
+        文件缺失或损坏时返回 {} (不支持过滤，不影响检索)
+        """
+        try:
+            with open(os.path.join(snapshot_dir, cls.FILTERS_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return {}
+
+    @classmethod
+    def mount(cls, db_connector, index_dir, model_name="", logger=None):
+        """
+        挂载当前快照，并把快照之后的变更回放为增量段 (仿真器与检索服务共用)
+        索引缺失或过期时: 变更量不超过 Config.DELTA_REPLAY_MAX_ROWS 则只回放，否则先导出新快照
+        返回: (search_engine, live_index, manifest, change_seq)
+            search_engine: 快照矩阵上的精确引擎；live_index: 叠加增量段的 IncrementalSearchEngine
+            change_seq: 已回放到的变更序号 (之后的变更从这里继续回放)
+        """
+        pending = 0
+        if not cls.is_fresh(index_dir, db_connector.db_path):
+            pending = cls.can_replay(index_dir, db_connector)
+            if pending is not None and pending <= Config.DELTA_REPLAY_MAX_ROWS:
+                if logger: logger(f"[Delta] 索引导出后有 {pending} 条切片变更，回放为增量段 (不重新导出)")
+            else:
+                if logger: logger(f"索引不存在或已过期，正在导出内存映射索引快照 -> {index_dir}")
+                cls.export(db_connector, index_dir, model_name=model_name, logger=logger)
+                pending = 0
+        matrix, ids, manifest = cls.load(index_dir)
+        
+        search_engine = VectorSearchEngine(matrix, ids=ids, normalized=manifest.get('normalized', False),
+                                           filter_ranges=cls.load_filters(manifest['snapshot_dir']))
+        live_index = IncrementalSearchEngine(search_engine, ids, search_engine.dim)
+        change_seq = manifest.get('change_seq', 0)
+        if pending:
+            upserts, deletes, change_seq = db_connector.fetch_changes_since(change_seq)
+            live_index.apply_changes(upserts, deletes)
+            if logger: logger(f"[Delta] 已回放 {len(upserts)} 条新增/更新、{len(deletes)} 条删除")
+        return search_engine, live_index, manifest, change_seq
+
+class VectorSearchEngine:
+    """
+    精确向量检索引擎 (矩阵化余弦相似度)
+    
+    持有一个 L2 归一化的 float32 矩阵 (可以直接是 VectorIndexStore 的 memmap)：
+    - 单条查询: 一次矩阵-向量乘积完成全量打分，argpartition 选出 Top-K 后只对 K 个结果排序
+    - 批量查询: 一次矩阵-矩阵乘积为多条查询同时打分
+    - 范围过滤: 按 filters.json 的行区间只对区间内的连续切片打分 (不是全量打分后再过滤)，
+      限定文档 / 章节的查询打分量随范围缩小
+    """
+    def __init__(self, matrix, ids=None, normalized=False, filter_ranges=None):
+        """
+        matrix: (count x dim) 向量矩阵
+        ids: 行号 -> chunk_uuid 映射 (可选)
+        normalized: 矩阵是否已经 L2 归一化 (VectorIndexStore 导出的矩阵为 True，避免复制 memmap)
+        filter_ranges: {field: {value: [[start, end), ...]}} (VectorIndexStore.load_filters，可选)
+        """
+        if normalized and isinstance(matrix, np.ndarray) and matrix.dtype == np.float32:
+            self.matrix = matrix
+        else:
+            self.matrix = self.normalize_rows(np.asarray(matrix, dtype=np.float32))
+        self.ids = list(ids) if ids is not None else None
+        self.filter_ranges = filter_ranges or {}
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dim(self):
+        return self.matrix.shape[1]
+
+    @property
+    def nbytes(self):
+        return int(self.matrix.nbytes)
+
+    @staticmethod
+    def normalize_rows(matrix):
+        """按行 L2 归一化 (零向量保持为零，打分恒为 0)"""
+        matrix = np.array(matrix, dtype=np.float32, ndmin=2)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+    @staticmethod
+    def _top_k_desc(scores, k):
+        """argpartition 选出 Top-K 下标，再只对这 K 个按分数降序排序"""
+        n = scores.shape[-1]
+        k = min(k, n)
+        if k <= 0:
+            return np.empty(0, dtype=np.int64)
+        if k < n:
+            idx = np.argpartition(-scores, k - 1)[:k]
+        else:
+            idx = np.arange(n)
+        return idx[np.argsort(-scores[idx], kind='stable')]
+
+    @staticmethod
+    def _union_ranges(ranges):
+        """合并重叠 / 相邻的行区间"""
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        return [(start, end) for start, end in merged]
+
+    @staticmethod
+    def _intersect_ranges(a, b):
+        """两个有序区间列表求交 (双指针)"""
+        result = []
+        i = j = 0
+        while i < len(a) and j < len(b):
+            start, end = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+            if start < end:
+                result.append((start, end))
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return result
+
+    def resolve_filters(self, filters):
+        """
+        filters: {'doc': 值或值列表, 'chapter': 值或值列表}
+        同一字段多个值取并集，不同字段取交集；值为空 (None / "" / []) 的字段忽略
+        返回: 有序行区间列表 [(start, end), ...]；没有生效的过滤条件时返回 None
+        """
+        result = None
+        for field, values in (filters or {}).items():
+            if values is None or values == "" or values == []:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            if field not in self.filter_ranges:
+                raise KeyError(f"索引不支持按 '{field}' 过滤")
+            value_ranges = self.filter_ranges[field]
+            ranges = self._union_ranges([r for v in values for r in value_ranges.get(v, [])])
+            result = ranges if result is None else self._intersect_ranges(result, ranges)
+        return result
+
+    def filter_values(self, field, filters=None):
+        """字段的可选取值；给定 filters 时只返回与其范围有交集的取值 (如某文档下的章节)"""
+        value_ranges = self.filter_ranges.get(field, {})
+        scope = self.resolve_filters(filters)
+        if scope is None:
+            return sorted(value_ranges)
+        return sorted(v for v, ranges in value_ranges.items()
+                      if self._intersect_ranges(scope, self._union_ranges(ranges)))
+
+    def _scoped_rows(self, ranges):
+        return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+    def search(self, query_vector, k=3, filters=None):
+        """
+        单条查询
+        filters: 文档 / 章节范围 (见 resolve_filters)，只对范围内的行打分
+        返回: [(row, score), ...] 按相似度降序，row 为矩阵行号
+        """
+        if len(self) == 0:
+            return []
+        q = self.normalize_rows(query_vector)[0]
+        ranges = self.resolve_filters(filters)
+        if ranges is None:
+            scores = self.matrix @ q
+            top = self._top_k_desc(scores, k)
+            return [(int(row), float(scores[row])) for row in top]
+        if not ranges:
+            return []
+        # 每个区间是矩阵的连续切片 (memmap 上不复制)，分段打分后拼接
+        scores = np.concatenate([self.matrix[start:end] @ q for start, end in ranges])
+        rows = self._scoped_rows(ranges)
+        top = self._top_k_desc(scores, k)
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+    def search_batch(self, query_vectors, k=3, batch_size=256, filters=None):
+        """
+        批量查询: 每 batch_size 条查询做一次矩阵-矩阵乘积，控制 (batch x count) 打分矩阵的内存
+        filters: 所有查询共用的文档 / 章节范围
+        返回: 与输入顺序一致的 [[(row, score), ...], ...]
+        """
+        queries = self.normalize_rows(query_vectors)
+        ranges = self.resolve_filters(filters)
+        if len(self) == 0 or ranges == []:
+            return [[] for _ in range(queries.shape[0])]
+        rows = self._scoped_rows(ranges) if ranges is not None else None
+        
+        results = []
+        for start in range(0, queries.shape[0], batch_size):
+            batch = queries[start:start + batch_size]
+            if ranges is None:
+                scores = batch @ self.matrix.T
+            else:
+                scores = np.hstack([batch @ self.matrix[s:e].T for s, e in ranges])
+            for row_scores in scores:
+                top = self._top_k_desc(row_scores, k)
+                if rows is None:
+                    results.append([(int(row), float(row_scores[row])) for row in top])
+                else:
+                    results.append([(int(rows[i]), float(row_scores[i])) for i in top])
+        return results
+
+    def get_id(self, row):
+        return self.ids[row] if self.ids is not None else row
+
+class IncrementalSearchEngine:
+    """
+    基础索引 + 内存增量段 + 墓碑 (入库后无需整库重载即可检索到新数据)
+
+    - base: 只读基础引擎 (VectorSearchEngine / ANN / 量化索引)，行号 0..N-1 与导出矩阵一致
+      构造时传入的精确引擎保留为 exact，带 filters 的查询总是走 exact (范围内精确打分)
+    - upsert: 新向量追加为一个增量段，行号从 N 开始递增且永不复用；同一 chunk_uuid 的旧行记为墓碑
+    - delete: 只记墓碑，不改基础索引文件
+    - search: 基础引擎多取 "基础墓碑数" 条后剔除墓碑，再与增量段的精确打分结果合并
+    - 增量段数超过 Config.DELTA_MAX_SEGMENTS 时在后台线程合并为一段，并丢弃其中已成墓碑的行
+    所有写操作在锁内替换 (而不是原地修改) 段列表，检索线程拿到的始终是一致的快照
+    """
+    def __init__(self, base, base_ids, dim):
+        self.base = base
+        self.exact = base
+        self.base_ids = base_ids
+        self.base_count = len(base_ids)
+        self.dim = dim
+        self._lock = threading.Lock()
+        # 增量段: [(rows, vectors, docs, chapters)]，rows 为全局行号 (int64)，vectors 已 L2 归一化
+        self._segments = []
+        self._next_row = self.base_count
+        self._delta_ids = {}        # 增量行号 -> chunk_uuid
+        self._live_rows = {}        # 变更过的 chunk_uuid -> 当前行号 (已删除为 None)
+        self._base_row_of_id = None  # 基础索引 chunk_uuid -> 行号 (首次变更时才构建)
+        self._tombstones = set()
+        self._base_dead = 0
+        self._live_count = self.base_count
+        self._compacting = False
+
+    def __len__(self):
+        return self._live_count
+
+    def __getitem__(self, row):
+        return self.get_id(row)
+
+    @property
+    def pending(self):
+        """相对基础索引的变更量 (增量行 + 墓碑)，用于判断是否值得重建基础索引"""
+        return (self._next_row - self.base_count) + len(self._tombstones)
+
+    def get_id(self, row):
+        if row < self.base_count:
+            return self.base_ids[row]
+        return self._delta_ids[row]
+
+    def _current_row(self, chunk_uuid):
+        if chunk_uuid in self._live_rows:
+            return self._live_rows[chunk_uuid]
+        if self._base_row_of_id is None:
+            self._base_row_of_id = {cid: row for row, cid in enumerate(self.base_ids)}
+        return self._base_row_of_id.get(chunk_uuid)
+
+    def _kill(self, row):
+        if row is None or row in self._tombstones:
+            return
+        self._tombstones.add(row)
+        self._live_count -= 1
+        if row < self.base_count:
+            self._base_dead += 1
+
+    def upsert(self, chunk_uuids, vectors, docs=None, chapters=None):
+        """追加 / 更新一批向量 (入库线程调用)"""
+        if not chunk_uuids:
+            return
+        vectors = VectorSearchEngine.normalize_rows(vectors)
+        if vectors.shape[1] != self.dim:
+            raise ValueError(f"向量维度 {vectors.shape[1]} 与索引维度 {self.dim} 不一致")
+        n = len(chunk_uuids)
+        docs = list(docs) if docs is not None else [""] * n
+        chapters = list(chapters) if chapters is not None else [""] * n
+        with self._lock:
+            rows = np.arange(self._next_row, self._next_row + n, dtype=np.int64)
+            for chunk_uuid, row in zip(chunk_uuids, rows):
+                self._kill(self._current_row(chunk_uuid))
+                self._live_rows[chunk_uuid] = int(row)
+                self._delta_ids[int(row)] = chunk_uuid
+            self._next_row += n
+            self._live_count += n
+            # 同一批内重复的 chunk_uuid: 只保留最后一次
+            for row in rows:
+                if self._live_rows[self._delta_ids[int(row)]] != row:
+                    self._kill(int(row))
+            self._segments = self._segments + [(rows, vectors, docs, chapters)]
+            need_compact = len(self._segments) > Config.DELTA_MAX_SEGMENTS and not self._compacting
+            if need_compact:
+                self._compacting = True
+        if need_compact:
+            threading.Thread(target=self.compact, daemon=True).start()
+
+    def apply_changes(self, upserts, deletes):
+        """写入 DBConnector.fetch_changes_since 的回放结果"""
+        if upserts:
+            self.upsert([u[0] for u in upserts], [u[1] for u in upserts],
+                        docs=[u[2] for u in upserts], chapters=[u[3] for u in upserts])
+        if deletes:
+            self.delete(deletes)
+
+    def delete(self, chunk_uuids):
+        with self._lock:
+            for chunk_uuid in chunk_uuids:
+                self._kill(self._current_row(chunk_uuid))
+                self._live_rows[chunk_uuid] = None
+
+    def compact(self):
+        """把当前所有增量段合并为一段，并物理丢弃其中已成墓碑的行 (后台线程调用)"""
+        try:
+            with self._lock:
+                segments = self._segments
+                tombstones = set(self._tombstones)
+            if not segments:
+                return
+            rows = np.concatenate([seg[0] for seg in segments])
+            keep = np.array([int(row) not in tombstones for row in rows], dtype=bool)
+            docs = [d for seg in segments for d in seg[2]]
+            chapters = [c for seg in segments for c in seg[3]]
+            merged = (
+                rows[keep],
+                np.concatenate([seg[1] for seg in segments])[keep],
+                [d for d, alive in zip(docs, keep) if alive],
+                [c for c, alive in zip(chapters, keep) if alive],
+            )
+            dropped = [int(row) for row in rows[~keep]]
+            with self._lock:
+                # 合并期间新追加的段原样保留在后面
+                self._segments = [merged] + self._segments[len(segments):]
+                for row in dropped:
+                    self._tombstones.discard(row)
+                    self._delta_ids.pop(row, None)
+        finally:
+            self._compacting = False
+
+    @staticmethod
+    def _segment_mask(segment, filters):
+        """增量段的文档 / 章节过滤 (增量行不在 filters.json 的区间里，按行比较)"""
+        mask = None
+        for field, values in (filters or {}).items():
+            if values is None or values == "" or values == []:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            column = segment[2] if field == "doc" else segment[3]
+            field_mask = np.array([v in values for v in column], dtype=bool)
+            mask = field_mask if mask is None else (mask & field_mask)
+        return mask
+
+    def search(self, query_vector, k=3, filters=None):
+        """返回: [(row, score), ...]，row 可能属于基础索引或增量段 (用 get_id 映射)"""
+        with self._lock:
+            segments = self._segments
+            tombstones = set(self._tombstones) if self._tombstones else None
+            base_dead = self._base_dead
+        q = VectorSearchEngine.normalize_rows(query_vector)[0]
+
+        candidates = []
+        if self.base_count:
+            if filters:
+                base_hits = self.exact.search(q, k=k + base_dead, filters=filters)
+            else:
+                base_hits = self.base.search(q, k=k + base_dead)
+            candidates.extend(h for h in base_hits if tombstones is None or h[0] not in tombstones)
+        for segment in segments:
+            rows, vectors = segment[0], segment[1]
+            scores = vectors @ q
+            mask = self._segment_mask(segment, filters)
+            if tombstones is not None:
+                alive = np.array([int(row) not in tombstones for row in rows], dtype=bool)
+                mask = alive if mask is None else (mask & alive)
+            if mask is not None:
+                rows, scores = rows[mask], scores[mask]
+            top = VectorSearchEngine._top_k_desc(scores, k)
+            candidates.extend((int(rows[i]), float(scores[i])) for i in top)
+        candidates.sort(key=lambda h: h[1], reverse=True)
+        return candidates[:k]
+
+class HybridRetriever:
+    """
+    混合检索: FTS5 全文 (bm25) 与向量 Top-K 并发执行，再做结果融合
+
+    - 两路在线程池中同时提交: 向量路 = 问题向量化 (API 往返) + 引擎检索，全文路 = search_fts
+      全文路耗时被向量化往返覆盖，不再是 "先 SQL、未命中再向量" 的串行流程
+    - 融合方式:
+      rrf:      score = Σ 1 / (rrf_k + rank)，只看名次，无需对齐两路分数量纲
+      weighted: 两路分数各自 min-max 归一化到 [0, 1] 后按 vector_weight 加权
+    - 问题中含文号 / 标准号等全库唯一的标识符时，chunk_identifiers 精确命中 (来源 id) 额外加 HYBRID_IDENTIFIER_BOOST，排在最前；
+      条款号 / 章节号只在过滤条件或文号限定的文档内命中，按一路全文信号计分
+    - 每条结果带来源 (id / fts / vector) 与各路的名次、原始分数
+    - 每次检索记录分阶段耗时，latency_stats() 给出最近窗口内的 p50 / p95
+    """
+    STAGES = ("id_ms", "fts_ms", "embed_ms", "vector_ms", "fusion_ms", "total_ms")
+
+    def __init__(self, db_connector, engine, ids, embed_fn, fusion=None, rrf_k=None, vector_weight=None,
+                 executor=None):
+        """
+        engine: 任意实现 search(q, k) -> [(row, score)] 的检索引擎 (精确 / ANN / 量化索引)
+        ids: 行号 -> chunk_uuid 映射 (与 engine 的矩阵行号对齐)
+        embed_fn: query -> 向量
+        executor: 外部共享的线程池 (检索服务跨快照复用，close 时不关闭)；为 None 时自建 2 线程的池
+        """
+        self.db_conn = db_connector
+        self.engine = engine
+        self.ids = ids
+        self.embed_fn = embed_fn
+        self.fusion = fusion or Config.HYBRID_FUSION
+        self.rrf_k = rrf_k or Config.HYBRID_RRF_K
+        self.vector_weight = Config.HYBRID_VECTOR_WEIGHT if vector_weight is None else vector_weight
+        self._owns_executor = executor is None
+        self.executor = executor or concurrent.futures.ThreadPoolExecutor(max_workers=2)
+        self.latencies = deque(maxlen=Config.HYBRID_LATENCY_WINDOW)
+
+    def _lexical(self, query, n, filters=None):
+        """标识符等值查询 + FTS 全文检索 (同一线程内顺序执行，前者是微秒级)"""
+        start_time = time.perf_counter()
+        # 条款号 / 章节号只在文档范围内有意义，范围取自过滤条件 (见 lookup_identifiers)
+        id_hits = self.db_conn.lookup_identifiers(query, limit=n, docs=(filters or {}).get('doc'))
+        id_done = time.perf_counter()
+        filters = filters or {}
+        hits = self.db_conn.search_fts(query, limit=n, docs=filters.get('doc'), chapters=filters.get('chapter'))
+        return id_hits, hits, (id_done - start_time) * 1000, (time.perf_counter() - id_done) * 1000
+
+    def _vector(self, query, n, query_vector=None, filters=None):
+        start_time = time.perf_counter()
+        if query_vector is None:
+            query_vector = self.embed_fn(query)
+        embed_done = time.perf_counter()
+        if filters:
+            hits = self.engine.search(query_vector, k=n, filters=filters)
+        else:
+            hits = self.engine.search(query_vector, k=n)
+        search_done = time.perf_counter()
+        hits = [(self.ids[row], row, score) for row, score in hits]
+        return hits, (embed_done - start_time) * 1000, (search_done - embed_done) * 1000
+
+    @staticmethod
+    def _match_filters(hit, filters):
+        """全文 / 标识符命中按文档 / 章节范围过滤 (候选数很少，直接在内存中比较)"""
+        for field, values in (filters or {}).items():
+            if values is None or values == "" or values == []:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            if (hit.get(field) or "") not in values:
+                return False
+        return True
+
+    @staticmethod
+    def _min_max(scores):
+        if not scores:
+            return []
+        lo, hi = min(scores), max(scores)
+        if hi - lo < 1e-12:
+            return [1.0] * len(scores)
+        return [(s - lo) / (hi - lo) for s in scores]
+
+    def _fuse(self, id_hits, fts_hits, vec_hits):
+        fused = {}
+
+        def entry(chunk_uuid):
+            if chunk_uuid not in fused:
+                fused[chunk_uuid] = {'id': chunk_uuid, 'row': None, 'score': 0.0, 'sources': [],
+                                     'id_rank': None, 'identifier': None,
+                                     'fts_rank': None, 'fts_score': None, 'fts_hit': None,
+                                     'vector_rank': None, 'vector_score': None}
+            return fused[chunk_uuid]
+
+        if self.fusion == "weighted":
+            fts_norm = self._min_max([h['score'] for h in fts_hits])
+            vec_norm = self._min_max([score for _, _, score in vec_hits])
+        for rank, hit in enumerate(id_hits, 1):
+            e = entry(hit['id'])
+            e.update(id_rank=rank, identifier=hit['identifier'], fts_hit=hit)
+            e['sources'].append("id")
+            if hit['kind'] in UNIQUE_IDENTIFIER_KINDS:
+                e['score'] += Config.HYBRID_IDENTIFIER_BOOST
+            elif self.fusion == "weighted":
+                # 条款号 / 章节号 (已限定在文档范围内) 只作为一路全文信号，不加置顶分
+                e['score'] += 1.0 - self.vector_weight
+            else:
+                e['score'] += 1.0 / (self.rrf_k + rank)
+        for rank, hit in enumerate(fts_hits, 1):
+            e = entry(hit['id'])
+            e.update(fts_rank=rank, fts_score=hit['score'], fts_hit=e['fts_hit'] or hit)
+            e['sources'].append("fts")
+            if self.fusion == "weighted":
+                e['score'] += (1.0 - self.vector_weight) * fts_norm[rank - 1]
+            else:
+                e['score'] += 1.0 / (self.rrf_k + rank)
+        for rank, (chunk_uuid, row, score) in enumerate(vec_hits, 1):
+            e = entry(chunk_uuid)
+            e.update(row=row, vector_rank=rank, vector_score=score)
+            e['sources'].append("vector")
+            if self.fusion == "weighted":
+                e['score'] += self.vector_weight * vec_norm[rank - 1]
+            else:
+                e['score'] += 1.0 / (self.rrf_k + rank)
+
+        return sorted(fused.values(), key=lambda e: e['score'], reverse=True)
+
+    def search(self, query, k=3, candidates=None, query_vector=None, filters=None):
+        """
+        candidates: 每一路召回的候选数 (默认 max(k, Config.HYBRID_CANDIDATES))
+        query_vector: 已有问题向量时直接传入，跳过向量化
+        filters: 文档 / 章节范围 (见 VectorSearchEngine.resolve_filters)，需要 engine 支持过滤
+        返回: (results, timings)
+            results: [{'id', 'row', 'score', 'sources', 'id_rank', 'identifier', 'fts_rank', 'fts_score',
+                       'fts_hit', 'vector_rank', 'vector_score'}]，row 为向量矩阵行号 (仅全文命中时为 None)
+            timings: {'id_ms', 'fts_ms', 'embed_ms', 'vector_ms', 'fusion_ms', 'total_ms'}
+        任一路异常时降级为另一路的结果，异常信息放在 timings['errors']
+        """
+        start_time = time.perf_counter()
+        n = max(k, candidates or Config.HYBRID_CANDIDATES)
+        fts_future = self.executor.submit(self._lexical, query, n, filters)
+        vec_future = self.executor.submit(self._vector, query, n, query_vector, filters)
+
+        timings = {stage: 0.0 for stage in self.STAGES}
+        errors = []
+        id_hits, fts_hits, vec_hits = [], [], []
+        try:
+            id_hits, fts_hits, timings['id_ms'], timings['fts_ms'] = fts_future.result()
+        except Exception as e:
+            errors.append(f"fts: {e}")
+        try:
+            vec_hits, timings['embed_ms'], timings['vector_ms'] = vec_future.result()
+        except Exception as e:
+            errors.append(f"vector: {e}")
+        if errors and not id_hits and not fts_hits and not vec_hits:
+            raise RuntimeError("; ".join(errors))
+
+        if filters:
+            id_hits = [h for h in id_hits if self._match_filters(h, filters)]
+            fts_hits = [h for h in fts_hits if self._match_filters(h, filters)]
+
+        fusion_start = time.perf_counter()
+        results = self._fuse(id_hits, fts_hits, vec_hits)[:k]
+        timings['fusion_ms'] = (time.perf_counter() - fusion_start) * 1000
+        timings['total_ms'] = (time.perf_counter() - start_time) * 1000
+        self.latencies.append(dict(timings))
+        if errors:
+            timings['errors'] = errors
+        return results, timings
+
+    def latency_stats(self):
+        """最近 Config.HYBRID_LATENCY_WINDOW 次检索的分阶段 p50 / p95 (ms)"""
+        if not self.latencies:
+            return {}
+        stats = {}
+        for stage in self.STAGES:
+            values = np.array([t[stage] for t in self.latencies])
+            stats[stage] = {'p50': float(np.percentile(values, 50)), 'p95': float(np.percentile(values, 95))}
+        return stats
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False)
@@ -16,8 +16,8 @@ class Config:
     SILICON_MODEL_NAME = "BAAI/bge-m3"
     
     # === 路径配置 ===
-    # Day 2 生成的输入文件
-    INPUT_JSON_PATH = "rag_corpus_for_embedding.json"
+    # Day 2 生成的输入语料 (JSONL，可为 .jsonl.gz / .jsonl.zst；旧版 .json 数组仍可读取)
+    INPUT_JSON_PATH = "rag_corpus_for_embedding.jsonl"
     # Day 3 输出的最终数据库
     DB_PATH = "rag_production.db"
     # Day 3 备份的含向量JSON
@@ -26,5 +26,121 @@ class Config:
     # === 向量化默认配置 ===
     DEFAULT_BATCH_SIZE = 8 # 默认批处理大小
     DEFAULT_CONCURRENCY = 2 # 默认并发数
+    # 流式入库流水线 (day3_stream_pipeline.py) 阶段间队列容量 (条)；批队列按 容量 / 批大小 折算
+    PIPELINE_QUEUE_SIZE = 256
+    # Day 3 入库时每个并发线程最多在途的批数 (有界提交窗口，内存占用与语料规模无关)
+    INGEST_INFLIGHT_PER_WORKER = 2
+
+    # === 近重复切片检测 (chunk_dedup.py，向量化之前) ===
+    # 开启后每个近重复簇只向量化代表切片，其余切片入库但不写向量
+    DEDUP_ENABLED = True
+    # MinHash 估计的 Jaccard 相似度阈值 (>= 即视为近重复)
+    DEDUP_THRESHOLD = 0.85
+    # 字符 shingle 长度、签名长度与 LSH 分段数 (DEDUP_NUM_PERM 须为 DEDUP_BANDS 的整数倍)
+    DEDUP_SHINGLE_SIZE = 5
+    DEDUP_NUM_PERM = 64
+    DEDUP_BANDS = 16
+    # 正文 (去空白后) 短于该长度的切片不参与检测
+    DEDUP_MIN_CHARS = 30
+    # 签名只保留最近 N 份文档 (LRU)，入库内存不随语料规模增长；同一文档的切片被隔开超过 N 份时不再互相比较
+    DEDUP_MAX_DOCS = 16
 
     EMBEDDING_DIM = 1024 # BGE-M3 维度
+
+    # === 查询向量缓存 (EmbeddingAdapter.embed_query) ===
+    # LRU 容量 (0 表示关闭缓存) 与条目有效期 (秒)
+    QUERY_CACHE_SIZE = 2048
+    QUERY_CACHE_TTL_SECONDS = 3600
+    # 查询向量化微批 (检索服务): 单批最大条数、最早请求的最长等待 (毫秒)、同时在途的批数
+    MICROBATCH_MAX_SIZE = 32
+    MICROBATCH_MAX_WAIT_MS = 5
+    MICROBATCH_CONCURRENCY = 4
+
+    # === 检索默认配置 ===
+    DEFAULT_TOP_K = 3 # 仿真器默认召回条数
+
+    # === 磁盘向量索引 (内存映射) 配置 ===
+    # 导出目录默认放在 DB 同级: rag_production.db -> rag_production.index/
+    INDEX_DIR_SUFFIX = ".index"
+    # 索引文件格式版本 (格式不兼容变更时递增)
+    # 2: 行按 (doc_title, chapter_title) 排序导出，新增 filters.json
+    # 3: 每次导出生成不可变快照 snapshots/v<版本>/，CURRENT 文件指向当前快照
+    INDEX_FORMAT_VERSION = 3
+    # 保留的快照数 (含当前快照)；更早的快照在新快照发布后清理
+    INDEX_KEEP_SNAPSHOTS = 2
+
+    # === ANN (IVF) 索引配置 ===
+    # IVF 文件存放在索引目录下的子目录: rag_production.index/ivf/
+    IVF_SUBDIR = "ivf"
+    # 默认探查的倒排列表数 (越大召回越高、延迟越大)
+    IVF_DEFAULT_NPROBE = 8
+
+    # === 标量量化 (SQ) 索引配置 ===
+    # 量化检索的默认重排倍数: 先取 k * N 条候选，再用 float32 原始向量精确打分 (0 = 不重排)
+    SQ_DEFAULT_RERANK = 4
+
+    # === 乘积量化 (PQ / IVF-PQ) 索引配置 ===
+    # 子空间数: 1024 维 / 64 = 每段 16 维，每条向量 64 字节 (float32 为 4096 字节)
+    PQ_DEFAULT_M = 64
+    # 码本训练最多抽样的向量条数
+    PQ_TRAIN_POINTS = 65536
+
+    # === 二值 (1-bit) 预筛索引配置 ===
+    # Hamming 预筛保留的候选数，随后用 float32 原始向量精确重排
+    BINARY_CANDIDATES = 256
+
+    # === 全文索引 (FTS5) 配置 ===
+    # 与 chunks_full_index 通过触发器同步的虚表名
+    FTS_TABLE = "chunks_fts"
+    # trigram: 按 3 字符滑窗切分，适合中文与文号 / 编号 (需 SQLite >= 3.34)
+    FTS_TOKENIZER = "trigram"
+
+    # === 混合检索 (FTS + 向量) 配置 ===
+    # 融合方式: "rrf" (倒数排名融合) 或 "weighted" (min-max 归一化后加权)
+    HYBRID_FUSION = "rrf"
+    # RRF 平滑常数 (经验值 60)
+    HYBRID_RRF_K = 60
+    # weighted 融合中向量分数的权重 (全文分数权重为 1 - 该值)
+    HYBRID_VECTOR_WEIGHT = 0.5
+    # 每一路召回的候选数
+    HYBRID_CANDIDATES = 20
+    # 分阶段耗时统计窗口 (最近 N 次检索)
+    HYBRID_LATENCY_WINDOW = 200
+    # 交互式检索的 p95 延迟预算 (ms)，超出时仿真器给出提示
+    HYBRID_LATENCY_BUDGET_MS = 300
+    # 全库唯一标识符 (文号 / 标准号 / ICS / 工作号) 精确命中的加分，保证排在 RRF / 加权分数之前
+    HYBRID_IDENTIFIER_BOOST = 1.0
+
+    # === 懒加载文本 (精简常驻内存) 配置 ===
+    # True: 挂载时只常驻向量矩阵 (memmap) 与行号 -> chunk_uuid 映射，Top-K 的文本按主键回表拉取
+    # False: 挂载时把全部切片文本读入内存 (小库调试用)
+    LAZY_TEXT_HYDRATION = True
+    # 懒加载模式下多召回的条数 (回表时可能有 pure_text 损坏的行被丢弃)
+    LAZY_FETCH_MARGIN = 5
+
+    # === 增量索引配置 ===
+    # 增量段数超过该值时在后台合并为一段
+    DELTA_MAX_SEGMENTS = 8
+    # 挂载时待回放的变更切片数不超过该值则只回放增量，否则重新导出基础索引
+    DELTA_REPLAY_MAX_ROWS = 50000
+
+    # === 检索服务配置 (day3_search_service.py) ===
+    SERVICE_HOST = "127.0.0.1"
+    SERVICE_PORT = 8765
+    # 单个请求的批量查询条数与 k 的上限
+    SERVICE_MAX_BATCH = 64
+    SERVICE_MAX_K = 100
+    # 混合检索共享线程池大小 (每个检索占 2 个线程: 全文路 + 向量路)
+    SERVICE_HYBRID_WORKERS = 16
+    # /stats 统计的最近请求数
+    SERVICE_LATENCY_WINDOW = 1000
+    # 轮询 chunk_changes 回放增量的间隔 (秒)，0 表示只在 /reload 时更新
+    SERVICE_CHANGE_POLL_SECONDS = 5
+
+# 命令行入口 (检索服务 / 流式入库 / 索引工具) 的 --provider 选项 -> 向量化接口配置 (取值时读取 Config，便于运行时覆盖)
+PROVIDERS = {
+    "intranet": lambda: {"name": "Intranet", "url": Config.INTRANET_API_URL,
+                         "key": Config.INTRANET_API_KEY, "model": Config.INTRANET_MODEL_NAME},
+    "silicon": lambda: {"name": "SiliconFlow", "url": Config.SILICON_API_URL,
+                        "key": Config.SILICON_API_KEY, "model": Config.SILICON_MODEL_NAME},
+}
@@ -0,0 +1,355 @@
+# day3_index_cli.py
+"""
+Day 3 向量索引命令行工具 (无 GUI)
+
+用法示例:
+    python day3_index_cli.py export --db rag_production.db
+    python day3_index_cli.py build-ann --type ivf --db rag_production.db --nlist 1024
+    python day3_index_cli.py bench-ann --type ivf --db rag_production.db --nprobe 1,4,16,64
+    python day3_index_cli.py bench-ann --type sq8 --db rag_production.db --rerank 0,4,10
+    python day3_index_cli.py train-pq --type ivfpq --db rag_production.db --m 64 --nlist 4096
+    python day3_index_cli.py encode-pq --type ivfpq --db rag_production.db
+    python day3_index_cli.py bench-ann --type ivfpq --db rag_production.db --nprobe 8,32 --rerank 0,10
+    python day3_index_cli.py backfill-fts --db rag_production.db
+    python day3_index_cli.py search-fts --db rag_production.db "国航发〔2023〕"
+    python day3_index_cli.py backfill-identifiers --db rag_production.db
+    python day3_index_cli.py lookup-id --db rag_production.db "国航发〔2023〕12号"
+    python day3_index_cli.py bench-ann --type binary --db rag_production.db --candidates 64,256,1024
+    python day3_index_cli.py list-docs --db rag_production.db
+    python day3_index_cli.py delete-doc --db rag_production.db "关于修订XX规定的通知.pdf"
+    python day3_index_cli.py replace-doc --db rag_production.db --corpus rag_corpus_for_embedding.jsonl "关于修订XX规定的通知.pdf"
+"""
+import argparse
+import itertools
+import os
+import time
+import numpy as np
+from day3_config import Config, PROVIDERS
+from day3_backend import DBConnector, EmbeddingAdapter, VectorIndexStore, VectorSearchEngine
+from day3_ann_index import (IVFIndex, PQIndex, IVFPQIndex, ANN_INDEX_TYPES, load_or_build_ann,
+                            benchmark_recall, sample_benchmark_queries)
+from corpus_io import iter_corpus
+from chunk_dedup import ChunkDeduplicator
+
+# bench-ann 对每种索引扫描的检索参数
+BENCH_PARAMS = {
+    "ivf": ("nprobe",),
+    "sq8": ("rerank",),
+    "fp16": ("rerank",),
+    "pq": ("rerank",),
+    "ivfpq": ("nprobe", "rerank"),
+    "binary": ("candidates",),
+}
+
+def cmd_export(args):
+    """从 DB 导出内存映射索引快照 (snapshots/v<版本>/)，发布为当前快照并清理旧快照"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    db_conn = DBConnector(args.db)
+    index_dir = args.out or VectorIndexStore.default_dir(args.db)
+    manifest = VectorIndexStore.export(db_conn, index_dir, model_name=args.model, logger=print)
+    VectorIndexStore.gc_snapshots(index_dir, keep=args.keep, logger=print)
+    print(f"[Done] 版本 {manifest['version']} | {manifest['count']} 条 x {manifest['dim']} 维 | 模型: {manifest['model']}")
+    return 0
+
+def _load_base_index(args):
+    """
+    加载 (必要时先导出) 内存映射索引的当前快照
+    返回 (snapshot_dir, matrix, ids, manifest)；ANN 索引构建在快照目录下
+    """
+    index_dir = args.index_dir or VectorIndexStore.default_dir(args.db)
+    if not VectorIndexStore.is_fresh(index_dir, args.db):
+        print(f"[Index] 索引不存在或已过期，先从 DB 导出 -> {index_dir}")
+        VectorIndexStore.export(DBConnector(args.db), index_dir, model_name=args.model, logger=print)
+    matrix, ids, manifest = VectorIndexStore.load(index_dir)
+    return manifest['snapshot_dir'], matrix, ids, manifest
+
+def _load_queries(args, matrix):
+    """查询向量: --queries 指定的 .npy 文件，否则从库内抽样加扰动"""
+    if args.queries:
+        return np.load(args.queries)
+    return sample_benchmark_queries(matrix, n_queries=args.n_queries)
+
+def cmd_build_ann(args):
+    """构建 ANN / 量化索引 (IVF / SQ8 / FP16)，保存到索引目录的对应子目录"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    index_dir, matrix, ids, manifest = _load_base_index(args)
+    if manifest['count'] == 0:
+        print(f"错误: 索引中没有向量 ({args.type} 需要先完成 Day 3 向量化入库): {args.db}")
+        return 1
+    if args.type == "ivf":
+        # IVF 支持自定义 nlist / 迭代次数
+        ivf = IVFIndex.build(matrix, nlist=args.nlist, n_iter=args.iters, logger=print)
+        ivf.save(IVFIndex.default_dir(index_dir), source_version=manifest['version'])
+    else:
+        load_or_build_ann(args.type, index_dir, matrix, manifest, logger=print, rebuild=True)
+    print(f"[Done] {args.type} 索引已保存 -> {index_dir}")
+    return 0
+
+def cmd_bench_ann(args):
+    """对比精确检索，报告 ANN / 量化索引在不同参数下的 recall@k / 延迟 / QPS / 内存"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    index_dir, matrix, ids, manifest = _load_base_index(args)
+    if manifest['count'] == 0:
+        print(f"错误: 索引中没有向量 ({args.type} 需要先完成 Day 3 向量化入库): {args.db}")
+        return 1
+    index = load_or_build_ann(args.type, index_dir, matrix, manifest, logger=print)
+
+    exact = VectorSearchEngine(matrix, ids=ids, normalized=True)
+    queries = _load_queries(args, matrix)
+    print(f"[Bench] 语料 {len(exact)} 条 | 查询 {len(queries)} 条 | 类型 {args.type} | k={args.k} | "
+          f"float32 矩阵 {exact.nbytes / 1024 / 1024:.1f} MB")
+
+    param_names = BENCH_PARAMS.get(args.type, ())
+    grids = [[int(x) for x in getattr(args, name).split(",")] for name in param_names]
+    for values in itertools.product(*grids):
+        benchmark_recall(exact, index, queries, k=args.k, search_kwargs=dict(zip(param_names, values)), logger=print)
+    return 0
+
+def cmd_train_pq(args):
+    """训练 PQ / IVF-PQ 码本并编码全量向量"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    index_dir, matrix, ids, manifest = _load_base_index(args)
+    if manifest['count'] == 0:
+        print(f"错误: 索引中没有向量 ({args.type} 需要先完成 Day 3 向量化入库): {args.db}")
+        return 1
+    if args.type == "pq":
+        index = PQIndex.build(matrix, m=args.m, n_iter=args.iters, max_train_points=args.train_size, logger=print)
+    else:
+        index = IVFPQIndex.build(matrix, nlist=args.nlist, m=args.m, n_iter=args.iters,
+                                 max_train_points=args.train_size, logger=print)
+    pq_dir = os.path.join(index_dir, ANN_INDEX_TYPES[args.type][0])
+    index.save(pq_dir, source_version=manifest['version'])
+    print(f"[Done] {args.type} 索引已保存 -> {pq_dir} | {index.nbytes / 1024 / 1024:.1f} MB "
+          f"(float32: {matrix.shape[0] * matrix.shape[1] * 4 / 1024 / 1024:.1f} MB)")
+    return 0
+
+def cmd_encode_pq(args):
+    """复用已训练的码本 (及 IVF 质心)，对当前导出的全量向量重新编码，不重新训练"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    index_dir, matrix, ids, manifest = _load_base_index(args)
+    if manifest['count'] == 0:
+        print(f"错误: 索引中没有向量 ({args.type} 需要先完成 Day 3 向量化入库): {args.db}")
+        return 1
+    pq_dir = os.path.join(index_dir, ANN_INDEX_TYPES[args.type][0])
+    if args.type == "pq":
+        trained = PQIndex.load(pq_dir)
+        index = PQIndex.build(matrix, pq=trained.pq, logger=print)
+    else:
+        trained = IVFPQIndex.load(pq_dir)
+        index = IVFPQIndex.build(matrix, centroids=trained.centroids, pq=trained.pq, logger=print)
+    index.save(pq_dir, source_version=manifest['version'])
+    print(f"[Done] {args.type} 已按现有码本重新编码 {len(index)} 条 -> {pq_dir}")
+    return 0
+
+def cmd_backfill_fts(args):
+    """为已有数据库回填 / 重建 FTS5 全文索引"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    db_conn = DBConnector(args.db)
+    if not db_conn.fts_available:
+        print("错误: 当前 SQLite 不支持 FTS5 trigram 分词器 (需 >= 3.34)")
+        return 1
+    db_conn.backfill_fts(logger=print)
+    return 0
+
+def cmd_search_fts(args):
+    """全文索引精确查询 (编号 / 短语)，打印命中与耗时"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    db_conn = DBConnector(args.db)
+    start_time = time.perf_counter()
+    hits = db_conn.search_fts(args.query, limit=args.limit)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    print(f"[FTS] '{args.query}' 命中 {len(hits)} 条 ({elapsed_ms:.2f}ms)")
+    for rank, hit in enumerate(hits, 1):
+        print(f"  {rank}. [{hit['score']:.3f}] {hit['doc']} / {hit['chapter']} | {hit['pure_text'][:60]}")
+    return 0
+
+def cmd_backfill_identifiers(args):
+    """为已有数据库回填 / 重建标识符索引 (chunk_identifiers)"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    DBConnector(args.db).backfill_identifiers(logger=print)
+    return 0
+
+def cmd_lookup_id(args):
+    """按问题中的文号 / 编号精确查询，打印命中与耗时"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    db_conn = DBConnector(args.db)
+    start_time = time.perf_counter()
+    hits = db_conn.lookup_identifiers(args.query, limit=args.limit, docs=args.doc)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    print(f"[Identifier] '{args.query}' 命中 {len(hits)} 条 ({elapsed_ms:.2f}ms)")
+    for rank, hit in enumerate(hits, 1):
+        print(f"  {rank}. [{hit['kind']}: {hit['identifier']}] {hit['doc']} / {hit['chapter']} | {hit['pure_text'][:60]}")
+    return 0
+
+def cmd_list_docs(args):
+    """列出库中文档及其切片数 / 已向量化切片数"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    docs = DBConnector(args.db).list_documents()
+    for doc_title, count, embedded in docs:
+        print(f"  {doc_title} | {count} 切片 | 已向量化 {embedded}")
+    print(f"[Docs] 共 {len(docs)} 个文档")
+    return 0
+
+def cmd_delete_doc(args):
+    """按文档删除切片 (单事务)；运行中的仿真器 / 检索服务经变更日志以墓碑形式同步"""
+    if not os.path.exists(args.db):
+        print(f"错误: 找不到文件 {args.db}")
+        return 1
+    start_time = time.perf_counter()
+    deleted = DBConnector(args.db).delete_document(args.doc)
+    elapsed_ms = (time.perf_counter() - start_time) * 1000
+    if not deleted:
+        print(f"[Doc] 库中没有文档《{args.doc}》")
+        return 1
+    print(f"[Doc] 已删除《{args.doc}》: {len(deleted)} 个切片 ({elapsed_ms:.1f}ms)")
+    return 0
+
+def cmd_replace_doc(args):
+    """用语料中该文档的最新切片重新向量化并整体替换 (旧切片删除与新切片写入同一事务)"""
+    if not os.path.exists(args.db) or not os.path.exists(args.corpus):
+        print(f"错误: 找不到文件 {args.db if not os.path.exists(args.db) else args.corpus}")
+        return 1
+    records = [r for r in iter_corpus(args.corpus) if r.get('metadata', {}).get('doc_title') == args.doc]
+    if not records:
+        print(f"错误: 语料中没有文档《{args.doc}》的切片")
+        return 1
+    adapter = EmbeddingAdapter(use_mock=args.mock)
+    provider_config = PROVIDERS[args.provider]()
+    start_time = time.perf_counter()
+    # 文档内的近重复切片只向量化代表切片
+    dedup = ChunkDeduplicator() if Config.DEDUP_ENABLED and not args.no_dedup else None
+    targets = dedup.mark(records) if dedup is not None else records
+    for i in range(0, len(targets), args.batch_size):
+        batch = targets[i:i + args.batch_size]
+        vectors = adapter.get_embeddings([r['embedding_text'] for r in batch], provider_config=provider_config)
+        for record, vector in zip(batch, vectors):
+            record['embedding'] = vector
+    for record in records:
+        path_list = record.get('metadata', {}).get('section_path', [])
+        record['chapter_title_temp'] = path_list[1] if len(path_list) > 1 else ""
+        record['sub_title_temp'] = path_list[2] if len(path_list) > 2 else ""
+    embed_seconds = time.perf_counter() - start_time
+    if dedup is not None:
+        print(dedup.summary())
+    deleted, inserted = DBConnector(args.db).replace_document(args.doc, records)
+    print(f"[Doc] 已替换《{args.doc}》: 写入 {len(inserted)} 个切片, 删除 {len(deleted)} 个旧切片 "
+          f"(向量化 {embed_seconds:.2f}s, 总计 {time.perf_counter() - start_time:.2f}s)")
+    return 0
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Day 3 向量索引工具")
+    sub = parser.add_subparsers(dest="command")
+    sub.required = True
+
+    p_export = sub.add_parser("export", help="导出内存映射向量索引")
+    p_export.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_export.add_argument("--out", default=None, help="索引目录 (默认: DB 同级 .index 目录)")
+    p_export.add_argument("--model", default=Config.INTRANET_MODEL_NAME, help="写入 manifest 的模型名")
+    p_export.add_argument("--keep", type=int, default=Config.INDEX_KEEP_SNAPSHOTS, help="保留的快照数 (含当前快照)")
+    p_export.set_defaults(func=cmd_export)
+
+    p_ann = sub.add_parser("build-ann", help="构建 ANN / 量化索引")
+    p_ann.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_ann.add_argument("--index-dir", default=None, help="索引目录 (默认: DB 同级 .index 目录)")
+    p_ann.add_argument("--model", default=Config.INTRANET_MODEL_NAME, help="写入 manifest 的模型名")
+    p_ann.add_argument("--type", choices=sorted(ANN_INDEX_TYPES), default="ivf", help="索引类型")
+    p_ann.add_argument("--nlist", type=int, default=None, help="[ivf] 倒排列表数 (默认约 4*sqrt(N))")
+    p_ann.add_argument("--iters", type=int, default=20, help="[ivf] k-means 迭代次数")
+    p_ann.set_defaults(func=cmd_build_ann)
+
+    p_bench = sub.add_parser("bench-ann", help="ANN / 量化索引与精确检索的 recall@k / 延迟 / 内存对比")
+    p_bench.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_bench.add_argument("--index-dir", default=None, help="索引目录 (默认: DB 同级 .index 目录)")
+    p_bench.add_argument("--model", default=Config.INTRANET_MODEL_NAME, help="写入 manifest 的模型名")
+    p_bench.add_argument("--type", choices=sorted(ANN_INDEX_TYPES), default="ivf", help="索引类型")
+    p_bench.add_argument("--nprobe", default="1,4,8,16,32", help="[ivf] 逗号分隔的 nprobe 取值")
+    p_bench.add_argument("--rerank", default="0,2,4,10", help="[sq8/fp16/pq/ivfpq] 逗号分隔的重排倍数 (0 = 不重排)")
+    p_bench.add_argument("--candidates", default="64,128,256,512", help="[binary] 逗号分隔的 Hamming 预筛候选数")
+    p_bench.add_argument("--k", type=int, default=10, help="recall@k 的 k")
+    p_bench.add_argument("--queries", default=None, help="查询向量 .npy 文件 (nq x dim)")
+    p_bench.add_argument("--n-queries", type=int, default=200, help="未指定查询文件时的抽样查询数")
+    p_bench.set_defaults(func=cmd_bench_ann)
+
+    p_train = sub.add_parser("train-pq", help="训练 PQ / IVF-PQ 码本并编码")
+    p_train.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_train.add_argument("--index-dir", default=None, help="索引目录 (默认: DB 同级 .index 目录)")
+    p_train.add_argument("--model", default=Config.INTRANET_MODEL_NAME, help="写入 manifest 的模型名")
+    p_train.add_argument("--type", choices=["pq", "ivfpq"], default="ivfpq", help="索引类型")
+    p_train.add_argument("--m", type=int, default=Config.PQ_DEFAULT_M, help="子空间数 (每条向量字节数)")
+    p_train.add_argument("--nlist", type=int, default=None, help="[ivfpq] 倒排列表数 (默认约 4*sqrt(N))")
+    p_train.add_argument("--iters", type=int, default=15, help="k-means 迭代次数")
+    p_train.add_argument("--train-size", type=int, default=Config.PQ_TRAIN_POINTS, help="训练抽样条数")
+    p_train.set_defaults(func=cmd_train_pq)
+
+    p_encode = sub.add_parser("encode-pq", help="用已训练码本重新编码当前语料 (不重新训练)")
+    p_encode.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_encode.add_argument("--index-dir", default=None, help="索引目录 (默认: DB 同级 .index 目录)")
+    p_encode.add_argument("--model", default=Config.INTRANET_MODEL_NAME, help="写入 manifest 的模型名")
+    p_encode.add_argument("--type", choices=["pq", "ivfpq"], default="ivfpq", help="索引类型")
+    p_encode.set_defaults(func=cmd_encode_pq)
+
+    p_fts = sub.add_parser("backfill-fts", help="为已有数据库回填 / 重建 FTS5 全文索引")
+    p_fts.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_fts.set_defaults(func=cmd_backfill_fts)
+
+    p_fts_q = sub.add_parser("search-fts", help="全文索引精确查询 (编号 / 短语)")
+    p_fts_q.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_fts_q.add_argument("--limit", type=int, default=10, help="最多返回条数")
+    p_fts_q.add_argument("query", help="查询串，空格分隔的词需同时出现")
+    p_fts_q.set_defaults(func=cmd_search_fts)
+
+    p_id = sub.add_parser("backfill-identifiers", help="为已有数据库回填 / 重建文号 / 编号标识符索引")
+    p_id.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_id.set_defaults(func=cmd_backfill_identifiers)
+
+    p_id_q = sub.add_parser("lookup-id", help="按文号 / 编号精确查询")
+    p_id_q.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_id_q.add_argument("--limit", type=int, default=10, help="最多返回条数")
+    p_id_q.add_argument("--doc", action="append", help="限定文档 (可重复)；条款号 / 章节号只在限定文档或同时给出文号时查询")
+    p_id_q.add_argument("query", help="含标识符的查询串，如 \"国航发〔2023〕12号\"")
+    p_id_q.set_defaults(func=cmd_lookup_id)
+
+    p_docs = sub.add_parser("list-docs", help="列出库中文档")
+    p_docs.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_docs.set_defaults(func=cmd_list_docs)
+
+    p_del = sub.add_parser("delete-doc", help="按文档删除切片 (向量 / 全文 / 标识符一并删除)")
+    p_del.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_del.add_argument("doc", help="文档名 (doc_title)")
+    p_del.set_defaults(func=cmd_delete_doc)
+
+    p_rep = sub.add_parser("replace-doc", help="用语料中的最新切片重新向量化并替换一个文档")
+    p_rep.add_argument("--db", default=Config.DB_PATH, help="源数据库路径")
+    p_rep.add_argument("--corpus", default=Config.INPUT_JSON_PATH, help="Day 2 语料 (.jsonl / .jsonl.gz / 旧版 .json)")
+    p_rep.add_argument("--provider", choices=sorted(PROVIDERS), default="intranet", help="向量化接口")
+    p_rep.add_argument("--mock", action="store_true", help="使用随机向量 (调试用)")
+    p_rep.add_argument("--batch-size", type=int, default=Config.DEFAULT_BATCH_SIZE, help="每次向量化请求的切片数")
+    p_rep.add_argument("--no-dedup", action="store_true", help="关闭近重复切片检测 (每条切片都向量化)")
+    p_rep.add_argument("doc", help="文档名 (doc_title)")
+    p_rep.set_defaults(func=cmd_replace_doc)
+
+    return parser
+
+if __name__ == "__main__":
+    args = build_arg_parser().parse_args()
+    raise SystemExit(args.func(args))
@@ -1,17 +1,31 @@
 # day3_rag_simulator.py
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import json
 import os
 import threading
 import queue
-import numpy as np
 import concurrent.futures
 from datetime import datetime
 from day3_config import Config
-from day3_backend import EmbeddingAdapter, DBConnector
+from day3_backend import EmbeddingAdapter, DBConnector, VectorIndexStore, HybridRetriever
+from day3_ann_index import load_or_build_ann
+from corpus_io import count_records, iter_batches
+from chunk_dedup import ChunkDeduplicator
 
 class RAGSimulatorGUI:
+    # 引擎下拉框 -> ANN / 量化索引类型 (None 表示精确检索)
+    ENGINE_CHOICES = {
+        "Exact (精确)": None,
+        "IVF (ANN)": "ivf",
+        "SQ8 (int8)": "sq8",
+        "FP16": "fp16",
+        "PQ": "pq",
+        "IVF-PQ": "ivfpq",
+        "Binary (1-bit)": "binary",
+    }
+    # 范围过滤下拉框中 "不过滤" 的选项
+    FILTER_ALL = "(全部)"
+
     def __init__(self, root):
         self.root = root
         self.root.title("Day 3: RAG 仿真器 & 向量仓库 (双通道版: Intranet/SiliconFlow)")
@@ -26,8 +40,28 @@ class RAGSimulatorGUI:
         # Adapter 是我们的"翻译官"，负责调用 API
         self.adapter = EmbeddingAdapter(use_mock=False) 
         
-        # 仿真器内存：从 DB 加载的向量和元数据将缓存在这里
+        # 仿真器内存：从 DB 加载的元数据将缓存在这里 (与检索引擎矩阵按行号对齐)
+        # 懒加载模式 (Config.LAZY_TEXT_HYDRATION) 下为空，Top-K 文本按主键回表
         self.memory_vectors = []
+        self.lazy_text = Config.LAZY_TEXT_HYDRATION
+        # 检索引擎：持有 L2 归一化的 float32 向量矩阵
+        self.search_engine = None
+        # ANN / 量化索引 (IVF / SQ8 / FP16)：按需从 .index/ 子目录加载或构建
+        self.ann_index = None
+        self.ann_kind = None
+        # 当前挂载的索引信息 (用于按需构建 ANN 索引)
+        self.index_dir = None
+        self.index_manifest = None
+        # 元数据缺失的行数 (召回时多取这么多条再过滤)
+        self.skip_count = 0
+        # 混合检索 (FTS + 向量并发，RRF 融合)；chunk_uuid -> 矩阵行号，用于全文命中回查元数据
+        self.hybrid = None
+        self.row_by_id = {}
+        # 增量索引: 基础引擎 + 入库后追加的内存增量段 / 墓碑，新数据无需整库重载即可检索
+        self.live_index = None
+        # 热切换: 后台准备新快照时置位；swap_lock 保护增量写入与状态替换
+        self._reloading = False
+        self.swap_lock = threading.Lock()
         
         self._init_ui()
         
@@ -120,9 +154,53 @@ class RAGSimulatorGUI:
         self.query_entry.pack(side="left", fill="x", expand=True, padx=10)
         self.query_entry.bind("<Return>", lambda event: self.run_simulation())
         
+        tk.Label(search_box, text="引擎:").pack(side="left")
+        self.engine_var = tk.StringVar(value="Exact (精确)")
+        self.engine_combo = ttk.Combobox(search_box, textvariable=self.engine_var, state="readonly", width=12)
+        self.engine_combo['values'] = tuple(self.ENGINE_CHOICES)
+        self.engine_combo.pack(side="left", padx=2)
+        self.engine_combo.bind("<<ComboboxSelected>>", lambda event: self._ensure_ann_index())
+        
+        tk.Label(search_box, text="nprobe:").pack(side="left")
+        self.nprobe_spin = tk.Spinbox(search_box, from_=1, to=1024, width=4)
+        self.nprobe_spin.delete(0, "end")
+        self.nprobe_spin.insert(0, Config.IVF_DEFAULT_NPROBE)
+        self.nprobe_spin.pack(side="left", padx=2)
+        
+        tk.Label(search_box, text="重排:").pack(side="left")
+        self.rerank_spin = tk.Spinbox(search_box, from_=0, to=100, width=4)
+        self.rerank_spin.delete(0, "end")
+        self.rerank_spin.insert(0, Config.SQ_DEFAULT_RERANK)
+        self.rerank_spin.pack(side="left", padx=2)
+        
+        tk.Label(search_box, text="Top-K:").pack(side="left")
+        self.top_k_spin = tk.Spinbox(search_box, from_=1, to=50, width=4)
+        self.top_k_spin.delete(0, "end")
+        self.top_k_spin.insert(0, Config.DEFAULT_TOP_K)
+        self.top_k_spin.pack(side="left", padx=5)
+        
+        self.hybrid_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(search_box, text="混合(FTS+向量)", variable=self.hybrid_var).pack(side="left", padx=2)
+        
         btn_search = tk.Button(search_box, text="🔍 计算相似度召回", bg="#28a745", fg="white", font=("Arial", 11, "bold"), command=self.run_simulation)
         btn_search.pack(side="left")
 
+        # --- 检索范围过滤 (只对选中文档 / 章节的行打分) ---
+        filter_box = tk.Frame(sim_frame)
+        filter_box.pack(fill="x", pady=2)
+        tk.Label(filter_box, text="范围 - 文档:").pack(side="left")
+        self.doc_filter_var = tk.StringVar(value=self.FILTER_ALL)
+        self.doc_filter_combo = ttk.Combobox(filter_box, textvariable=self.doc_filter_var, state="readonly", width=40)
+        self.doc_filter_combo['values'] = (self.FILTER_ALL,)
+        self.doc_filter_combo.pack(side="left", padx=5)
+        self.doc_filter_combo.bind("<<ComboboxSelected>>", lambda event: self._refresh_chapter_filter())
+        tk.Label(filter_box, text="章节:").pack(side="left")
+        self.chapter_filter_var = tk.StringVar(value=self.FILTER_ALL)
+        self.chapter_filter_combo = ttk.Combobox(filter_box, textvariable=self.chapter_filter_var, state="readonly", width=40)
+        self.chapter_filter_combo['values'] = (self.FILTER_ALL,)
+        self.chapter_filter_combo.pack(side="left", padx=5)
+        tk.Button(filter_box, text="🗑 删除所选文档", command=self.delete_selected_document).pack(side="left", padx=5)
+
         # 结果显示区
         self.result_area = scrolledtext.ScrolledText(sim_frame, font=("Segoe UI", 10), height=15)
         self.result_area.pack(fill="both", expand=True)
@@ -164,8 +242,16 @@ class RAGSimulatorGUI:
                 elif msg_type == "STATUS_DONE":
                     messagebox.showinfo("完成", content)
                     self.btn_ingest.config(state="normal")
-                    # 入库完成后，自动刷新
-                    self.reload_memory_db() 
+                    # 新数据已在入库时写入增量段，无需整库重载；尚未挂载索引时才刷新
+                    if self.live_index is not None:
+                        self.log(f"[Delta] 新数据已可检索 (相对基础索引 {self.live_index.pending} 条增量/墓碑)，"
+                                 f"下次挂载时回放或重建基础索引")
+                    else:
+                        self.reload_memory_db()
+                
+                elif msg_type == "SWAP":
+                    # 后台准备好的新快照，在主线程替换检索状态
+                    self._swap_index(content)
                 
                 elif msg_type == "ERROR":
                     messagebox.showerror("错误", content)
@@ -178,7 +264,7 @@ class RAGSimulatorGUI:
 
     # --- 文件选择辅助 ---
     def browse_json_file(self):
-        fn = filedialog.askopenfilename(filetypes=[("JSON Files", "*.json")])
+        fn = filedialog.askopenfilename(filetypes=[("语料文件", "*.jsonl *.gz *.zst *.json"), ("All Files", "*.*")])
         if fn: 
             self.json_path_entry.delete(0, tk.END)
             self.json_path_entry.insert(0, fn)
@@ -210,64 +296,257 @@ class RAGSimulatorGUI:
             }
 
     # --- 核心逻辑：从数据库(仓库)加载数据 ---
-    def reload_memory_db(self):
+    def reload_memory_db(self, background=True):
         """
-        ✨ 方案 2 修复版本：连接 DB，拉取 embedding_json, full_context_text 和 pure_text 到内存。
-        支持从 UI 输入框动态读取 DB 路径。
-        增强的数据验证和修复能力。
+        挂载 / 刷新向量索引 (热切换)
+        后台线程准备好新快照的全部检索状态 (导出或回放、memmap、元数据、ANN 索引)，
+        再由主线程在 _swap_index 中一次性替换引用：切换前的检索继续使用旧快照，之后的检索使用新快照，
+        准备失败时继续使用当前已挂载的索引。支持从 UI 输入框动态读取 DB 路径。
+        background=False 时在当前线程同步完成 (命令行 / 调试)
         """
-        # 1. 获取界面上配置的 DB 路径
+        if self._reloading:
+            self.log("[Swap] 上一次挂载仍在进行中，请稍候...")
+            return
+        # 1. 获取界面上配置的 DB 路径 (Tk 控件只在主线程读取)
         target_db_path = self.db_path_entry.get().strip()
         if not target_db_path:
             target_db_path = Config.DB_PATH # 回退到默认
+        model_name = self.get_current_api_config()['model']
+        ann_kind = self.ENGINE_CHOICES.get(self.engine_var.get())
         
         self.log(f"正在尝试挂载数据库: {target_db_path} ...")
+        if not background:
+            self._swap_index(self._prepare_index(target_db_path, model_name, ann_kind))
+            return
+        self._reloading = True
+        threading.Thread(
+            target=lambda: self.msg_queue.put(("SWAP", self._prepare_index(target_db_path, model_name, ann_kind))),
+            daemon=True
+        ).start()
+
+    def _prepare_index(self, target_db_path, model_name, ann_kind):
+        """
+        ✨ 方案 2 修复版本：连接 DB，挂载内存映射向量索引，拉取 full_context_text 和 pure_text 到内存。
+        增强的数据验证和修复能力。
+        只构建新状态、不修改 self 上的检索状态 (在后台线程运行)
+        返回: 状态字典，失败时含 'error'
+        """
+        state = {'db_path': target_db_path}
+        if not os.path.exists(target_db_path):
+            state['error'] = f"找不到文件 {target_db_path}"
+            state['status'] = "状态: 文件不存在"
+            return state
+        # 2. 新的 Connector：旧的仍供切换前的检索使用
+        db_conn = DBConnector(target_db_path)
+        state['db_conn'] = db_conn
+
+        # 3. 优先使用磁盘内存映射索引 (DB 同级的 .index 目录，当前快照)
+        # 索引缺失或 DB 在导出后被修改过时，先导出一个新快照，之后的挂载直接 np.memmap
+        # 导出后的变更量不超过 Config.DELTA_REPLAY_MAX_ROWS 时不重新导出，只把 chunk_changes 回放为增量段
+        index_dir = VectorIndexStore.default_dir(target_db_path)
+        try:
+            search_engine, live_index, manifest, change_seq = VectorIndexStore.mount(
+                db_conn, index_dir, model_name=model_name, logger=self.log)
+        except Exception as e:
+            state['error'] = f"向量索引加载失败: {e}"
+            state['status'] = "状态: 索引加载失败"
+            return state
+        
+        if manifest.get('model') and manifest['model'] != model_name:
+            self.log(f"⚠️ 警告：索引模型 ({manifest['model']}) 与当前 API 模型 ({model_name}) 不一致")
+        state.update(index_dir=index_dir, snapshot_dir=manifest['snapshot_dir'], manifest=manifest,
+                     change_seq=change_seq, search_engine=None)
+        
+        if len(live_index) == 0:
+            # 空库也是一次成功的挂载 (切换为空状态)
+            return state
+
+        # 4. 拉取文本元数据 (不含向量)，与映射矩阵按行号对齐
+        # 缺少有效 pure_text 的行以 None 占位，保证行号与矩阵 (及 IVF 索引) 一致
+        # 懒加载模式跳过这一步：常驻内存只有 memmap 矩阵与 ids，文本在检索后按 Top-K 回表
+        lazy_text = Config.LAZY_TEXT_HYDRATION
+        meta_map = {} if lazy_text else db_conn.fetch_chunk_metadata()
+        memory_vectors = []
+        skip_count = 0
         
-        # 2. 更新 Connector 的路径
-        # 注意：这里我们动态修改 db_conn 实例的路径属性，以便后续操作都针对新 DB
-        self.db_conn.db_path = target_db_path
+        ids = search_engine.ids
+        for chunk_uuid in ([] if lazy_text else ids):
+            item = meta_map.get(chunk_uuid)
+            # ✨ 额外的数据完整性检查
+            if not item or not item.get('pure_text') or not item['pure_text'].strip():
+                self.log(f"⚠️ 警告：记录 {chunk_uuid[:8]}... 缺少有效的 pure_text，已跳过")
+                skip_count += 1
+                memory_vectors.append(None)
+                continue
+            
+            memory_vectors.append(item)
         
-        if not os.path.exists(target_db_path):
-            self.log(f"错误: 找不到文件 {target_db_path}")
-            self.db_status_label.config(text=f"状态: 文件不存在", fg="red")
+        # 5. 当前选择的 ANN / 量化引擎随快照一起准备好，切换后首个查询无需等待构建
+        ann_index = None
+        if ann_kind is not None:
+            try:
+                ann_index = load_or_build_ann(ann_kind, manifest['snapshot_dir'], search_engine.matrix, manifest,
+                                              logger=self.log)
+            except Exception as e:
+                self.log(f"[ANN Error] {ann_kind} 索引加载失败，回退到精确检索: {e}")
+        
+        state.update(
+            search_engine=search_engine, live_index=live_index,
+            lazy_text=lazy_text, memory_vectors=memory_vectors, skip_count=skip_count,
+            row_by_id={} if lazy_text else {chunk_uuid: row for row, chunk_uuid in enumerate(ids)},
+            ann_index=ann_index, ann_kind=ann_kind if ann_index is not None else None,
+        )
+        return state
+
+    def _swap_index(self, state):
+        """
+        主线程: 用 _prepare_index 准备好的状态原子替换当前检索状态
+        持有 swap_lock 补放准备期间新写入的变更，入库线程的增量写入在切换前后都不会丢失
+        """
+        self._reloading = False
+        target_db_path = state['db_path']
+        if 'error' in state:
+            self.log(f"错误: {state['error']}")
+            if self.search_engine is not None:
+                self.log(f"[Swap] 继续使用当前已挂载的索引 (版本 {self.index_manifest['version']})")
+                return
+            self.db_status_label.config(text=state['status'], fg="red")
             self.memory_vectors = []
+            self.search_engine = None
+            self.live_index = None
+            self.ann_index = None
+            self.ann_kind = None
             return
-
-        # 3. 调用 Backend 的方法
-        # 此时 db_conn.fetch_all_vectors() 内部会使用 self.db_path (也就是我们刚才设置的 target_db_path)
-        raw_data = self.db_conn.fetch_all_vectors()
         
-        if not raw_data:
+        old_hybrid = self.hybrid
+        with self.swap_lock:
+            live_index = state.get('live_index')
+            if live_index is not None:
+                upserts, deletes, _ = state['db_conn'].fetch_changes_since(state['change_seq'])
+                live_index.apply_changes(upserts, deletes)
+            self.db_conn = state['db_conn']
+            self.index_dir = state['snapshot_dir']
+            self.index_manifest = state['manifest']
+            self.search_engine = state['search_engine']
+            self.live_index = live_index
+            self.lazy_text = state.get('lazy_text', Config.LAZY_TEXT_HYDRATION)
+            self.memory_vectors = state.get('memory_vectors', [])
+            self.skip_count = state.get('skip_count', 0)
+            self.row_by_id = state.get('row_by_id', {})
+            self.ann_index = state.get('ann_index')
+            self.ann_kind = state.get('ann_kind')
+            # 向量通道的行号 -> chunk_uuid 映射由增量索引提供 (覆盖增量段中的行)
+            self.hybrid = HybridRetriever(self.db_conn, live_index, live_index, embed_fn=None) if live_index else None
+        if old_hybrid is not None:
+            old_hybrid.close()
+        self._refresh_doc_filter()
+        # 旧快照不再被本进程使用；保留最近的快照，更早的清理掉
+        VectorIndexStore.gc_snapshots(state['index_dir'], protect=[self.index_dir], logger=self.log)
+        
+        manifest = state['manifest']
+        if self.search_engine is None:
             self.log("挂载成功，但数据库为空 (没有有效向量)。")
-            self.memory_vectors = []
             self.db_status_label.config(text=f"状态: 空数据库 | Path: {os.path.basename(target_db_path)}", fg="#ff8800")
             return
-
-        # 4. 转换数据格式 + 增强的数据完整性检查
-        self.memory_vectors = []
-        skip_count = 0
         
-        for item in raw_data:
-            try:
-                # ✨ 额外的数据完整性检查
-                if not item.get('pure_text') or not item['pure_text'].strip():
-                    self.log(f"⚠️ 警告：记录 {item['id'][:8]}... 缺少有效的 pure_text，已跳过")
-                    skip_count += 1
-                    continue
-                
-                item['np_vector'] = np.array(item['vector'])
-                self.memory_vectors.append(item)
-            except Exception as e:
-                self.log(f"⚠️ 警告：处理记录 {item.get('id', 'unknown')[:8]}... 时出错: {e}")
-                skip_count += 1
-                continue
-            
-        count = len(self.memory_vectors)
-        if skip_count > 0:
-            self.log(f"[Info] 数据库挂载成功！已跳过 {skip_count} 条损坏记录。")
-        self.log(f"[Success] 内存索引已构建，共 {count} 条有效数据可用。")
+        self._ensure_ann_index()
+        count = len(self.live_index) - self.skip_count
+        if self.lazy_text:
+            self.log(f"[Lazy] 仅常驻向量矩阵 ({self.search_engine.nbytes / 1024 / 1024:.1f} MB, memmap) 与 ID 映射，"
+                     f"文本在检索后按 Top-K 回表")
+        if self.skip_count > 0:
+            self.log(f"[Info] 数据库挂载成功！已跳过 {self.skip_count} 条损坏记录。")
+        self.log(f"[Success] 内存映射索引已切换到快照 {os.path.basename(self.index_dir)} (版本 {manifest['version']})，"
+                 f"共 {count} 条有效数据可用。")
         self.db_status_label.config(text=f"状态: 已挂载 ✅ | 索引量: {count} 条", fg="green")
 
+    def _ensure_ann_index(self):
+        """
+        选择 ANN / 量化引擎时按需加载索引
+        .index/ 对应子目录不存在或与当前向量索引版本不一致时，从 memmap 矩阵重新构建并保存
+        """
+        kind = self.ENGINE_CHOICES.get(self.engine_var.get())
+        if kind is None or self.search_engine is None or (self.ann_index is not None and self.ann_kind == kind):
+            return
+        
+        try:
+            self.ann_index = load_or_build_ann(kind, self.index_dir, self.search_engine.matrix, self.index_manifest, logger=self.log)
+            self.ann_kind = kind
+            self.log(f"[ANN] {kind} 索引就绪 | 内存 {self.ann_index.nbytes / 1024 / 1024:.1f} MB "
+                     f"(float32 矩阵 {self.search_engine.nbytes / 1024 / 1024:.1f} MB)")
+        except Exception as e:
+            self.log(f"[ANN Error] {kind} 索引加载失败，回退到精确检索: {e}")
+            self.ann_index = None
+            self.ann_kind = None
+
+    def _refresh_doc_filter(self):
+        """挂载后刷新文档下拉框，并重置章节"""
+        docs = self.search_engine.filter_values('doc') if self.search_engine is not None else []
+        self.doc_filter_combo['values'] = (self.FILTER_ALL,) + tuple(docs)
+        self.doc_filter_var.set(self.FILTER_ALL)
+        self._refresh_chapter_filter()
+
+    def _refresh_chapter_filter(self):
+        """章节下拉框只列出当前选中文档下的章节"""
+        chapters = []
+        if self.search_engine is not None:
+            chapters = self.search_engine.filter_values('chapter', self._current_filters(include_chapter=False))
+        self.chapter_filter_combo['values'] = (self.FILTER_ALL,) + tuple(chapters)
+        self.chapter_filter_var.set(self.FILTER_ALL)
+
+    def delete_selected_document(self):
+        """按文档删除 (DB 单事务)，并立即在内存索引中打墓碑，无需重新导出索引"""
+        doc = self.doc_filter_var.get()
+        if not doc or doc == self.FILTER_ALL:
+            messagebox.showwarning("提示", "请先在 \"范围 - 文档\" 中选择要删除的文档")
+            return
+        if not messagebox.askyesno("确认删除", f"确定从数据库中删除《{doc}》的全部切片？"):
+            return
+        try:
+            seq = self.db_conn.current_change_seq()
+            deleted = self.db_conn.delete_document(doc)
+        except Exception as e:
+            messagebox.showerror("错误", f"删除失败: {e}")
+            return
+        # 按变更日志回放: 除删除外，近重复簇的代表切片被删后接过向量的切片也一并加入索引
+        self._replay_changes_since(seq)
+        self.log(f"[Doc] 已删除《{doc}》: {len(deleted)} 个切片 (内存索引已同步)")
+        self.doc_filter_combo['values'] = tuple(v for v in self.doc_filter_combo['values'] if v != doc)
+        self.doc_filter_var.set(self.FILTER_ALL)
+        self._refresh_chapter_filter()
+
+    def _replay_changes_since(self, seq):
+        """把 seq 之后的 DB 变更回放到增量索引"""
+        with self.swap_lock:
+            if self.live_index is None:
+                return
+            upserts, deletes, _ = self.db_conn.fetch_changes_since(seq)
+            self.live_index.apply_changes(upserts, deletes)
+
+    def _publish_document_change(self, deleted_ids, records):
+        """
+        文档级变更发布到增量索引: 新写入的切片追加为增量段，删除的切片打墓碑 (精确 / ANN 检索都会跳过)
+        records: bulk_insert / replace_document 的记录格式 (含 embedding；近重复切片没有 embedding，不进入索引)
+        """
+        with self.swap_lock:
+            if self.live_index is None:
+                return
+            upserts = [(r['metadata'].get('section_id', ''), r['embedding'],
+                        r['metadata'].get('doc_title', ''), r.get('chapter_title_temp', ''))
+                       for r in records if r.get('embedding') is not None]
+            self.live_index.apply_changes(upserts, deleted_ids)
+
+    def _current_filters(self, include_chapter=True):
+        """界面上的范围选择 -> VectorSearchEngine 的 filters 字典 (未选择时为 {})"""
+        filters = {}
+        doc = self.doc_filter_var.get()
+        if doc and doc != self.FILTER_ALL:
+            filters['doc'] = doc
+        chapter = self.chapter_filter_var.get()
+        if include_chapter and chapter and chapter != self.FILTER_ALL:
+            filters['chapter'] = chapter
+        return filters
+
     # --- 线程工作逻辑：入库 (JSON -> API -> DB) ---
     def start_ingestion_thread(self):
         path = self.json_path_entry.get()
@@ -298,72 +577,52 @@ class RAGSimulatorGUI:
         """
         ✨ 方案 2 修复版本：批量入库逻辑
         核心改进：在处理 batch 时，优先从 JSON 的 pure_text 读取，实现多级降级策略
+        内存有界: 语料按批流式读取，最多 max_workers * INGEST_INFLIGHT_PER_WORKER 批在途，
+        每批写库 (并追加到增量索引) 后即释放，只保留计数器，百万级切片也不随语料增长
         """
         try:
-            self.log("正在解析 JSON 文件...")
-            with open(json_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            total_items = len(data)
-            self.log(f"解析成功，共 {total_items} 条数据待处理。")
-            
-            # 数据检查：扫描 JSON 中是否包含 pure_text 字段
-            sample_item = data[0] if data else {}
-            has_pure_text = 'pure_text' in sample_item
-            self.log(f"[Info] JSON 数据结构检查：pure_text 字段 {'✅ 已包含' if has_pure_text else '❌ 缺失'}")
-            
-            batches = []
-            for i in range(0, total_items, batch_size):
-                batch_data = data[i:i+batch_size]
-                batch_texts = [item['embedding_text'] for item in batch_data]
-                batches.append({
-                    'index': i,
-                    'data': batch_data,
-                    'texts': batch_texts
-                })
+            self.log("正在读取语料文件...")
+            # 自动识别 JSONL (含 .gz / .zst 压缩) 与旧版 JSON 数组；条数只用于进度条
+            total_items = count_records(json_path)
+            self.log(f"语料共 {total_items} 条数据待处理。")
+            if total_items == 0:
+                self.msg_queue.put(("STATUS_DONE", "语料为空，没有需要入库的数据。"))
+                return
             
-            processed_data = []
-            processed_count = 0
-            lock = threading.Lock()
-            
-            def process_batch(batch_info):
+            def thread_logger(msg):
+                if "Error" in msg or "error" in msg: 
+                    self.log(msg)
+
+            def process_batch(batch_index, batch_data):
                 """
                 ✨ 核心处理函数：实现方案 2 的多级降级策略
+                语料记录只属于本批，直接在原字典上补字段，不再 copy
                 """
-                texts = batch_info['texts']
-                def thread_logger(msg):
-                    if "Error" in msg or "error" in msg: 
-                        self.log(msg)
-                
                 try:
-                    vectors = self.adapter.get_embeddings(texts, provider_config=api_config, logger=thread_logger)
+                    # 近重复切片 (读取时已由 dedup 标记) 不调用向量接口
+                    targets = [item for item in batch_data if 'duplicate_of' not in item]
+                    if targets:
+                        vectors = self.adapter.get_embeddings([item['embedding_text'] for item in targets],
+                                                              provider_config=api_config, logger=thread_logger)
+                        for record, vector in zip(targets, vectors):
+                            record['embedding'] = vector
                     
-                    result_records = []
-                    for idx, item in enumerate(batch_info['data']):
-                        meta = item.get('metadata', {})
+                    for record in batch_data:
+                        meta = record.get('metadata', {})
                         path_list = meta.get('section_path', [])
-                        h1 = path_list[1] if len(path_list) > 1 else ""
-                        h2 = path_list[2] if len(path_list) > 2 else ""
-                        
-                        record = item.copy()
-                        record['embedding'] = vectors[idx]
-                        record['chapter_title_temp'] = h1
-                        record['sub_title_temp'] = h2
+                        record['chapter_title_temp'] = path_list[1] if len(path_list) > 1 else ""
+                        record['sub_title_temp'] = path_list[2] if len(path_list) > 2 else ""
                         
                         # ✨ 方案 2 的核心修复：多级降级策略获取 pure_text
-                        pure_text = ""
-                        
                         # 第一优先级：直接从 JSON 的 pure_text 字段读取
-                        if 'pure_text' in item and item['pure_text']:
-                            pure_text = item['pure_text'].strip()
-                            
+                        if record.get('pure_text'):
+                            pure_text = record['pure_text'].strip()
                         # 第二优先级：从 metadata 中读取
-                        elif 'pure_text' in meta and meta['pure_text']:
+                        elif meta.get('pure_text'):
                             pure_text = meta['pure_text'].strip()
-                        
                         # 第三优先级：从 embedding_text 分割提取
                         else:
-                            embedding_text = item.get('embedding_text', '')
+                            embedding_text = record.get('embedding_text', '')
                             if "Content: " in embedding_text:
                                 pure_text = embedding_text.split("Content: ", 1)[1].strip()
                             else:
@@ -371,44 +630,75 @@ class RAGSimulatorGUI:
                         
                         # 最后保底：确保 pure_text 不为空
                         if not pure_text:
-                            pure_text = item.get('embedding_text', '').strip()
+                            pure_text = record.get('embedding_text', '').strip()
                         
-                        # 将处理后的 pure_text 保存到 metadata 和 record，供后续 bulk_insert 使用
+                        # 将处理后的 pure_text 保存到 metadata，供后续 bulk_insert 使用
                         meta['pure_text'] = pure_text
                         record['metadata'] = meta
-                        
-                        result_records.append(record)
-                    return result_records
+                    return batch_data
                 except Exception as e:
-                    self.log(f"[Batch Error] 索引 {batch_info['index']} 失败: {e}")
+                    self.log(f"[Batch Error] 索引 {batch_index} 失败: {e}")
                     return None
 
-            self.log(f"开始并发处理，线程池大小: {max_workers}")
+            def persist(results):
+                # 这里调用 backend 的 bulk_insert，数据真正存入 Warehouse (DB)
+                # bulk_insert 内部已经集成了方案 2 的逻辑
+                self.db_conn.bulk_insert(results)
+                # 同步追加到增量索引，入库完成即可检索，无需整库重载
+                self._publish_document_change([], results)
+
+            max_inflight = max_workers * Config.INGEST_INFLIGHT_PER_WORKER
+            # 近重复检测在读取线程中按语料顺序进行 (先到的成为代表切片)，并发批次之间结果确定
+            # 代表切片所在批次向量化失败时，已挂在它名下的重复切片没有向量 (仍可全文检索)，重跑本语料即可补齐
+            # 签名按文档保存、只保留最近 DEDUP_MAX_DOCS 份 (Day 2 语料按文档连续写出)，内存不随语料规模增长
+            dedup = ChunkDeduplicator() if Config.DEDUP_ENABLED else None
+            self.log(f"开始并发处理，线程池大小: {max_workers} | 在途批次上限: {max_inflight}")
             
-            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                future_to_batch = {executor.submit(process_batch, b): b for b in batches}
-                
-                for future in concurrent.futures.as_completed(future_to_batch):
+            processed_count = 0
+            failed_count = 0
+            sample_checked = False
+            inflight = {}
+            
+            def drain(return_when):
+                nonlocal processed_count, failed_count
+                done, _ = concurrent.futures.wait(inflight, return_when=return_when)
+                for future in done:
+                    batch_len = inflight.pop(future)
                     results = future.result()
-                    if results:
-                        with lock:
-                            # 这里调用 backend 的 bulk_insert，数据真正存入 Warehouse (DB)
-                            # bulk_insert 内部已经集成了方案 2 的逻辑
-                            self.db_conn.bulk_insert(results)
-                            processed_data.extend(results)
-                            processed_count += len(results)
-                            
-                            progress = (processed_count / total_items) * 100
-                            self.msg_queue.put(("PROGRESS", progress))
-                            
-                            if processed_count % (batch_size * 2) == 0:
-                                self.log(f"进度: {processed_count}/{total_items} 已入库")
+                    if not results:
+                        failed_count += batch_len
+                        continue
+                    # 写库在主入库线程串行进行 (SQLite 单写者)；写完后本批记录随 future 一起释放
+                    persist(results)
+                    processed_count += len(results)
+                    self.msg_queue.put(("PROGRESS", processed_count / total_items * 100))
+                    if processed_count % (batch_size * 2) == 0:
+                        self.log(f"进度: {processed_count}/{total_items} 已入库")
+            
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for batch_index, batch_data in enumerate(iter_batches(json_path, batch_size)):
+                    if not sample_checked:
+                        # 数据检查：扫描 JSON 中是否包含 pure_text 字段
+                        has_pure_text = 'pure_text' in batch_data[0]
+                        self.log(f"[Info] JSON 数据结构检查：pure_text 字段 {'✅ 已包含' if has_pure_text else '❌ 缺失'}")
+                        sample_checked = True
+                    if dedup is not None:
+                        dedup.mark(batch_data)
+                    # 有界提交窗口: 在途批次已满时先等至少一批完成并落库，读取端随之被背压
+                    if len(inflight) >= max_inflight:
+                        drain(concurrent.futures.FIRST_COMPLETED)
+                    future = executor.submit(process_batch, batch_index * batch_size, batch_data)
+                    inflight[future] = len(batch_data)
+                while inflight:
+                    drain(concurrent.futures.FIRST_COMPLETED)
             
             self.log("="*50)
             self.log("入库任务全部完成！数据已安全存入数据库。")
-            self.log(f"总处理数: {len(processed_data)} | 成功率: {len(processed_data)/total_items*100:.1f}%")
+            self.log(f"总处理数: {processed_count} | 失败: {failed_count} | 成功率: {processed_count/total_items*100:.1f}%")
+            if dedup is not None:
+                self.log(dedup.summary())
             self.log("="*50)
-            self.msg_queue.put(("STATUS_DONE", f"入库成功！共 {len(processed_data)} 条数据。\n已存入 DB，ready for RAG simulation."))
+            self.msg_queue.put(("STATUS_DONE", f"入库成功！共 {processed_count} 条数据。\n已存入 DB，ready for RAG simulation."))
             
         except Exception as e:
             import traceback
@@ -417,6 +707,95 @@ class RAGSimulatorGUI:
             print(err)
             self.msg_queue.put(("ERROR", f"���理异常: {str(e)}"))
 
+    def _fetch_margin(self):
+        """召回时多取的条数: 常驻模式为已知的损坏行数，懒加载模式回表前未知，取固定余量"""
+        return Config.LAZY_FETCH_MARGIN if self.lazy_text else self.skip_count
+
+    def _hydrate(self, chunk_uuids, fallback_hits=None):
+        """
+        chunk_uuid 列表 -> {chunk_uuid: item}，pure_text 无效的切片不在结果中
+        - 常驻模式: 从 memory_vectors 取
+        - 懒加载模式: 一次 IN (...) 主键查询只拉取这几条的文本
+        fallback_hits: {chunk_uuid: 全文 / 标识符命中}，常驻模式下尚未向量化 (不在索引中) 的切片用命中字段兜底
+        常驻模式下增量段中的切片 (挂载后才入库) 不在 memory_vectors 里，同样按主键回表
+        """
+        if self.lazy_text:
+            items = self.db_conn.fetch_texts(chunk_uuids)
+        else:
+            items = {}
+            missing = []
+            for chunk_uuid in chunk_uuids:
+                row = self.row_by_id.get(chunk_uuid)
+                if row is None:
+                    missing.append(chunk_uuid)
+                elif self.memory_vectors[row] is not None:
+                    items[chunk_uuid] = self.memory_vectors[row]
+            if missing:
+                items.update(self.db_conn.fetch_texts(missing))
+        for chunk_uuid, hit in (fallback_hits or {}).items():
+            if not self.lazy_text and chunk_uuid not in items and chunk_uuid not in self.row_by_id:
+                items[chunk_uuid] = {'id': hit['id'], 'text': "", 'pure_text': hit['pure_text'],
+                                     'doc': hit['doc'], 'chapter': hit['chapter'], 'sub': hit['sub']}
+        return items
+
+    def _vector_top_k(self, engine, q_vec, top_k_n, filters=None):
+        """
+        向量检索 + 文本回表
+        多取 _fetch_margin() 条以覆盖 pure_text 损坏的行；回表后仍不足 top_k_n 条时扩大 k 重试
+        返回: [(score, item, None), ...]
+        """
+        k = top_k_n + self._fetch_margin()
+        while True:
+            if filters:
+                hits = engine.search(q_vec, k=k, filters=filters)
+            else:
+                hits = engine.search(q_vec, k=k)
+            chunk_uuids = [self.live_index.get_id(row) for row, _ in hits]
+            items = self._hydrate(chunk_uuids)
+            top_k = [(score, items[chunk_uuid], None) for (_, score), chunk_uuid in zip(hits, chunk_uuids)
+                     if chunk_uuid in items][:top_k_n]
+            if len(top_k) >= top_k_n or len(hits) < k:
+                return top_k
+            k *= 2
+
+    def _run_hybrid(self, query, engine, api_config, top_k_n, filters=None):
+        """
+        混合检索: FTS5 全文与向量 (问题向量化 + 引擎检索) 并发执行后 RRF 融合
+        返回: [(score, item, provenance), ...]；失败返回 None
+        """
+        self.log(f"正在混合检索: '{query}' (FTS + 向量并发, {Config.HYBRID_FUSION} 融合)...")
+        self.hybrid.engine = engine
+        self.hybrid.embed_fn = lambda text: self.adapter.embed_query(text, provider_config=api_config)
+        try:
+            results, timings = self.hybrid.search(query, k=top_k_n + self._fetch_margin(), filters=filters)
+        except Exception as e:
+            self.result_area.insert(tk.END, f"[Error] 混合检索失败: {e}\n")
+            self.log(f"混合检索失败: {e}")
+            return None
+        for err in timings.get('errors', []):
+            self.log(f"⚠️ 单路检索失败，已降级: {err}")
+
+        items = self._hydrate([r['id'] for r in results],
+                              fallback_hits={r['id']: r['fts_hit'] for r in results if r['fts_hit'] is not None})
+        top_k = []
+        for r in results:
+            item = items.get(r['id'])
+            if item is None:
+                continue
+            provenance = " + ".join(f"id:{r['identifier']}" if source == "id" else f"{source}#{r[source + '_rank']}"
+                                    for source in r['sources'])
+            top_k.append((r['score'], item, provenance))
+            if len(top_k) >= top_k_n:
+                break
+
+        self.log(f"[Hybrid] 标识符 {timings['id_ms']:.1f}ms | 全文 {timings['fts_ms']:.1f}ms | 向量化 {timings['embed_ms']:.1f}ms | "
+                 f"向量检索 {timings['vector_ms']:.1f}ms | 融合 {timings['fusion_ms']:.2f}ms | "
+                 f"总计 {timings['total_ms']:.1f}ms")
+        p95 = self.hybrid.latency_stats()['total_ms']['p95']
+        if p95 > Config.HYBRID_LATENCY_BUDGET_MS:
+            self.log(f"⚠️ 混合检索 p95 {p95:.0f}ms 超出预算 {Config.HYBRID_LATENCY_BUDGET_MS}ms")
+        return top_k
+
     # --- 仿真搜索逻辑 (Read from DB Memory) ---
     def run_simulation(self):
         """
@@ -427,7 +806,7 @@ class RAGSimulatorGUI:
         if not query: return
         
         # 强制检查：必须基于数据库内容
-        if not self.memory_vectors:
+        if self.search_engine is None:
             messagebox.showwarning("警告", "当前未挂载数据库或数据库为空。\n请检查文件路径并点击'立即挂载/刷新'")
             return
 
@@ -435,36 +814,75 @@ class RAGSimulatorGUI:
         self.result_area.delete(1.0, tk.END)
         
         api_config = self.get_current_api_config()
-        self.log(f"正在向量化问题: '{query}' ...")
-        
+
         try:
-            q_vec = self.adapter.get_embeddings([query], provider_config=api_config, logger=None)[0]
-            q_vec_np = np.array(q_vec)
-        except Exception as e:
-            self.result_area.insert(tk.END, f"[Error] 向量化失败: {e}\n")
-            self.log(f"向量化失败: {e}")
-            return
+            top_k_n = max(1, int(self.top_k_spin.get()))
+        except ValueError:
+            top_k_n = Config.DEFAULT_TOP_K
 
-        self.log(f"正在 {len(self.memory_vectors)} 条数据中检索 (余弦相似度)...")
-        scores = []
-        q_norm = np.linalg.norm(q_vec_np)
-        
-        # 这里的 item 来源于 reload_memory_db 中拉取的 DB 数据
-        for item in self.memory_vectors:
-            d_vec_np = item['np_vector']
-            d_norm = np.linalg.norm(d_vec_np)
-            
-            if q_norm == 0 or d_norm == 0:
-                sim = 0
-            else:
-                sim = np.dot(q_vec_np, d_vec_np) / (q_norm * d_norm)
-            
-            scores.append((sim, item))
+        # 选择检索引擎: 精确检索 (一次矩阵-向量乘积 + argpartition) 或 ANN / 量化索引
+        engine = self.search_engine
+        kind = self.ENGINE_CHOICES.get(self.engine_var.get())
+        filters = self._current_filters()
+        if filters:
+            # 范围检索只对区间内的行精确打分，打分量随范围缩小，不需要 ANN
+            scope = self.search_engine.resolve_filters(filters)
+            scoped_rows = sum(end - start for start, end in scope)
+            self.log(f"正在 {scoped_rows}/{len(engine)} 条数据中检索 (范围: {filters}, 精确打分)...")
+        elif kind is not None and self.ann_index is not None and self.ann_kind == kind:
+            engine = self.ann_index
+            params = []
+            # IVF / IVF-PQ 有 nprobe；量化索引 (SQ8 / FP16 / PQ / IVF-PQ) 有重排倍数
+            if hasattr(engine, 'nprobe'):
+                try:
+                    engine.nprobe = max(1, int(self.nprobe_spin.get()))
+                except ValueError:
+                    engine.nprobe = Config.IVF_DEFAULT_NPROBE
+                params.append(f"nprobe={engine.nprobe}")
+            if hasattr(engine, 'rerank'):
+                try:
+                    engine.rerank = max(0, int(self.rerank_spin.get()))
+                except ValueError:
+                    engine.rerank = Config.SQ_DEFAULT_RERANK
+                params.append(f"重排倍数={engine.rerank}")
+            # 二值索引: Hamming 预筛候选数 (Config.BINARY_CANDIDATES)，候选全部精确重排
+            if hasattr(engine, 'candidates'):
+                params.append(f"预筛候选={engine.candidates}")
+            self.log(f"正在 {len(engine)} 条数据中检索 ({kind} 近似检索, {', '.join(params)})...")
+        else:
+            self.log(f"正在 {len(engine)} 条数据中检索 (余弦相似度, 矩阵化)...")
+        # 基础引擎之上叠加增量段 (挂载后入库的新数据) 并剔除墓碑
+        self.live_index.base = engine
+        engine = self.live_index
+        
+        if self.hybrid_var.get() and self.hybrid is not None:
+            top_k = self._run_hybrid(query, engine, api_config, top_k_n, filters)
+            if top_k is None:
+                return
+        else:
+            top_k = None
+            # 问题中含文号 / 编号: chunk_identifiers 等值查询直接命中，跳过向量化往返
+            # (条款号 / 章节号只在选定文档或问题中带文号时参与，否则会命中任意文档的 "第三条")
+            id_hits = [hit for hit in self.db_conn.lookup_identifiers(query, docs=filters.get('doc'))
+                       if HybridRetriever._match_filters(hit, filters)][:top_k_n]
+            if id_hits:
+                self.log(f"[Identifier] 标识符精确命中 {len(id_hits)} 条 ({id_hits[0]['identifier']})，跳过向量检索")
+                items = self._hydrate([hit['id'] for hit in id_hits], fallback_hits={hit['id']: hit for hit in id_hits})
+                top_k = [(1.0, items[hit['id']], f"id:{hit['identifier']}") for hit in id_hits if hit['id'] in items]
+        if top_k is None:
+            self.log(f"正在向量化问题: '{query}' ...")
+            try:
+                # 重复的问题直接命中查询向量缓存，不再走 HTTP 往返
+                q_vec = self.adapter.embed_query(query, provider_config=api_config, logger=self.log)
+            except Exception as e:
+                self.result_area.insert(tk.END, f"[Error] 向量化失败: {e}\n")
+                self.log(f"向量化失败: {e}")
+                return
 
-        scores.sort(key=lambda x: x[0], reverse=True)
-        top_k = scores[:3]
+            # 这里的 item 来源于 reload_memory_db 中拉取的 DB 数据 (懒加载模式下按 Top-K 回表)
+            top_k = self._vector_top_k(engine, q_vec, top_k_n, filters)
 
-        self.result_area.insert(tk.END, f"\n{'='*20} 仿真召回结果 (Top 3) {'='*20}\n")
+        self.result_area.insert(tk.END, f"\n{'='*20} 仿真召回结果 (Top {top_k_n}) {'='*20}\n")
         
         current_db_name = os.path.basename(self.db_path_entry.get())
         self.result_area.insert(tk.END, f"数据源: {current_db_name} (Pure Text Fusion - Method 2 Enhanced)\n\n", "source_db")
@@ -472,11 +890,18 @@ class RAGSimulatorGUI:
         if not top_k:
             self.result_area.insert(tk.END, "无匹配结果。\n")
 
-        for i, (score, item) in enumerate(top_k):
+        # 近重复簇的其他出处 (这些切片未单独向量化，由代表切片代为召回)
+        duplicates = self.db_conn.fetch_duplicates([item['id'] for _, item, _ in top_k])
+
+        for i, (score, item, provenance) in enumerate(top_k):
             self.log(f"Top {i+1} Score: {score:.4f} | Doc: {item['doc']}")
             
             self.result_area.insert(tk.END, f"Rank {i+1} | ")
-            self.result_area.insert(tk.END, f"相似度: {score:.4f}\n", "score")
+            if provenance:
+                score_label = "融合分" if self.hybrid_var.get() else "精确命中"
+                self.result_area.insert(tk.END, f"{score_label}: {score:.4f} | 来源: {provenance}\n", "score")
+            else:
+                self.result_area.insert(tk.END, f"相似度: {score:.4f}\n", "score")
             
             # 1. 标题
             title_text = f"文档: {item['doc']} >> 章: {item['chapter']} >> 节: {item['sub']}\n"
@@ -507,6 +932,10 @@ class RAGSimulatorGUI:
             else:
                  self.result_area.insert(tk.END, f"[Body]:\n{full_context}\n")
 
+            if item['id'] in duplicates:
+                sources = "; ".join(f"{d['doc']} p{d['page']} ({d['similarity']:.2f})" for d in duplicates[item['id']])
+                self.result_area.insert(tk.END, f"[同文另见 {len(duplicates[item['id']])} 处]: {sources}\n", "meta")
+
             self.result_area.insert(tk.END, "-"*50 + "\n")
 
         self.result_area.configure(state="disabled")
@@ -0,0 +1,400 @@
+# day3_search_service.py
+"""
+Day 3 无界面检索服务 (HTTP, 多线程)
+
+与仿真器共用 day3_backend 的检索链路 (内存映射快照 + 增量段 + 可选 ANN / 混合检索)，
+启动时挂载一次索引，之后由 ThreadingHTTPServer 的工作线程并发处理请求。
+
+用法示例:
+    python day3_search_service.py --db rag_production.db --port 8765
+    python day3_search_service.py --db rag_production.db --engine ivf --provider silicon
+    python day3_search_service.py --db rag_production.db --stub-embeddings   # 本地桩向量化接口 (测试用)
+
+接口:
+    GET  /health   挂载状态、快照版本、向量数
+    GET  /stats    最近 Config.SERVICE_LATENCY_WINDOW 个请求的分阶段 p50 / p95 / p99 (ms)，
+                   查询向量缓存命中与微批填充率
+    POST /search   {"query": "...", "k": 5, "filters": {"doc": "..."}, "hybrid": false}
+                   {"queries": ["...", "..."], "k": 5}   (批量: 一次向量化请求 + 一次回表)
+    POST /reload   重新挂载当前快照 (热切换，进行中的请求继续使用旧快照)
+
+curl 示例:
+    curl -s -X POST http://127.0.0.1:8765/search -d '{"query": "国航发〔2023〕12号", "k": 3}'
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+import concurrent.futures
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from day3_config import Config, PROVIDERS
+from day3_backend import EmbeddingAdapter, DBConnector, VectorIndexStore, HybridRetriever
+from day3_ann_index import ANN_INDEX_TYPES, load_or_build_ann
+
+# 允许的过滤字段 (与 VectorSearchEngine.resolve_filters 一致)
+FILTER_FIELDS = ("doc", "chapter")
+
+class RequestError(ValueError):
+    """请求参数错误 (返回 400)"""
+
+class SearchService:
+    """
+    检索服务核心 (与 HTTP 无关，也可在脚本中直接调用)
+
+    - reload(): 挂载当前快照 (VectorIndexStore.mount，必要时导出或回放增量)，准备好后一次性替换 self.state；
+      请求开始时只读取一次 self.state，进行中的请求不受切换影响
+    - sync_changes(): 把其他进程 (仿真器入库 / Day 2 ETL) 新写入的变更回放到当前增量段，无需重新挂载
+    - search(): 单条或批量查询，返回结果与分阶段耗时
+    """
+    STAGES = ("embed_ms", "search_ms", "hydrate_ms", "total_ms")
+
+    def __init__(self, db_path, provider_config, engine_kind=None, logger=print, batch_max=None, batch_wait_ms=None):
+        """batch_max / batch_wait_ms: 查询向量化微批的大小与等待上限 (batch_wait_ms=0 关闭微批)"""
+        self.db_path = db_path
+        self.provider_config = provider_config
+        self.engine_kind = engine_kind
+        self.logger = logger
+        self.adapter = EmbeddingAdapter(use_mock=False)
+        if batch_wait_ms is None or batch_wait_ms > 0:
+            self.adapter.enable_micro_batching(max_batch=batch_max, max_wait_ms=batch_wait_ms)
+        self.state = None
+        self._reload_lock = threading.Lock()
+        # 混合检索的两路并发线程池，跨快照共享
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=2 * Config.SERVICE_HYBRID_WORKERS)
+        self.latencies = deque(maxlen=Config.SERVICE_LATENCY_WINDOW)
+        self._stats_lock = threading.Lock()
+        self.request_count = 0
+        self.error_count = 0
+
+    def _embed(self, texts):
+        # 查询向量缓存 + single-flight: 并发的相同热门问题只调用一次 API
+        return self.adapter.embed_queries(texts, provider_config=self.provider_config)
+
+    def reload(self):
+        """挂载当前快照并替换服务状态，返回新快照的 manifest"""
+        with self._reload_lock:
+            db_conn = DBConnector(self.db_path)
+            index_dir = VectorIndexStore.default_dir(self.db_path)
+            search_engine, live_index, manifest, change_seq = VectorIndexStore.mount(
+                db_conn, index_dir, model_name=self.provider_config['model'], logger=self.logger)
+            if self.engine_kind and len(search_engine):
+                # 无过滤查询走 ANN / 量化索引；带 filters 的查询由 live_index.exact 精确打分
+                live_index.base = load_or_build_ann(self.engine_kind, manifest['snapshot_dir'],
+                                                    search_engine.matrix, manifest, logger=self.logger)
+            hybrid = HybridRetriever(db_conn, live_index, live_index,
+                                     embed_fn=lambda text: self._embed([text])[0], executor=self.executor)
+            self.state = {
+                'db_conn': db_conn, 'live_index': live_index, 'hybrid': hybrid,
+                'manifest': manifest, 'change_seq': change_seq,
+            }
+            VectorIndexStore.gc_snapshots(index_dir, protect=[manifest['snapshot_dir']], logger=self.logger)
+        self.logger(f"[Service] 已挂载快照 {manifest['version']} | {len(live_index)} 条 | "
+                    f"引擎: {self.engine_kind or 'exact'}")
+        return manifest
+
+    def sync_changes(self):
+        """回放上次挂载 / 同步之后的变更，返回回放的切片数"""
+        with self._reload_lock:
+            state = self.state
+            if state is None:
+                return 0
+            upserts, deletes, change_seq = state['db_conn'].fetch_changes_since(state['change_seq'])
+            state['live_index'].apply_changes(upserts, deletes)
+            state['change_seq'] = change_seq
+        if upserts or deletes:
+            self.logger(f"[Delta] 已回放 {len(upserts)} 条新增/更新、{len(deletes)} 条删除")
+        return len(upserts) + len(deletes)
+
+    def search(self, queries, k=None, filters=None, hybrid=False):
+        """
+        queries: 问题列表 (单条查询传长度为 1 的列表)
+        返回: (results, timings)
+            results: 每条问题一个列表 [{'id', 'score', 'doc', 'chapter', 'sub', 'pure_text', 'sources', 'duplicates'}]
+                duplicates: 折叠进该切片近重复簇、未单独向量化的切片 [{'id', 'doc', 'page', 'similarity'}] (见 chunk_dedup)
+            timings: {'embed_ms', 'search_ms', 'hydrate_ms', 'total_ms'}
+        """
+        state = self.state
+        if state is None:
+            raise RuntimeError("索引尚未挂载")
+        start_time = time.perf_counter()
+        k = k or Config.DEFAULT_TOP_K
+        # 多取几条覆盖 pure_text 损坏、回表时被丢弃的行
+        n = k + Config.LAZY_FETCH_MARGIN
+        live_index = state['live_index']
+
+        vectors = self._embed(queries)
+        embed_done = time.perf_counter()
+        ranked = []
+        for query, q_vec in zip(queries, vectors):
+            if hybrid:
+                fused, _ = state['hybrid'].search(query, k=n, query_vector=q_vec, filters=filters)
+                ranked.append([(r['id'], r['score'], r['sources']) for r in fused])
+            else:
+                hits = live_index.search(q_vec, k=n, filters=filters)
+                ranked.append([(live_index.get_id(row), score, ["vector"]) for row, score in hits])
+        search_done = time.perf_counter()
+
+        # 所有问题的候选合并为一次主键回表
+        items = state['db_conn'].fetch_texts([chunk_uuid for hits in ranked for chunk_uuid, _, _ in hits])
+        results = []
+        for hits in ranked:
+            top_k = []
+            for chunk_uuid, score, sources in hits:
+                item = items.get(chunk_uuid)
+                if item is None:
+                    continue
+                top_k.append({'id': chunk_uuid, 'score': float(score), 'doc': item['doc'],
+                              'chapter': item['chapter'], 'sub': item['sub'],
+                              'pure_text': item['pure_text'], 'sources': sources})
+                if len(top_k) >= k:
+                    break
+            results.append(top_k)
+        duplicates = state['db_conn'].fetch_duplicates([r['id'] for top_k in results for r in top_k])
+        for top_k in results:
+            for r in top_k:
+                r['duplicates'] = duplicates.get(r['id'], [])
+        end_time = time.perf_counter()
+
+        timings = {
+            'embed_ms': (embed_done - start_time) * 1000,
+            'search_ms': (search_done - embed_done) * 1000,
+            'hydrate_ms': (end_time - search_done) * 1000,
+            'total_ms': (end_time - start_time) * 1000,
+        }
+        self.latencies.append(dict(timings))
+        return results, timings
+
+    def count_request(self, error=False):
+        with self._stats_lock:
+            if error:
+                self.error_count += 1
+            else:
+                self.request_count += 1
+
+    def latency_stats(self):
+        """最近窗口内的分阶段 p50 / p95 / p99 (ms)"""
+        stats = {'requests': self.request_count, 'errors': self.error_count, 'window': len(self.latencies)}
+        if self.adapter.query_cache is not None:
+            stats['query_cache'] = self.adapter.query_cache.stats()
+        if self.adapter.micro_batcher is not None:
+            stats['micro_batch'] = self.adapter.micro_batcher.stats()
+        latencies = list(self.latencies)
+        if latencies:
+            for stage in self.STAGES:
+                values = np.array([t[stage] for t in latencies])
+                stats[stage] = {p: float(np.percentile(values, int(p[1:]))) for p in ("p50", "p95", "p99")}
+        return stats
+
+    def health(self):
+        state = self.state
+        if state is None:
+            return {'status': "loading"}
+        manifest = state['manifest']
+        return {'status': "ok", 'version': manifest['version'], 'snapshot': manifest['snapshot_dir'],
+                'count': len(state['live_index']), 'pending': state['live_index'].pending,
+                'engine': self.engine_kind or "exact", 'model': manifest.get('model')}
+
+    @staticmethod
+    def parse_request(payload):
+        """校验 /search 请求体，返回 (queries, k, filters, hybrid, is_batch)"""
+        if not isinstance(payload, dict):
+            raise RequestError("请求体必须是 JSON 对象")
+        is_batch = "queries" in payload
+        queries = payload.get("queries") if is_batch else [payload.get("query")]
+        if not isinstance(queries, list) or not queries:
+            raise RequestError("queries 必须是非空列表")
+        if len(queries) > Config.SERVICE_MAX_BATCH:
+            raise RequestError(f"单次最多 {Config.SERVICE_MAX_BATCH} 条查询")
+        if not all(isinstance(q, str) and q.strip() for q in queries):
+            raise RequestError("query 必须是非空字符串")
+
+        k = payload.get("k", Config.DEFAULT_TOP_K)
+        if not isinstance(k, int) or isinstance(k, bool) or not 1 <= k <= Config.SERVICE_MAX_K:
+            raise RequestError(f"k 必须是 1..{Config.SERVICE_MAX_K} 的整数")
+
+        filters = payload.get("filters") or {}
+        if not isinstance(filters, dict) or set(filters) - set(FILTER_FIELDS):
+            raise RequestError(f"filters 只支持字段: {', '.join(FILTER_FIELDS)}")
+        for field, values in filters.items():
+            if isinstance(values, str) and values:
+                continue
+            if isinstance(values, list) and values and all(isinstance(v, str) and v for v in values):
+                continue
+            raise RequestError(f"filters.{field} 必须是非空字符串或非空字符串列表")
+        return [q.strip() for q in queries], k, filters, bool(payload.get("hybrid", False)), is_batch
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """HTTP 层: 解析 JSON、分发到 SearchService，响应中带本次请求耗时 (latency_ms / X-Latency-Ms)"""
+    server_version = "RAGSearchService/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def log_message(self, fmt, *args):
+        if self.server.verbose:
+            self.service.logger(f"[HTTP] {self.address_string()} {fmt % args}")
+
+    def _send_json(self, status, payload, start_time):
+        latency_ms = (time.perf_counter() - start_time) * 1000
+        payload['latency_ms'] = round(latency_ms, 3)
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Latency-Ms", f"{latency_ms:.3f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(raw.decode('utf-8') or "{}")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise RequestError(f"JSON 解析失败: {e}")
+
+    def do_GET(self):
+        start_time = time.perf_counter()
+        if self.path == "/health":
+            self._send_json(200, self.service.health(), start_time)
+        elif self.path == "/stats":
+            self._send_json(200, self.service.latency_stats(), start_time)
+        else:
+            self._send_json(404, {'error': f"未知路径: {self.path}"}, start_time)
+
+    def do_POST(self):
+        start_time = time.perf_counter()
+        try:
+            if self.path == "/search":
+                self.service.count_request()
+                queries, k, filters, hybrid, is_batch = self.service.parse_request(self._read_json())
+                results, timings = self.service.search(queries, k=k, filters=filters, hybrid=hybrid)
+                payload = {'results': results} if is_batch else {'results': results[0]}
+                payload.update(timings={stage: round(v, 3) for stage, v in timings.items()},
+                               version=self.service.state['manifest']['version'])
+                self._send_json(200, payload, start_time)
+            elif self.path == "/reload":
+                self._read_json()
+                manifest = self.service.reload()
+                self._send_json(200, {'version': manifest['version'], 'count': manifest['count']}, start_time)
+            else:
+                self._send_json(404, {'error': f"未知路径: {self.path}"}, start_time)
+        except RequestError as e:
+            self.service.count_request(error=True)
+            self._send_json(400, {'error': str(e)}, start_time)
+        except Exception as e:
+            self.service.count_request(error=True)
+            self.service.logger(f"[Service Error] {self.path}: {e}")
+            self._send_json(500, {'error': str(e)}, start_time)
+
+class SearchHTTPServer(ThreadingHTTPServer):
+    """每个连接一个工作线程；daemon_threads 保证 Ctrl+C 时不等待空闲的 keep-alive 连接"""
+    daemon_threads = True
+    # 默认 listen backlog 只有 5，突发并发连接会被重置
+    request_queue_size = 128
+
+    def __init__(self, address, service, verbose=False):
+        super().__init__(address, SearchRequestHandler)
+        self.service = service
+        self.verbose = verbose
+
+# --- 本地桩向量化接口 (测试用) ---
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    OpenAI 兼容的 /v1/embeddings 桩: 同一文本总是得到同一个向量 (按文本哈希播种)
+    走 EmbeddingAdapter 的真实 HTTP 路径，无需连接内网或硅基流动即可压测服务
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        payload = json.loads(self.rfile.read(length).decode('utf-8') or "{}")
+        texts = payload.get("input") or []
+        if isinstance(texts, str):
+            texts = [texts]
+        data = []
+        for i, text in enumerate(texts):
+            seed = int.from_bytes(hashlib.md5(text.encode('utf-8')).digest()[:4], "little")
+            vec = np.random.RandomState(seed).standard_normal(self.server.dim).astype(np.float32)
+            data.append({"object": "embedding", "index": i, "embedding": vec.tolist()})
+        body = json.dumps({"object": "list", "data": data, "model": payload.get("model")}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubEmbeddingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, dim):
+        super().__init__(address, StubEmbeddingHandler)
+        self.dim = dim
+
+def start_stub_embedding_server(dim, host="127.0.0.1", port=0):
+    """在后台线程启动桩向量化接口 (port=0 自动分配)，返回 (server, url)"""
+    server = StubEmbeddingServer((host, port), dim)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1/embeddings"
+
+def _poll_changes(service, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            service.sync_changes()
+        except Exception as e:
+            service.logger(f"[Delta Error] 变更回放失败: {e}")
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Day 3 无界面检索服务 (HTTP)")
+    parser.add_argument("--db", default=Config.DB_PATH, help="数据库路径")
+    parser.add_argument("--host", default=Config.SERVICE_HOST, help="监听地址")
+    parser.add_argument("--port", type=int, default=Config.SERVICE_PORT, help="监听端口")
+    parser.add_argument("--engine", choices=sorted(ANN_INDEX_TYPES), default=None,
+                        help="无过滤查询使用的 ANN / 量化索引 (默认精确检索)")
+    parser.add_argument("--provider", choices=sorted(PROVIDERS), default="intranet", help="向量化接口")
+    parser.add_argument("--stub-embeddings", action="store_true",
+                        help="启动本地桩向量化接口代替真实 API (维度取索引维度，测试用)")
+    parser.add_argument("--batch-max", type=int, default=Config.MICROBATCH_MAX_SIZE,
+                        help="查询向量化微批的最大条数")
+    parser.add_argument("--batch-wait-ms", type=float, default=Config.MICROBATCH_MAX_WAIT_MS,
+                        help="微批最早请求的最长等待毫秒数 (0 = 关闭微批，每个请求单独调用 API)")
+    parser.add_argument("--poll-changes", type=float, default=Config.SERVICE_CHANGE_POLL_SECONDS,
+                        help="轮询变更日志的间隔秒数 (0 = 只在 /reload 时更新)")
+    parser.add_argument("--verbose", action="store_true", help="打印每个 HTTP 请求")
+    return parser
+
+def main():
+    args = build_arg_parser().parse_args()
+    provider_config = PROVIDERS[args.provider]()
+    service = SearchService(args.db, provider_config, engine_kind=args.engine,
+                            batch_max=args.batch_max, batch_wait_ms=args.batch_wait_ms)
+    manifest = service.reload()
+    if args.stub_embeddings:
+        _, url = start_stub_embedding_server(manifest['dim'])
+        provider_config.update(name="Stub", url=url, key="stub")
+        print(f"[Stub] 桩向量化接口: {url} ({manifest['dim']} 维)")
+    if args.poll_changes > 0:
+        threading.Thread(target=_poll_changes, args=(service, args.poll_changes), daemon=True).start()
+
+    server = SearchHTTPServer((args.host, args.port), service, verbose=args.verbose)
+    print(f"[Service] 检索服务已启动: http://{args.host}:{server.server_address[1]} (Ctrl+C 退出)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n[Service] 正在退出...")
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,334 @@
+# day3_stream_pipeline.py
+"""
+端到端流式入库流水线: 解析 -> 切片 -> 向量化 -> 入库
+
+原流程是三个完全物化的阶段 (Day 2 整本解析后写出 JSON 语料，Day 3 json.load 全量后再向量化)，
+这里把它们串成一条流水线，阶段之间用有界队列连接 (满了就阻塞上游，内存占用与文档大小无关):
+
+    解析线程 (PDFStructureParser.iter_lines, 逐页)
+      -> [lines 队列] -> 切片线程 (H1/H2 状态机 + SmartChunker)
+      -> [chunks 队列] -> 组批线程 (近重复检测 chunk_dedup + 凑满 batch_size 或文档结束即发出)
+      -> [batches 队列] -> 向量化线程 x N (EmbeddingAdapter.get_embeddings)
+      -> [vectors 队列] -> 写入线程 (DBConnector.bulk_insert，每批一个事务)
+
+每批提交后即可被检索 (chunk_changes 触发器记录变更，仿真器 / 检索服务回放为增量段)；
+文档最后一页解析完到最后一个切片提交之间的耗时记为该文档的 "可检索延迟"。
+
+近重复切片 (样板段落、重叠窗口) 在组批线程中按到达顺序判定，只有代表切片调用向量接口；
+重复切片随批入库但不写向量，并登记所属的代表切片 (--no-dedup 关闭)。
+
+文档登记表 (document_registry): 内容与解析参数都未变的 PDF 直接跳过；同名文档内容变化时，
+旧版本切片保留到新版本最后一批提交后，再与登记记录在同一个事务中删除 (替换期间不会出现查不到的窗口)。
+
+用法示例:
+    python day3_stream_pipeline.py a.pdf b.pdf --db rag_production.db
+    python day3_stream_pipeline.py scans/*.pdf --ocr --provider silicon --batch-size 16 --workers 4
+"""
+import argparse
+import os
+import queue
+import threading
+import time
+from day3_config import Config, PROVIDERS
+from day3_backend import EmbeddingAdapter, DBConnector
+from chunk_dedup import ChunkDeduplicator
+from day2_etl_gui_v3 import SmartChunker, document_settings
+from pdf_structure_parser import PDFStructureParser
+from document_registry import (file_sha256, find_ingested, next_version, document_chunk_ids,
+                               delete_chunks, register_document)
+
+# 队列中的控制消息
+_END = object()
+
+class _DocStart:
+    def __init__(self, doc_title):
+        self.doc_title = doc_title
+
+class _DocEnd:
+    def __init__(self, doc_title, parsed_at):
+        self.doc_title = doc_title
+        self.parsed_at = parsed_at
+
+class PipelineStopped(Exception):
+    """流水线中某个阶段失败，其余阶段随之退出"""
+
+class StreamingIngestPipeline:
+    """
+    流式入库流水线 (无界面，可被 GUI / 命令行复用)
+    run(pdf_paths) 阻塞直到全部文档入库；任一阶段异常时其余阶段停止，异常在 run() 中重新抛出
+    on_batch(records): 每批提交后回调 (例如把向量追加到仿真器的 IncrementalSearchEngine)；近重复切片的记录没有 embedding
+    dedup: 是否做近重复检测 (None 时按 Config.DEDUP_ENABLED)
+    """
+    def __init__(self, db_connector, adapter, provider_config=None, use_ocr=False,
+                 batch_size=None, workers=None, queue_size=None, logger=print, on_batch=None, dedup=None):
+        self.db_conn = db_connector
+        self.adapter = adapter
+        self.provider_config = provider_config
+        self.use_ocr = use_ocr
+        self.batch_size = batch_size or Config.DEFAULT_BATCH_SIZE
+        self.workers = workers or Config.DEFAULT_CONCURRENCY
+        queue_size = queue_size or Config.PIPELINE_QUEUE_SIZE
+        self.logger = logger
+        self.on_batch = on_batch
+        self.settings = document_settings(use_ocr)
+        self.dedup = ChunkDeduplicator() if (Config.DEDUP_ENABLED if dedup is None else dedup) else None
+
+        self.lines_q = queue.Queue(maxsize=queue_size)
+        self.chunks_q = queue.Queue(maxsize=queue_size)
+        self.batches_q = queue.Queue(maxsize=max(2, queue_size // self.batch_size))
+        self.vectors_q = queue.Queue(maxsize=max(2, queue_size // self.batch_size))
+        self.stop_event = threading.Event()
+        self.error = None
+
+        # 每个文档: 尚未写入的批次数 / 解析完成时间 (未解析完为 None)
+        self._doc_lock = threading.Lock()
+        self._doc_pending = {}
+        self._doc_parsed_at = {}
+        # 每个文档的登记信息: 内容哈希 / 新版本号 / 旧版本切片 / 页数 / 切片数
+        self._doc_info = {}
+        self.stats = {'docs': 0, 'skipped': 0, 'lines': 0, 'chunks': 0, 'batches': 0, 'written': 0,
+                      'searchable_latency': {}}
+
+    # --- 队列辅助: 阻塞时定期检查停止标志，避免某阶段失败后上下游互相等待 ---
+    def _put(self, q, item):
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            try:
+                q.put(item, timeout=0.2)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while True:
+            if self.stop_event.is_set():
+                raise PipelineStopped()
+            try:
+                return q.get(timeout=0.2)
+            except queue.Empty:
+                continue
+
+    def _stage(self, fn, *args):
+        def target():
+            try:
+                fn(*args)
+            except PipelineStopped:
+                pass
+            except Exception as e:
+                if self.error is None:
+                    self.error = e
+                self.logger(f"[Pipeline Error] {fn.__name__}: {e}")
+                self.stop_event.set()
+        thread = threading.Thread(target=target, name=fn.__name__, daemon=True)
+        thread.start()
+        return thread
+
+    # --- 阶段 1: 解析 ---
+    def _parse(self, pdf_paths):
+        for path in pdf_paths:
+            doc_title = os.path.basename(path)
+            content_hash = file_sha256(path)
+            conn = self.db_conn.get_connection()
+            try:
+                c = conn.cursor()
+                existing = find_ingested(c, content_hash, self.settings)
+                if not existing:
+                    # 旧版本切片在新切片写入前取出，新版本全部提交后再删除
+                    info = {'hash': content_hash, 'path': os.path.abspath(path), 'chunks': 0, 'page_count': 0,
+                            'version': next_version(c, doc_title), 'old_ids': document_chunk_ids(c, doc_title)}
+            finally:
+                conn.close()
+            if existing:
+                self.logger(f"[Skip] 内容未变化，已作为《{existing[0]}》v{existing[1]} 入库: {doc_title}")
+                self.stats['skipped'] += 1
+                continue
+            with self._doc_lock:
+                self._doc_info[doc_title] = info
+
+            self.logger(f"[Parse] 开始解析: {doc_title}")
+            self._put(self.lines_q, _DocStart(doc_title))
+            parser = PDFStructureParser(path, use_ocr=self.use_ocr)
+            for line in parser.iter_lines():
+                self._put(self.lines_q, line)
+                self.stats['lines'] += 1
+            info['page_count'] = parser.page_count
+            self._put(self.lines_q, _DocEnd(doc_title, time.perf_counter()))
+            self.stats['docs'] += 1
+        self._put(self.lines_q, _END)
+
+    # --- 阶段 2: 切片 (与 Day 2 ETLWorker 相同的 H1/H2 状态机) ---
+    def _chunk(self):
+        doc_title, current_h1, current_h2 = None, None, None
+        while True:
+            item = self._get(self.lines_q)
+            if item is _END or isinstance(item, _DocEnd):
+                self._put(self.chunks_q, item)
+                if item is _END:
+                    return
+                continue
+            if isinstance(item, _DocStart):
+                doc_title, current_h1, current_h2 = item.doc_title, None, None
+                continue
+            if item.role == 'H1':
+                current_h1, current_h2 = item.text, None
+            elif item.role == 'H2':
+                current_h2 = item.text
+            elif item.role == 'BODY':
+                for packet in SmartChunker.process_paragraph(doc_title, current_h1, current_h2,
+                                                             item.text, item.page_num):
+                    self._put(self.chunks_q, self._to_record(packet))
+                    self._doc_info[doc_title]['chunks'] += 1
+                    self.stats['chunks'] += 1
+
+    @staticmethod
+    def _to_record(packet):
+        """SmartChunker 输出 -> DBConnector.bulk_insert 的记录格式 (与 Day 3 run_ingestion 相同)"""
+        record = dict(packet['json'])
+        record['chapter_title_temp'] = packet['db']['chapter_title']
+        record['sub_title_temp'] = packet['db']['sub_title']
+        return record
+
+    # --- 阶段 3: 组批 ---
+    def _emit_batch(self, batch):
+        with self._doc_lock:
+            for doc_title in {r['metadata']['doc_title'] for r in batch}:
+                self._doc_pending[doc_title] = self._doc_pending.get(doc_title, 0) + 1
+        self._put(self.batches_q, batch)
+        self.stats['batches'] += 1
+
+    def _batch(self):
+        batch = []
+        while True:
+            item = self._get(self.chunks_q)
+            if item is _END:
+                if batch:
+                    self._emit_batch(batch)
+                for _ in range(self.workers):
+                    self._put(self.batches_q, _END)
+                return
+            if isinstance(item, _DocEnd):
+                # 文档结束: 不等凑满，尾部切片立即发出
+                if batch:
+                    self._emit_batch(batch)
+                    batch = []
+                if self.dedup is not None:
+                    self.dedup.forget(item.doc_title)
+                with self._doc_lock:
+                    self._doc_parsed_at[item.doc_title] = item.parsed_at
+                    done = self._doc_pending.get(item.doc_title, 0) == 0
+                if done:
+                    self._mark_searchable(item.doc_title)
+                continue
+            if self.dedup is not None:
+                self.dedup.mark([item])
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._emit_batch(batch)
+                batch = []
+
+    # --- 阶段 4: 向量化 (N 个线程并发) ---
+    def _embed(self):
+        while True:
+            batch = self._get(self.batches_q)
+            if batch is _END:
+                self._put(self.vectors_q, _END)
+                return
+            # 近重复切片不向量化 (整批都是重复时不调用接口)
+            targets = [r for r in batch if 'duplicate_of' not in r]
+            if targets:
+                vectors = self.adapter.get_embeddings([r['embedding_text'] for r in targets],
+                                                      provider_config=self.provider_config)
+                for record, vector in zip(targets, vectors):
+                    record['embedding'] = vector
+            self._put(self.vectors_q, batch)
+
+    # --- 阶段 5: 写入 (单线程，每批一个事务) ---
+    def _write(self):
+        remaining = self.workers
+        while remaining:
+            batch = self._get(self.vectors_q)
+            if batch is _END:
+                remaining -= 1
+                continue
+            self.db_conn.bulk_insert(batch)
+            self.stats['written'] += len(batch)
+            if self.on_batch:
+                self.on_batch(batch)
+            finished = []
+            with self._doc_lock:
+                for doc_title in {r['metadata']['doc_title'] for r in batch}:
+                    self._doc_pending[doc_title] -= 1
+                    if self._doc_pending[doc_title] == 0 and doc_title in self._doc_parsed_at:
+                        finished.append(doc_title)
+            for doc_title in finished:
+                self._mark_searchable(doc_title)
+
+    def _mark_searchable(self, doc_title):
+        with self._doc_lock:
+            parsed_at = self._doc_parsed_at.pop(doc_title)
+            self._doc_pending.pop(doc_title, None)
+            info = self._doc_info.pop(doc_title)
+        self._finish_document(doc_title, info)
+        latency = time.perf_counter() - parsed_at
+        self.stats['searchable_latency'][doc_title] = latency
+        self.logger(f"[Pipeline] 《{doc_title}》已全部入库可检索 (解析结束后 {latency:.2f}s)")
+
+    def _finish_document(self, doc_title, info):
+        """新版本已全部提交: 删除旧版本切片并登记，同一事务"""
+        conn = self.db_conn.get_connection()
+        try:
+            c = conn.cursor()
+            replaced = delete_chunks(c, info['old_ids'])
+            register_document(c, info['hash'], doc_title, info['version'], info['path'],
+                              info['page_count'], info['chunks'], self.settings)
+            conn.commit()
+        finally:
+            conn.close()
+        if replaced:
+            self.logger(f"[Registry] 《{doc_title}》替换旧版本的 {replaced} 个切片 (新版本 v{info['version']})")
+
+    def run(self, pdf_paths):
+        start_time = time.time()
+        threads = [self._stage(self._parse, list(pdf_paths)), self._stage(self._chunk), self._stage(self._batch)]
+        threads += [self._stage(self._embed) for _ in range(self.workers)]
+        threads.append(self._stage(self._write))
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+        self.logger(f"[Pipeline] 完成: {self.stats['docs']} 个文档 (跳过 {self.stats['skipped']}), {self.stats['chunks']} 个切片, "
+                    f"{self.stats['batches']} 批, 已写入 {self.stats['written']} 条 ({time.time() - start_time:.2f}s)")
+        if self.dedup is not None:
+            self.stats['duplicates'] = self.dedup.duplicates
+            self.logger(self.dedup.summary())
+        return self.stats
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="端到端流式入库: 解析 -> 切片 -> 向量化 -> 入库")
+    parser.add_argument("pdfs", nargs="+", help="PDF 文件路径")
+    parser.add_argument("--db", default=Config.DB_PATH, help="目标数据库路径")
+    parser.add_argument("--ocr", action="store_true", help="使用 OCR 解析 (扫描件)")
+    parser.add_argument("--provider", choices=sorted(PROVIDERS), default="intranet", help="向量化接口")
+    parser.add_argument("--mock", action="store_true", help="使用随机向量 (调试用)")
+    parser.add_argument("--batch-size", type=int, default=Config.DEFAULT_BATCH_SIZE, help="每次向量化请求的切片数")
+    parser.add_argument("--workers", type=int, default=Config.DEFAULT_CONCURRENCY, help="并发向量化线程数")
+    parser.add_argument("--queue-size", type=int, default=Config.PIPELINE_QUEUE_SIZE, help="阶段间队列容量 (条)")
+    parser.add_argument("--no-dedup", action="store_true", help="关闭近重复切片检测 (每条切片都向量化)")
+    return parser
+
+def main():
+    args = build_arg_parser().parse_args()
+    missing = [p for p in args.pdfs if not os.path.exists(p)]
+    if missing:
+        print(f"错误: 找不到文件 {', '.join(missing)}")
+        return 1
+    pipeline = StreamingIngestPipeline(DBConnector(args.db), EmbeddingAdapter(use_mock=args.mock),
+                                       provider_config=PROVIDERS[args.provider](), use_ocr=args.ocr,
+                                       batch_size=args.batch_size, workers=args.workers,
+                                       queue_size=args.queue_size, dedup=not args.no_dedup)
+    pipeline.run(args.pdfs)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,126 @@
+# document_registry.py
+"""
+文档登记表 (documents): 按文件内容哈希识别文档 (Day 2 各入口与流式流水线共用)
+
+此前文档身份只有 os.path.basename，同一份 PDF 重新拖入会重新 OCR / 切片并重复入库。
+登记表以内容 SHA-256 为主键，记录版本号、页数、切片数、解析参数与入库状态:
+- 内容与解析参数都未变 (find_ingested 命中) -> 直接跳过，不再解析
+- 同名文档内容变化 -> 版本号 +1；旧版本的切片与新版本的切片、登记记录在同一个事务中替换，
+  旧登记记录标记为 superseded
+- 文件改名但内容不变 -> 仍视为已入库
+
+切片仍以 doc_title 归属文档；删除切片时同步删除 chunk_identifiers 与已空的章节 (chunk_store)，
+FTS 与变更日志 (chunk_changes) 由 chunks 表上的触发器同步
+"""
+import hashlib
+import json
+from datetime import datetime
+from chunk_store import prune_sections, release_representatives
+
+HASH_BLOCK_SIZE = 1 << 20
+
+# 入库状态
+STATUS_INGESTED = "ingested"
+STATUS_SUPERSEDED = "superseded"
+STATUS_FAILED = "failed"
+STATUS_DELETED = "deleted"
+
+DOCUMENT_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS documents (
+        content_hash TEXT PRIMARY KEY,
+        doc_title TEXT NOT NULL,
+        version INTEGER NOT NULL,
+        source_path TEXT,
+        page_count INTEGER,
+        chunk_count INTEGER,
+        parse_settings TEXT,
+        status TEXT NOT NULL,
+        error TEXT,
+        created_at DATETIME,
+        updated_at DATETIME
+    )
+'''
+DOCUMENT_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_documents_title ON documents (doc_title, version)"
+
+def init_document_table(cursor):
+    cursor.execute(DOCUMENT_TABLE_SQL)
+    cursor.execute(DOCUMENT_INDEX_SQL)
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def encode_settings(settings):
+    """解析 / 切片参数 -> 规范化 JSON (键排序)，参数变化即视为需要重新处理"""
+    return json.dumps(settings or {}, ensure_ascii=False, sort_keys=True)
+
+def find_ingested(cursor, content_hash, settings):
+    """内容与解析参数都相同且已成功入库时返回 (doc_title, version)，否则返回 None"""
+    row = cursor.execute(
+        "SELECT doc_title, version FROM documents WHERE content_hash = ? AND status = ? AND parse_settings = ?",
+        (content_hash, STATUS_INGESTED, encode_settings(settings))
+    ).fetchone()
+    return (row[0], row[1]) if row else None
+
+def next_version(cursor, doc_title):
+    row = cursor.execute("SELECT MAX(version) FROM documents WHERE doc_title = ?", (doc_title,)).fetchone()
+    return (row[0] or 0) + 1
+
+def document_chunk_ids(cursor, doc_title):
+    """某文档当前在库的全部切片 chunk_uuid"""
+    return [row[0] for row in cursor.execute(
+        "SELECT chunk_uuid FROM chunks_full_index WHERE doc_title = ?", (doc_title,))]
+
+def delete_chunks(cursor, chunk_uuids):
+    """删除切片及其标识符索引、近重复归属 (不提交，由调用方控制事务)"""
+    rows = [(chunk_uuid,) for chunk_uuid in chunk_uuids]
+    if rows:
+        # 近重复簇的代表切片被删除时，向量转给簇内存活的切片
+        release_representatives(cursor, chunk_uuids)
+        cursor.executemany("DELETE FROM chunk_identifiers WHERE chunk_uuid = ?", rows)
+        cursor.executemany("DELETE FROM chunks_full_index WHERE chunk_uuid = ?", rows)
+        prune_sections(cursor)
+    return len(rows)
+
+def register_document(cursor, content_hash, doc_title, version, source_path, page_count, chunk_count, settings):
+    """
+    登记新版本为已入库，同名旧版本标记为 superseded (不提交)
+    调用方应在同一事务中先删除旧版本切片、写入新切片，再调用本函数后提交
+    """
+    now = datetime.now()
+    cursor.execute(
+        "UPDATE documents SET status = ?, updated_at = ? WHERE doc_title = ? AND content_hash != ? AND status = ?",
+        (STATUS_SUPERSEDED, now, doc_title, content_hash, STATUS_INGESTED)
+    )
+    cursor.execute(
+        '''INSERT OR REPLACE INTO documents
+           (content_hash, doc_title, version, source_path, page_count, chunk_count, parse_settings,
+            status, error, created_at, updated_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, NULL, ?, ?)''',
+        (content_hash, doc_title, version, source_path, page_count, chunk_count,
+         encode_settings(settings), STATUS_INGESTED, now, now)
+    )
+
+def mark_deleted(cursor, doc_title):
+    """文档被整体删除 (不提交)；同一文件再次入库时会重新处理"""
+    cursor.execute(
+        "UPDATE documents SET status = ?, updated_at = ? WHERE doc_title = ? AND status = ?",
+        (STATUS_DELETED, datetime.now(), doc_title, STATUS_INGESTED)
+    )
+
+def mark_failed(cursor, content_hash, doc_title, source_path, settings, error):
+    """记录处理失败 (不覆盖已成功入库的同内容记录)；下次运行会重试"""
+    now = datetime.now()
+    cursor.execute(
+        '''INSERT OR IGNORE INTO documents
+           (content_hash, doc_title, version, source_path, parse_settings, status, error, created_at, updated_at)
+           VALUES (?, ?, 0, ?, ?, ?, ?, ?, ?)''',
+        (content_hash, doc_title, source_path, encode_settings(settings), STATUS_FAILED, str(error), now, now)
+    )
+    cursor.execute(
+        "UPDATE documents SET error = ?, updated_at = ? WHERE content_hash = ? AND status = ?",
+        (str(error), now, content_hash, STATUS_FAILED)
+    )
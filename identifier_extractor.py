@@ -0,0 +1,149 @@
+# identifier_extractor.py
+"""
+文号 / 编号标识符抽取 (Day 2 入库与 Day 3 查询共用)
+
+- Day 2 切片时从 pure_text 中抽取标识符，写入 chunk_identifiers (identifier, chunk_uuid) 表
+- Day 3 查询时对问题做同样的抽取与归一化，命中即走 B-tree 等值查询，不再 LIKE 全表扫描或调向量接口
+- 两侧必须使用同一套规则与归一化，否则入库与查询的写法对不上
+"""
+import re
+
+# --- 抽取规则 (按需增删) ---
+# (类型, 正则)；正则含捕获组时取第 1 组作为标识符，否则取整个匹配
+IDENTIFIER_PATTERNS = [
+    # 发文字号: 国航发〔2023〕12号 / 民航规〔2021〕5号 (兼容 [] 【】 () （） 等括号写法)
+    ("doc_number", r"[一-龥]{1,8}\s*[〔\[【（(]\s*(?:19|20)\d{2}\s*[〕\]】）)]\s*第?\s*\d{1,5}\s*号"),
+    # 标准编号: MH/T 6040-2016 / GB/T 19001-2016 / HB 7013-2019
+    ("standard", r"(?<![A-Za-z])(?:GB|GJB|HB|MH|AC)(?:\s*/\s*[TZ])?\s*\d{1,6}(?:\.\d+)?\s*[-—]\s*(?:19|20)\d{2}"),
+    # ICS 分类号: ICS 49.020 / ICS 03.220.50
+    ("ics", r"ICS\s*[:：]?\s*\d{2}(?:\.\d{2,3}){1,2}"),
+    # 工作号 / 工卡号: 工作号 A001 / 工卡号：WO-2023-0012
+    ("work_number", r"(?:工作号|工卡号|工单号)\s*[:：]?\s*([A-Za-z0-9][A-Za-z0-9\-_/]{2,31})"),
+    # 条款号: 第十二条 / 第3条
+    ("clause", r"第[一二三四五六七八九十百零〇\d]{1,6}条"),
+    # 多级章节号: 3.2.1 / 4.10.2.3 (至少三级，避免误匹配小数)
+    ("section_number", r"(?<![\d.])\d{1,2}(?:\.\d{1,2}){2,3}(?![\d.])"),
+]
+
+# 全库唯一的类型: 命中即可确定是哪份文档 (可直接短路向量检索 / 加分)
+# 条款号、章节号只在文档内唯一 ("第三条" 每份通知都有)，只能在文档范围确定后使用
+UNIQUE_IDENTIFIER_KINDS = frozenset({"doc_number", "standard", "ics", "work_number"})
+
+# 括号统一为〔〕，全角冒号 / 破折号统一为半角
+_BRACKET_MAP = str.maketrans({"[": "〔", "【": "〔", "(": "〔", "（": "〔",
+                              "]": "〕", "】": "〕", ")": "〕", "）": "〕",
+                              "：": ":", "—": "-"})
+_WHITESPACE = re.compile(r"\s+")
+# 问题中粘连在机关代字前的引导词 ("请问国航发〔..〕"、"根据民航规〔..〕")，查询时剥掉后剩下的才是代字
+_QUERY_LEAD_IN = re.compile(r"^(?:请问|请教|根据|依据|按照|参照|参见|遵照|关于|对于|执行|落实|贯彻|[据依按照见对在与和及])+")
+
+_COMPILED = None
+
+def _compiled_patterns():
+    global _COMPILED
+    if _COMPILED is None:
+        _COMPILED = [(kind, re.compile(pattern)) for kind, pattern in IDENTIFIER_PATTERNS]
+    return _COMPILED
+
+def normalize_identifier(identifier):
+    """归一化: 去空白、统一括号与符号、ASCII 字母转大写"""
+    identifier = _WHITESPACE.sub("", identifier).translate(_BRACKET_MAP)
+    return identifier.upper()
+
+def identifier_variants(kind, identifier):
+    """
+    同一标识符的等价写法 (长 -> 短)
+    发文字号的机关代字前可能粘连正文 ("根据国航发〔2023〕1号")，正则无法判断代字从哪里开始，
+    因此保留代字的各个后缀 (至少 2 字): 根据国航发〔..〕、据国航发〔..〕、国航发〔..〕、航发〔..〕
+    入库时全部写入；查询时不能用这些后缀 (见 query_identifier_variants)
+    """
+    if kind != "doc_number" or "〔" not in identifier:
+        return [identifier]
+    prefix, rest = identifier.split("〔", 1)
+    if len(prefix) <= 2:
+        return [identifier]
+    return [prefix[-n:] + "〔" + rest for n in range(len(prefix), 1, -1)]
+
+def query_identifier_variants(kind, identifier):
+    """
+    查询侧的等价写法 (长 -> 短)，只剥掉机关代字前的引导词 ("请问"、"根据"、"依据" 等)，不再继续截短代字:
+    "国航发〔2023〕12号" 若截到 "航发〔2023〕12号"，会精确命中 "民航发〔2023〕12号" 的切片
+    """
+    if kind != "doc_number" or "〔" not in identifier:
+        return [identifier]
+    prefix, rest = identifier.split("〔", 1)
+    agency = _QUERY_LEAD_IN.sub("", prefix) or prefix
+    return [prefix[-n:] + "〔" + rest for n in range(len(prefix), len(agency) - 1, -1)]
+
+def extract_identifiers(text):
+    """
+    从文本中抽取标识符
+    返回: [(kind, identifier), ...]，已归一化、按首次出现顺序去重
+    """
+    if not text:
+        return []
+    found = []
+    seen = set()
+    for kind, regex in _compiled_patterns():
+        for match in regex.finditer(text):
+            raw = match.group(1) if regex.groups else match.group(0)
+            identifier = normalize_identifier(raw)
+            if identifier and identifier not in seen:
+                seen.add(identifier)
+                found.append((kind, identifier))
+    return found
+
+# --- 数据库 (chunk_identifiers 表) ---
+# WITHOUT ROWID + (identifier, chunk_uuid) 主键：按标识符等值查询只走一次 B-tree
+IDENTIFIER_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS chunk_identifiers (
+        identifier TEXT NOT NULL,
+        kind TEXT,
+        chunk_uuid TEXT NOT NULL,
+        PRIMARY KEY (identifier, chunk_uuid)
+    ) WITHOUT ROWID
+'''
+IDENTIFIER_INDEX_SQL = "CREATE INDEX IF NOT EXISTS idx_chunk_identifiers_uuid ON chunk_identifiers (chunk_uuid)"
+
+def init_identifier_table(cursor):
+    cursor.execute(IDENTIFIER_TABLE_SQL)
+    cursor.execute(IDENTIFIER_INDEX_SQL)
+
+def insert_identifiers(cursor, chunk_uuid, identifiers):
+    """identifiers: [(kind, identifier), ...] (extract_identifiers 的输出)，连同各等价写法一起写入"""
+    rows = [(variant, kind, chunk_uuid)
+            for kind, identifier in identifiers
+            for variant in identifier_variants(kind, identifier)]
+    if rows:
+        cursor.executemany(
+            "INSERT OR IGNORE INTO chunk_identifiers (identifier, kind, chunk_uuid) VALUES (?, ?, ?)", rows
+        )
+
+if __name__ == "__main__":
+    # 自检: 机关代字后缀相同的两个文号不能互相命中 (python identifier_extractor.py)
+    import sqlite3
+    conn = sqlite3.connect(":memory:")
+    cur = conn.cursor()
+    init_identifier_table(cur)
+    insert_identifiers(cur, "min", extract_identifiers("依据民航发〔2023〕12号执行"))
+    insert_identifiers(cur, "guo", extract_identifiers("国航发〔2024〕3号"))
+
+    def lookup(query):
+        for kind, identifier in extract_identifiers(query):
+            for variant in query_identifier_variants(kind, identifier):
+                rows = cur.execute("SELECT chunk_uuid FROM chunk_identifiers WHERE identifier = ?",
+                                   (variant,)).fetchall()
+                if rows:
+                    return sorted(r[0] for r in rows)
+        return []
+
+    cases = [
+        ("国航发〔2023〕12号的要求是什么", []),
+        ("民航发〔2023〕12号的要求是什么", ["min"]),
+        ("请问民航发〔2023〕12号", ["min"]),
+        ("根据国航发〔2024〕3号", ["guo"]),
+    ]
+    for query, expected in cases:
+        got = lookup(query)
+        assert got == expected, f"{query}: {got} != {expected}"
+    print(f"[Identifier] 自检通过 ({len(cases)} 例)")
@@ -0,0 +1,143 @@
+# ocr_scheduler.py
+"""
+全局 OCR 调度器 (解析层共用: Day 1 界面、Day 2 ETL / 批量 ETL、流式流水线)
+
+多个扫描件同时解析时，每次 Tesseract 调用都会按核数开 OpenMP 线程，N 个文档并发就是 N x 核数个线程，
+机器反而更慢。这里把 OCR 限制为固定数量的 "槽位":
+- 每个槽位同一时刻只跑一页 OCR，Tesseract 线程数固定为 threads_per_slot (OMP_THREAD_LIMIT)，
+  槽位数 x 每槽线程数 ≈ CPU 核数，页吞吐随核数线性增长
+- 排队按优先级放行: 交互请求 (PRIORITY_INTERACTIVE，Day 1 界面) 先于批量任务 (PRIORITY_BATCH，解析默认值)；
+  同级别按文档页数，短文档先走完。优先级只在共用同一个调度器的线程 / 进程之间生效，不跨独立启动的程序
+- stats() 给出排队深度、槽位利用率与平均等待
+
+单进程内直接用 get_scheduler()；多进程 (day2_batch_etl 进程池) 由主进程 start_shared_scheduler()
+启动一个 Manager 服务，工作进程用 install_scheduler(proxy) 挂上代理，全部进程共享同一组槽位
+"""
+import heapq
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from config import RAGConfig
+
+# 优先级 (数值越小越先放行)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+
+def configure_tesseract_threads(threads):
+    """Tesseract (OpenMP) 启动时读取该变量；pytesseract 的子进程继承当前进程环境变量"""
+    os.environ['OMP_THREAD_LIMIT'] = str(max(1, int(threads)))
+
+class OCRScheduler:
+    """
+    OCR 槽位调度 (线程安全)
+    acquire(priority, size) 阻塞到获得槽位，返回 ticket；release(ticket) 归还
+    size: 文档页数，同优先级下越小越先放行
+    """
+    def __init__(self, slots=None, threads_per_slot=None):
+        self.slots = max(1, slots or RAGConfig.OCR_SLOTS)
+        self.threads_per_slot = max(1, threads_per_slot or RAGConfig.OCR_THREADS_PER_SLOT)
+        configure_tesseract_threads(self.threads_per_slot)
+        self._cond = threading.Condition()
+        self._waiting = []  # 堆: (priority, size, seq)
+        self._seq = itertools.count()
+        self._busy = {}  # ticket -> 获得槽位的时间
+        self._started = time.perf_counter()
+        self._busy_seconds = 0.0
+        self._granted = 0
+        self._wait_seconds = 0.0
+        self._max_wait = 0.0
+
+    def acquire(self, priority=PRIORITY_BATCH, size=0):
+        enqueued = time.perf_counter()
+        with self._cond:
+            entry = (priority, size, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            # 只有排在堆顶且有空闲槽位时才放行，保证高优先级 / 短文档插队
+            try:
+                while len(self._busy) >= self.slots or self._waiting[0] is not entry:
+                    self._cond.wait()
+            except BaseException:
+                # 等待被中断 (KeyboardInterrupt 等): 撤掉自己的排队项，否则它留在堆顶会挡住之后所有等待者
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            now = time.perf_counter()
+            ticket = entry[2]
+            self._busy[ticket] = now
+            waited = now - enqueued
+            self._granted += 1
+            self._wait_seconds += waited
+            self._max_wait = max(self._max_wait, waited)
+            # 堆顶换人了，若还有空槽让下一个也检查一次
+            self._cond.notify_all()
+            return ticket
+
+    def release(self, ticket):
+        with self._cond:
+            self._busy_seconds += time.perf_counter() - self._busy.pop(ticket)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            now = time.perf_counter()
+            busy_seconds = self._busy_seconds + sum(now - t for t in self._busy.values())
+            elapsed = max(now - self._started, 1e-6)
+            return {
+                'slots': self.slots,
+                'threads_per_slot': self.threads_per_slot,
+                'busy': len(self._busy),
+                'queue_depth': len(self._waiting),
+                'utilization': round(busy_seconds / (elapsed * self.slots), 3),
+                'granted': self._granted,
+                'avg_wait_ms': round(self._wait_seconds / self._granted * 1000, 2) if self._granted else 0.0,
+                'max_wait_ms': round(self._max_wait * 1000, 2),
+            }
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    """当前进程使用的调度器 (首次调用时按 RAGConfig 创建本地调度器)"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = OCRScheduler()
+        return _scheduler
+
+def install_scheduler(scheduler, threads_per_slot=None):
+    """替换当前进程的调度器 (工作进程挂上主进程共享调度器的代理)"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = scheduler
+    if threads_per_slot:
+        configure_tesseract_threads(threads_per_slot)
+
+@contextmanager
+def ocr_slot(priority=PRIORITY_BATCH, size=0):
+    """with ocr_slot(...): 占用一个 OCR 槽位执行一页识别"""
+    scheduler = get_scheduler()
+    ticket = scheduler.acquire(priority, size)
+    try:
+        yield
+    finally:
+        scheduler.release(ticket)
+
+class OCRSchedulerManager(BaseManager):
+    pass
+
+OCRSchedulerManager.register('OCRScheduler', OCRScheduler)
+
+def start_shared_scheduler(slots=None, threads_per_slot=None):
+    """
+    启动跨进程共享的调度器服务，返回 (manager, proxy)
+    proxy 可作为参数传给进程池的 initializer，再由 install_scheduler() 挂上；用完调用 manager.shutdown()
+    Manager 服务端每个连接一个线程，acquire 的阻塞等待在服务端进行
+    """
+    manager = OCRSchedulerManager()
+    manager.start()
+    return manager, manager.OCRScheduler(slots, threads_per_slot)
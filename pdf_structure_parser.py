@@ -5,6 +5,7 @@ import re
 from PIL import Image
 from config import RAGConfig
 from image_preprocessing import preprocess_image_for_ocr
+from ocr_scheduler import ocr_slot, PRIORITY_BATCH
 
 class DocumentLine:
     """定义一行文本及其属性"""
@@ -19,11 +20,14 @@ class DocumentLine:
         return f"[{self.role}] size={self.font_size:.1f} | {self.text[:20]}..."
 
 class PDFStructureParser:
-    def __init__(self, filepath, use_ocr=True):
+    def __init__(self, filepath, use_ocr=True, ocr_priority=PRIORITY_BATCH):
         self.filepath = filepath
         self.use_ocr = use_ocr
+        # OCR 调度优先级: 默认按批量任务排队，交互界面 (Day 1) 显式传 PRIORITY_INTERACTIVE
+        self.ocr_priority = ocr_priority
         self.parsed_lines = []
         self.body_font_size = 10.5 
+        self.page_count = 0
 
     def parse(self, callback_signal=None):
         """执行解析主流程"""
@@ -31,6 +35,7 @@ class PDFStructureParser:
         
         with pdfplumber.open(self.filepath) as pdf:
             total_pages = len(pdf.pages)
+            self.page_count = total_pages
             
             for i, page in enumerate(pdf.pages):
                 page_num = i + 1
@@ -58,13 +63,57 @@ class PDFStructureParser:
         
         return self.parsed_lines
 
+    def iter_lines(self, callback_signal=None, sample_pages=None):
+        """
+        流式解析: 逐页产出清洗合并后的行，供流水线边解析边切片 (parse() 要等整本 PDF 解析完)
+        正文字号需要统计，这里只用前 sample_pages 页估计；文档不超过 sample_pages 页时与 parse() 结果一致
+        合并规则只看相邻两行，保留一行缓冲即可流式输出
+        """
+        sample_pages = sample_pages or RAGConfig.STREAM_FONT_SAMPLE_PAGES
+        return self._iter_clean_and_merge(self._iter_tagged_lines(callback_signal, sample_pages))
+
+    def _iter_tagged_lines(self, callback_signal, sample_pages):
+        """逐页提取并打标；前 sample_pages 页先缓存，用于统计正文字号"""
+        sample = []
+        with pdfplumber.open(self.filepath) as pdf:
+            total_pages = len(pdf.pages)
+            self.page_count = total_pages
+            
+            for i, page in enumerate(pdf.pages):
+                page_num = i + 1
+                if callback_signal:
+                    callback_signal.emit(f"正在分析第 {page_num}/{total_pages} 页...", int(page_num/total_pages*50))
+                
+                if self.use_ocr:
+                    lines = self._extract_via_ocr(page, page_num, resolution=400)
+                else:
+                    lines = self._extract_via_plumber(page, page_num)
+                
+                if page_num < sample_pages and page_num < total_pages:
+                    sample.extend(lines)
+                    continue
+                if sample is not None:
+                    # 样本页收齐：统计字号，补发样本页
+                    sample.extend(lines)
+                    self.parsed_lines = sample
+                    self._analyze_font_statistics()
+                    self._tag_roles()
+                    yield from sample
+                    sample = None
+                    continue
+                for line in lines:
+                    self._tag_line(line)
+                    yield line
+
     def _extract_via_ocr(self, page, page_num, resolution=400):
         """OCR 模式提取"""
         # 提高 DPI 有助于识别 '国际' vs '国破'
         img_pil = page.to_image(resolution=resolution).original
         processed_img = preprocess_image_for_ocr(img_pil)
         
-        data = pytesseract.image_to_data(processed_img, lang='chi_sim+eng', output_type=pytesseract.Output.DICT)
+        # 占用全局 OCR 槽位 (同优先级下页数少的文档先放行)
+        with ocr_slot(self.ocr_priority, self.page_count):
+            data = pytesseract.image_to_data(processed_img, lang='chi_sim+eng', output_type=pytesseract.Output.DICT)
         df = pd.DataFrame(data)
         
         # 过滤空文本
@@ -134,24 +183,31 @@ class PDFStructureParser:
     def _tag_roles(self):
         """打标"""
         for line in self.parsed_lines:
-            diff = line.font_size - self.body_font_size
-            # 这里可以根据实际情况微调
-            if diff > RAGConfig.HEADER_SIZE_THRESHOLD + 1.5:
-                line.role = "H1"
-            elif diff > RAGConfig.HEADER_SIZE_THRESHOLD:
-                line.role = "H2"
-            else:
-                line.role = "BODY"
+            self._tag_line(line)
+
+    def _tag_line(self, line):
+        diff = line.font_size - self.body_font_size
+        # 这里可以根据实际情况微调
+        if diff > RAGConfig.HEADER_SIZE_THRESHOLD + 1.5:
+            line.role = "H1"
+        elif diff > RAGConfig.HEADER_SIZE_THRESHOLD:
+            line.role = "H2"
+        else:
+            line.role = "BODY"
 
     def _clean_and_merge(self, lines):
         """
         优化3: 深度清洗与合并 (The Magic Function)
         解决标题断裂、页码干扰问题
         """
-        cleaned_lines = []
+        return list(self._iter_clean_and_merge(lines))
+
+    def _iter_clean_and_merge(self, lines):
+        """_clean_and_merge 的流式版本: 清洗后与上一行比较，能合并就合并，否则输出上一行"""
+        current_block = None
         
-        # --- 第一轮：清洗 ---
         for line in lines:
+            # --- 第一轮：清洗 ---
             txt = line.text.strip()
             if not txt: continue
             
@@ -163,34 +219,27 @@ class PDFStructureParser:
             # 去除 OCR 产生的奇怪单字符行
             if len(txt) == 1 and not '\u4e00' <= txt <= '\u9fa5':
                 continue
-                
-            cleaned_lines.append(line)
             
-        if not cleaned_lines: return []
-
-        # --- 第二轮：合并同类项 ---
-        merged_lines = []
-        current_block = cleaned_lines[0]
-        
-        for i in range(1, len(cleaned_lines)):
-            next_line = cleaned_lines[i]
+            # --- 第二轮：合并同类项 ---
+            if current_block is None:
+                current_block = line
+                continue
             
             # 判断是否应该合并：
             # 1. 角色相同 (都是 H1 或 都是 H2)
             # 2. 也是正文，且上一行没有以句号/分号结束 (简单的段落拼接)
-            same_role_merge = (current_block.role in ['H1', 'H2'] and next_line.role == current_block.role)
+            same_role_merge = (current_block.role in ['H1', 'H2'] and line.role == current_block.role)
             
             # 标题必须合并，正文视情况合并
             if same_role_merge:
-                current_block.text += " " + next_line.text # 合并文本
+                current_block.text += " " + line.text # 合并文本
                 # 字号取平均或保持最大，这里保持原样
             else:
-                merged_lines.append(current_block)
-                current_block = next_line
+                yield current_block
+                current_block = line
                 
-        merged_lines.append(current_block) # 加上最后一行
-        
-        return merged_lines
+        if current_block is not None:
+            yield current_block # 加上最后一行
 
     def build_tree_structure(self):
         """构建树 (UI展示用)"""